@@ -0,0 +1,86 @@
+"""Benchmarks the eye-region crop (face_crop.getCrop) against the per-landmark loop it replaced.
+
+Landmarks are synthesized around the center of the frame, so MediaPipe is not needed.
+
+    python benchmark_crop.py [--frames 500] [--width 640] [--height 480]
+"""
+import argparse
+import time
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+
+from face_crop import POI4AOI, _normalized_to_pixel_coordinates, getCrop, warpFrom
+
+
+def getCropLoop(img, landmarks):
+    """The previous implementation: warps the whole frame and transforms landmarks one by one."""
+    h, w, _ = img.shape
+    pt1, pt2, pt3 = landmarks.landmark[133], landmarks.landmark[362], landmarks.landmark[2]
+    matrix = warpFrom(
+        _normalized_to_pixel_coordinates(pt1.x, pt1.y, w, h),
+        _normalized_to_pixel_coordinates(pt2.x, pt2.y, w, h),
+        _normalized_to_pixel_coordinates(pt3.x, pt3.y, w, h),
+    )
+    dstImg = cv2.warpAffine(img, matrix, (img.shape[1], img.shape[0]))
+
+    left, top, bottom, right = -1, -1, -1, -1
+    init = False
+    for idx in POI4AOI:
+        px = landmarks.landmark[idx]
+        try:
+            px = _normalized_to_pixel_coordinates(px.x, px.y, w, h)
+            px = (matrix @ np.array([px[0], px[1], 1])).astype(int)
+            if not init:
+                left, right = px[0], px[0]
+                top, bottom = px[1], px[1]
+                init = True
+                continue
+            left, right = min(left, px[0]), max(right, px[0])
+            top, bottom = min(top, px[1]), max(bottom, px[1])
+        except Exception as e:
+            print('ERROR:{}'.format(e))
+    return dstImg[top:bottom+1, left:right+1]
+
+
+def make_landmarks(rng):
+    """Synthesizes the 468 face landmarks of a face with the eyes near the center of the frame."""
+    points = rng.uniform(0.35, 0.65, (468, 2))
+    # inner eye corners and the tip of the nose, used for alignment
+    points[133] = rng.normal((0.45, 0.45), 0.01)
+    points[362] = rng.normal((0.55, 0.45), 0.01)
+    points[2] = rng.normal((0.5, 0.58), 0.01)
+    return SimpleNamespace(landmark=[SimpleNamespace(x=x, y=y) for x, y in points])
+
+
+def bench(crop, frames):
+    t0 = time.perf_counter()
+    for img, landmarks in frames:
+        crop(img, landmarks)
+    return (time.perf_counter() - t0) / len(frames)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=500)
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--height', type=int, default=480)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    frames = [(rng.integers(0, 256, (args.height, args.width, 3), dtype=np.uint8), make_landmarks(rng))
+              for _ in range(args.frames)]
+
+    # same box; pixels may differ by rounding of the interpolation
+    max_diff = 0
+    for img, landmarks in frames[:20]:
+        expected, actual = getCropLoop(img, landmarks), getCrop(img, landmarks)
+        assert expected.shape == actual.shape, (expected.shape, actual.shape)
+        max_diff = max(max_diff, int(np.abs(expected.astype(int) - actual.astype(int)).max()))
+
+    loop = bench(getCropLoop, frames)
+    vectorized = bench(getCrop, frames)
+    print('{} frames of {}x{}, max pixel difference {}'.format(args.frames, args.width, args.height, max_diff))
+    print('loop:       {:.3f} ms/frame'.format(loop * 1000))
+    print('vectorized: {:.3f} ms/frame ({:.1f}x)'.format(vectorized * 1000, loop / vectorized))
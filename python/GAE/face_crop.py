@@ -0,0 +1,127 @@
+"""Crops the eye region of a face for confusion detection."""
+import math
+
+import cv2
+import numpy as np
+
+POI4AOI = [33, 7, 163, 144, 145, 153, 154, 155, 133, 246, 161, 160, 159,
+           158, 157, 173, 263, 249, 390, 373, 374, 380, 381, 382, 362,
+           466, 388, 387, 386, 385, 384, 398, 46, 53, 52, 65, 55, 70, 63, 105,
+           66, 107, 276, 283, 282, 295, 285, 300, 293, 334, 296, 336]
+
+
+def _normalized_to_pixel_coordinates(normalized_x, normalized_y, image_width, image_height):
+    """Converts normalized value pair to pixel coordinates."""
+
+    # Checks if the float value is between 0 and 1.
+    def is_valid_normalized_value(value: float) -> bool:
+        return (value > 0 or math.isclose(0, value)) and (value < 1 or
+                                                          math.isclose(1, value))
+
+    if not (is_valid_normalized_value(normalized_x) and
+            is_valid_normalized_value(normalized_y)):
+        # TODO: Draw coordinates even if it's outside of the image bounds.
+        return None
+    x_px = min(math.floor(normalized_x * image_width), image_width - 1)
+    y_px = min(math.floor(normalized_y * image_height), image_height - 1)
+    return x_px, y_px
+
+def getCrop(img, landmarks):
+    h, w, _ = img.shape
+    pt1, pt2, pt3 = landmarks.landmark[133], landmarks.landmark[362], landmarks.landmark[2]
+    matrix = warpFrom(
+        _normalized_to_pixel_coordinates(pt1.x, pt1.y, w, h),
+        _normalized_to_pixel_coordinates(pt2.x, pt2.y, w, h),
+        _normalized_to_pixel_coordinates(pt3.x, pt3.y, w, h),
+    )
+
+    # pixel coordinates of the landmarks around the eyes, same as _normalized_to_pixel_coordinates()
+    points = np.array([(landmarks.landmark[idx].x, landmarks.landmark[idx].y) for idx in POI4AOI])
+    valid = np.all((points >= 0) & (points <= 1), axis=1)
+    if not np.any(valid):
+        return img[0:0, 0:0]
+    points = np.minimum(np.floor(points[valid] * (w, h)), (w - 1, h - 1))
+
+    # bounding box of the warped landmarks. It is in the coordinates of warpFrom(), which do not depend on the size of
+    # the frame, so it is not clamped to the frame: the eyes of a small frame may be warped below its bottom.
+    warped = (np.hstack([points, np.ones((points.shape[0], 1))]) @ matrix.T).astype(int)
+    left, top = np.maximum(warped.min(axis=0), 0)
+    right, bottom = warped.max(axis=0)
+    if right < left or bottom < top:
+        return img[0:0, 0:0]
+
+    # warp the bounding box only, instead of the whole frame
+    matrix = matrix.copy()
+    matrix[:, 2] -= (left, top)
+    # return cv2.rectangle(dstImg, (left, top), (right, bottom), (255, 0, 0), 2)
+    return cv2.warpAffine(img, matrix, (int(right - left + 1), int(bottom - top + 1)))
+
+
+def warpFrom(pt1, pt2, pt3):
+
+    srcTri = np.array([[pt1[0], pt1[1]],
+                       [pt2[0], pt2[1]],
+                       [pt3[0], pt3[1]]]).astype(np.float32)
+
+    dstTri = np.array([[300, 180],
+                       [340, 180],
+                       [320, 240]]).astype(np.float32)
+    matrix = cv2.getAffineTransform(srcTri, dstTri)
+    return matrix
+
+
+class FaceTracker:
+    """
+    Keeps the face box of a user across frames, so that the landmarks of a frame are detected in the region
+    around the face of the previous frame, instead of the whole frame.
+
+    The full frame is used again when no face is found in the region, or the face reaches its border, i.e., it is
+    moving out of the region.
+    """
+
+    def __init__(self, detect, margin=0.25):
+        """
+        :param detect: A function that returns the face landmarks in an RGB image, or None.
+        :param margin: The region is the box of the landmarks expanded by margin * its size on each side.
+        """
+        self.detect = detect
+        self.margin = margin
+        # (left, top, right, bottom) in pixels, and the shape of the frame it belongs to
+        self.box = None
+        self.frame_shape = None
+
+    def reset(self):
+        self.box = None
+
+    def track(self, rgb):
+        """Returns the landmarks of the face in an RGB frame, normalized to the frame, or None."""
+        h, w = rgb.shape[:2]
+        if self.box is not None and self.frame_shape == rgb.shape:
+            left, top, right, bottom = self.box
+            landmarks = self.detect(np.ascontiguousarray(rgb[top:bottom, left:right]))
+            if landmarks is not None:
+                points = np.array([(lm.x, lm.y) for lm in landmarks.landmark])
+                if np.all(points > 0) and np.all(points < 1):
+                    # back to the coordinates of the frame
+                    for lm, (x, y) in zip(landmarks.landmark, points):
+                        lm.x = (left + x * (right - left)) / w
+                        lm.y = (top + y * (bottom - top)) / h
+                    self._update(points * (right - left, bottom - top) + (left, top), rgb.shape)
+                    return landmarks
+
+        landmarks = self.detect(rgb)
+        if landmarks is None:
+            self.box = None
+        else:
+            self._update(np.array([(lm.x, lm.y) for lm in landmarks.landmark]) * (w, h), rgb.shape)
+        return landmarks
+
+    def _update(self, points, frame_shape):
+        h, w = frame_shape[:2]
+        (x0, y0), (x1, y1) = points.min(axis=0), points.max(axis=0)
+        dx, dy = (x1 - x0) * self.margin, (y1 - y0) * self.margin
+        self.box = (max(int(x0 - dx), 0), max(int(y0 - dy), 0), min(int(math.ceil(x1 + dx)), w),
+                    min(int(math.ceil(y1 + dy)), h))
+        self.frame_shape = frame_shape
+        if self.box[2] - self.box[0] < 2 or self.box[3] - self.box[1] < 2:
+            self.box = None
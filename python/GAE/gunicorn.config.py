@@ -30,4 +30,11 @@ def getFileHandler():
 
     return fh
 
-logging.getLogger('gunicorn.error').addHandler(getFileHandler())
\ No newline at end of file
+logging.getLogger('gunicorn.error').addHandler(getFileHandler())
+
+
+def post_fork(server, worker):
+    # runs in the worker before the gevent worker monkey-patches it and loads main.py, see training_pool.py
+    import training_pool
+    training_pool.start()
+    server.log.info('training pool of worker {} started'.format(worker.pid))
@@ -18,24 +18,55 @@ import time
 import argparse
 import flask
 from flask import Flask, redirect, render_template, request
-from threading import Thread
+from threading import Thread, Lock
+from threading import Condition
+from concurrent.futures import Future
+import queue
+import copy
 import logging
 from datetime import date
 import re
 import shutil
 
+import training_pool
+from face_crop import FaceTracker, getCrop
+
+try:
+    from gevent import get_hub
+    from gevent.monkey import is_module_patched
+except ImportError:
+    # not running under the gevent worker, e.g., tested locally with Flask
+    get_hub = None
+
 CNTR = 0
 TOTAL = 400
 
+# Incremental training: frames of a user are applied in mini-batches of BATCH_SIZE,
+# or after MAX_DELAY seconds if fewer frames arrive.
+BATCH_SIZE = 16
+MAX_DELAY = 2.0
+# Models of a user are written to disk at most once every CHECKPOINT_INTERVAL seconds.
+CHECKPOINT_INTERVAL = 10.0
+# A version written by a worker is removed from disk by that worker once it is MODEL_RETENTION seconds old and a newer
+# one is written, so that other workers and replicas have time to load it.
+MODEL_RETENTION = 60.0
+# The disk is checked for a newer version of a user, written by another worker, at most every MODEL_REFRESH_INTERVAL
+# seconds.
+MODEL_REFRESH_INTERVAL = 1.0
+# Collected crops of a user are written to disk SNAPSHOT_DELAY seconds after the last one.
+SNAPSHOT_DELAY = 0.5
+# Face landmarks of all users are detected by FACEMESH_POOL_SIZE shared FaceMesh instances in each gunicorn worker.
+# Each instance takes up to FACEMESH_MAX_BATCH frames that arrive within FACEMESH_BATCH_WINDOW seconds at a time.
+FACEMESH_POOL_SIZE = 2
+FACEMESH_MAX_BATCH = 8
+FACEMESH_BATCH_WINDOW = 0.005
+# Landmarks are detected in the face box of the previous frame, expanded by TRACK_MARGIN of its size on each side.
+TRACK_MARGIN = 0.25
+
 DEPLOYED = True # Set to False when test locally
 
 FILEPATH = '/mnt/fileserver' if DEPLOYED else 'fileserver'
 
-POI4AOI = [33, 7, 163, 144, 145, 153, 154, 155, 133, 246, 161, 160, 159,
-           158, 157, 173, 263, 249, 390, 373, 374, 380, 381, 382, 362,
-           466, 388, 387, 386, 385, 384, 398, 46, 53, 52, 65, 55, 70, 63, 105,
-           66, 107, 276, 283, 282, 295, 285, 300, 293, 334, 296, 336]
-
 if not os.path.exists(FILEPATH):
     # os.rmdir(FILEPATH)
     os.makedirs(FILEPATH)
@@ -44,70 +75,21 @@ if not os.path.exists(FILEPATH):
 modelPool = {}
 metricPool = {}
 
-def _normalized_to_pixel_coordinates(normalized_x, normalized_y, image_width, image_height):
-    """Converts normalized value pair to pixel coordinates."""
-
-    # Checks if the float value is between 0 and 1.
-    def is_valid_normalized_value(value: float) -> bool:
-        return (value > 0 or math.isclose(0, value)) and (value < 1 or
-                                                          math.isclose(1, value))
-
-    if not (is_valid_normalized_value(normalized_x) and
-            is_valid_normalized_value(normalized_y)):
-        # TODO: Draw coordinates even if it's outside of the image bounds.
-        return None
-    x_px = min(math.floor(normalized_x * image_width), image_width - 1)
-    y_px = min(math.floor(normalized_y * image_height), image_height - 1)
-    return x_px, y_px
-
-def getCrop(img, landmarks):
-    h, w, _ = img.shape
-    pt1, pt2, pt3 = landmarks.landmark[133], landmarks.landmark[362], landmarks.landmark[2]
-    matrix = warpFrom(
-        _normalized_to_pixel_coordinates(pt1.x, pt1.y, w, h),
-        _normalized_to_pixel_coordinates(pt2.x, pt2.y, w, h),
-        _normalized_to_pixel_coordinates(pt3.x, pt3.y, w, h),
-    )
-    dstImg = cv2.warpAffine(img, matrix, (img.shape[1], img.shape[0]))
-
-    left, top, bottom, right = -1, -1, -1, -1
-
-    init = False
-    for idx in POI4AOI:
-        px = landmarks.landmark[idx]
-        try:
-            px = _normalized_to_pixel_coordinates(px.x, px.y, w, h)
-            px = (matrix @ np.array([px[0], px[1], 1])).astype(np.int)
-            if not init:
-                left, right = px[0], px[0]
-                top, bottom = px[1], px[1]
-                init = True
-                continue
-            if left > px[0]:
-                left = px[0]
-            if right < px[0]:
-                right = px[0]
-            if top > px[1]:
-                top = px[1]
-            if bottom < px[1]:
-                bottom = px[1]
-        except Exception as e:
-            print('ERROR:{}'.format(e))
-
-    # return cv2.rectangle(dstImg, (left, top), (right, bottom), (255, 0, 0), 2)
-    return dstImg[top:bottom+1, left:right+1]
-
-def warpFrom(pt1, pt2, pt3):
-
-    srcTri = np.array([[pt1[0], pt1[1]],
-                       [pt2[0], pt2[1]],
-                       [pt3[0], pt3[1]]]).astype(np.float32)
 
-    dstTri = np.array([[300, 180],
-                       [340, 180],
-                       [320, 240]]).astype(np.float32)
-    matrix = cv2.getAffineTransform(srcTri, dstTri)
-    return matrix
+def run_native(func, *args):
+    """
+    Calls func(*args) in a native thread and returns its result.
+
+    Under the gevent worker of gunicorn, `threading` is monkey-patched, so the background threads below are greenlets
+    sharing one native thread with the requests, and CPU-bound work in them (partial_fit, FaceMesh, writing models)
+    would stall every request of the worker. Such work is run in the threadpool of the gevent hub instead: only the
+    calling greenlet waits, and the work runs in native code that releases the GIL for most of its time.
+    func must not use the locks, conditions and queues of this module, which are patched as well.
+    Without gevent, func is called directly, the background threads are native threads already.
+    """
+    if get_hub is not None and is_module_patched('threading'):
+        return get_hub().threadpool.apply(func, args)
+    return func(*args)
 
 
 class Metric:
@@ -142,13 +124,588 @@ class Metric:
         )
         return text
 
+class ModelRegistry:
+    """
+    Keeps the models (classifier, PCA) of each user in memory, indexed by version.
+    
+    Models are never modified in place: an update stores a new version (see StatePredictor.incre_train), so a
+    request that is still predicting with an older version is not affected. New versions are written to FILEPATH
+    by a background thread, at most once every `checkpoint_interval` seconds for each user, and the disk is only read
+    when a version is not in memory, e.g., after the worker restarts or when the version was trained by another worker.
+    `latest()` also loads the newest version on disk, when it is newer than those in memory.
+
+    The folder of a user is shared by all workers and replicas, so a worker only removes the versions it has written
+    itself, once they are `retention` seconds old.
+    """
+
+    def __init__(self, keep=2, checkpoint_interval=0, retention=60.0, refresh_interval=1.0):
+        # username -> {ver: (clf, pca)}
+        self.models = {}
+        # username -> generation, increased on reset so that pending writes of old models are dropped
+        self.generations = {}
+        # number of versions kept in memory for each user
+        self.keep = keep
+        self.checkpoint_interval = checkpoint_interval
+        self.retention = retention
+        self.refresh_interval = refresh_interval
+        # username -> {ver: time written} of the versions on disk written by this worker
+        self.written = {}
+        # username -> time the disk was last checked for a newer version
+        self.refreshed = {}
+        self.lock = Lock()
+        self.pending = queue.Queue()
+        self.writer = None
+
+    def get(self, username, model_dir, ver):
+        """
+        Returns the (clf, pca) of a version, loaded from disk if it is not in memory, or None if it does not exist.
+        """
+        with self.lock:
+            models = self.models.get(username, {})
+            if ver in models:
+                return models[ver]
+        model_path = os.path.join(model_dir, 'model_pca.{}.joblib'.format(ver))
+        pca_path = os.path.join(model_dir, 'pca.{}.joblib'.format(ver))
+        if not os.path.exists(model_path) or not os.path.exists(pca_path):
+            return None
+        try:
+            model = run_native(lambda: (load(model_path), load(pca_path)))
+        except (OSError, EOFError):
+            # removed or being written by another worker
+            return None
+        self._store(username, ver, model)
+        return model
+
+    def latest(self, username, model_dir=None):
+        """
+        Returns (ver, (clf, pca)) of the latest version, or None.
+        With model_dir, a newer version on disk, e.g., written by another worker, is loaded. The disk is checked at
+        most once every `refresh_interval` seconds for each user.
+        """
+        now = time.time()
+        with self.lock:
+            models = self.models.get(username, {})
+            ver = max(models) if len(models) > 0 else None
+            refresh = model_dir is not None and now - self.refreshed.get(username, 0) >= self.refresh_interval
+            if refresh:
+                self.refreshed[username] = now
+        if refresh:
+            disk_versions = self._disk_versions(model_dir)
+            if len(disk_versions) > 0 and (ver is None or disk_versions[-1] > ver):
+                model = self.get(username, model_dir, disk_versions[-1])
+                if model is not None:
+                    return disk_versions[-1], model
+        if ver is None:
+            return None
+        with self.lock:
+            # may have been reset or replaced meanwhile
+            model = self.models.get(username, {}).get(ver)
+        return None if model is None else (ver, model)
+
+    def put(self, username, model_dir, ver, clf, pca):
+        """ Stores a new version in memory and queues it to be written to disk. """
+        self._store(username, ver, (clf, pca))
+        with self.lock:
+            generation = self.generations.get(username, 0)
+            if self.writer is None:
+                # started lazily, so that each gunicorn worker has its own writer
+                self.writer = Thread(target=self._write_loop, daemon=True)
+                self.writer.start()
+        self.pending.put((username, generation, model_dir, ver))
+
+    def generation(self, username):
+        """ Returns the generation of a user, which changes on every reset. """
+        with self.lock:
+            return self.generations.get(username, 0)
+
+    def reset(self, username):
+        """ Forgets the models of a user. Models that are not written yet are dropped. """
+        with self.lock:
+            self.models.pop(username, None)
+            self.written.pop(username, None)
+            self.refreshed.pop(username, None)
+            self.generations[username] = self.generations.get(username, 0) + 1
+
+    def _store(self, username, ver, model):
+        with self.lock:
+            models = self.models.setdefault(username, {})
+            models[ver] = model
+            for old_ver in sorted(models)[:-self.keep]:
+                del models[old_ver]
+
+    def _write_loop(self):
+        # username -> (generation, model_dir, ver) of the latest version not written yet
+        latest = {}
+        # username -> time of the last write
+        last_written = {}
+        while True:
+            timeout = None
+            if len(latest) > 0:
+                due = min(last_written.get(username, 0) + self.checkpoint_interval for username in latest)
+                timeout = max(due - time.time(), 0)
+            try:
+                item = self.pending.get(timeout=timeout)
+                # skip versions that already have a newer one waiting
+                latest[item[0]] = item[1:]
+                while not self.pending.empty():
+                    item = self.pending.get()
+                    latest[item[0]] = item[1:]
+            except queue.Empty:
+                pass
+
+            now = time.time()
+            for username in [u for u in latest if last_written.get(u, 0) + self.checkpoint_interval <= now]:
+                generation, model_dir, ver = latest.pop(username)
+                last_written[username] = now
+                try:
+                    self._write(username, generation, model_dir, ver)
+                except Exception as e:
+                    logging.getLogger('gunicorn.error').error('failed to save model {} of {}: {}'.format(
+                        ver, username, e))
+
+    def _write(self, username, generation, model_dir, ver):
+        with self.lock:
+            if self.generations.get(username, 0) != generation:
+                return
+            model = self.models.get(username, {}).get(ver)
+        if model is None:
+            return
+        run_native(self._dump, model_dir, ver, *model)
+
+        now = time.time()
+        with self.lock:
+            if self.generations.get(username, 0) != generation:
+                return
+            written = self.written.setdefault(username, {})
+            written[ver] = now
+            # versions written by other workers are left to them
+            expired = [old_ver for old_ver, t in written.items() if old_ver < ver and now - t >= self.retention]
+            for old_ver in expired:
+                del written[old_ver]
+        if len(expired) > 0:
+            run_native(self._remove, model_dir, expired)
+
+    @staticmethod
+    def _dump(model_dir, ver, clf, pca):
+        for name, obj in [('model_pca', clf), ('pca', pca)]:
+            path = os.path.join(model_dir, '{}.{}.joblib'.format(name, ver))
+            dump(obj, path + '.tmp')
+            os.replace(path + '.tmp', path)
+
+    @staticmethod
+    def _remove(model_dir, versions):
+        for ver in versions:
+            for name in ['model_pca', 'pca']:
+                try:
+                    os.remove(os.path.join(model_dir, '{}.{}.joblib'.format(name, ver)))
+                except FileNotFoundError:
+                    pass
+
+    @staticmethod
+    def _disk_versions(model_dir):
+        """ Returns the sorted versions that have both the classifier and the PCA in a folder. """
+        if not os.path.exists(model_dir):
+            return []
+        files = {}
+        for f in os.listdir(model_dir):
+            m = re.search(r"^(model_pca|pca)\.(\d+)\.joblib$", f)
+            if m is not None:
+                files.setdefault(int(m.group(2)), set()).add(m.group(1))
+        return sorted(ver for ver, names in files.items() if len(names) == 2)
+
+
+modelRegistry = ModelRegistry(checkpoint_interval=CHECKPOINT_INTERVAL, retention=MODEL_RETENTION,
+                              refresh_interval=MODEL_REFRESH_INTERVAL)
+
+
+class IncrementalTrainer:
+    """
+    Collects the labeled frames of each user and applies them to the user's model in mini-batches, in a background
+    thread, so that a request only has to queue its frame.
+    
+    A batch is applied when a user has `batch_size` frames, or when the oldest frame has waited `max_delay` seconds.
+    The resulting model is stored in the registry as the version of the last frame of the batch.
+    """
+
+    def __init__(self, registry, batch_size=16, max_delay=2.0):
+        self.registry = registry
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        # username -> (model_dir, list of (img, label, ver), time of the first frame)
+        self.buffers = {}
+        self.cond = Condition()
+        self.worker = None
+
+    def add(self, username, model_dir, img, label, ver):
+        with self.cond:
+            if self.worker is None:
+                # started lazily, so that each gunicorn worker has its own thread
+                self.worker = Thread(target=self._train_loop, daemon=True)
+                self.worker.start()
+            if username not in self.buffers:
+                self.buffers[username] = (model_dir, [], time.time())
+            frames = self.buffers[username][1]
+            frames.append((img, label, ver))
+            if len(frames) >= self.batch_size:
+                self.cond.notify()
+
+    def reset(self, username):
+        """ Drops the frames of a user that are not applied yet. """
+        with self.cond:
+            self.buffers.pop(username, None)
+
+    def _next_batch(self):
+        """ Waits until a batch is ready and returns (username, model_dir, frames). """
+        with self.cond:
+            while True:
+                now = time.time()
+                timeout = None
+                for username, (model_dir, frames, first_time) in self.buffers.items():
+                    if len(frames) >= self.batch_size or now - first_time >= self.max_delay:
+                        del self.buffers[username]
+                        return username, model_dir, frames
+                    due = first_time + self.max_delay - now
+                    timeout = due if timeout is None else min(timeout, due)
+                self.cond.wait(timeout)
+
+    def _train_loop(self):
+        while True:
+            username, model_dir, frames = self._next_batch()
+            try:
+                self.train_batch(username, model_dir, frames)
+            except Exception as e:
+                logging.getLogger('gunicorn.error').error('incremental training of {} failed: {}'.format(username, e))
+
+    def train_batch(self, username, model_dir, frames):
+        first_ver = min(ver for _, _, ver in frames)
+        last_ver = max(ver for _, _, ver in frames)
+        # the model the frames were labeled against, or the latest one if it is gone
+        model = self.registry.get(username, model_dir, first_ver - 1)
+        if model is None:
+            latest = self.registry.latest(username, model_dir)
+            if latest is None:
+                return
+            _, model = latest
+        clf, pca = model
+        clf = run_native(self._fit_batch, clf, pca, frames)
+        self.registry.put(username, model_dir, last_ver, clf, pca)
+        logging.getLogger('gunicorn.error').info('model updated with {} frame(s): {} -> {}'.format(
+            len(frames), first_ver - 1, last_ver))
+
+    @staticmethod
+    def _fit_batch(clf, pca, frames):
+        # train on a copy, so that requests predicting with the previous version are not affected
+        gt_input = pca.transform(np.stack([np.reshape(img, (-1)) for img, _, _ in frames]))
+        gt_label = np.array([str(label) for _, label, _ in frames])
+        return copy.deepcopy(clf).partial_fit(gt_input, gt_label)
+
+
+incrementalTrainer = IncrementalTrainer(modelRegistry, batch_size=BATCH_SIZE, max_delay=MAX_DELAY)
+
+
+class TrainingSamples:
+    """
+    Collects the crops of each user during calibration in a preallocated uint8 array, instead of JPEG files.
+    
+    Frames of a user are spread over gunicorn workers (and replicas), so each worker writes its own samples to
+    `samples.<hostname>.<pid>.npz` in the user's folder, in background, and `collect()` merges the samples
+    written by the others. A frame (label, frameId) received by several workers, e.g., in an earlier calibration
+    that the worker was not reset for, is taken from the latest one.
+    """
+
+    def __init__(self, capacity=800, shape=(50, 100), snapshot_delay=0.5):
+        self.capacity = capacity
+        self.shape = shape
+        self.snapshot_delay = snapshot_delay
+        # username -> {'images', 'labels', 'frame_ids', 'times', 'count', 'index': (label, frameId) -> row}
+        self.users = {}
+        # username -> generation, increased on reset so that pending snapshots are dropped
+        self.generations = {}
+        self.cond = Condition()
+        # username -> (model_dir, time of the last added sample)
+        self.pending = {}
+        self.writer = None
+        self.snapshot_name = 'samples.{}.{}.npz'.format(os.uname()[1], os.getpid())
+
+    def add(self, username, model_dir, img, label, frameId):
+        """ Adds a crop. A frame that is received again replaces the previous one. """
+        with self.cond:
+            if self.writer is None:
+                # started lazily, so that each gunicorn worker has its own writer
+                self.writer = Thread(target=self._snapshot_loop, daemon=True)
+                self.writer.start()
+                self.snapshot_name = 'samples.{}.{}.npz'.format(os.uname()[1], os.getpid())
+            user = self.users.get(username)
+            if user is None:
+                user = {
+                    'images': np.empty((self.capacity,) + self.shape, dtype=np.uint8),
+                    'labels': np.empty(self.capacity, dtype=np.int8),
+                    'frame_ids': np.empty(self.capacity, dtype=np.int32),
+                    'times': np.empty(self.capacity, dtype=np.float64),
+                    'count': 0,
+                    'index': {},
+                }
+                self.users[username] = user
+            row = user['index'].get((label, frameId))
+            if row is None:
+                row = user['count']
+                if row == user['images'].shape[0]:
+                    for key in ['images', 'labels', 'frame_ids', 'times']:
+                        user[key] = np.concatenate([user[key], np.empty_like(user[key])])
+                user['index'][(label, frameId)] = row
+                user['count'] += 1
+            user['images'][row] = img
+            user['labels'][row] = label
+            user['frame_ids'][row] = frameId
+            user['times'][row] = time.time()
+            self.pending[username] = (model_dir, user['times'][row])
+            self.cond.notify()
+
+    def collect(self, username, model_dir):
+        """
+        Returns the samples of a user collected by this worker and the snapshots of the others.
+        :return: (inputs, labels), inputs is an array of flattened crops, labels is an array of str labels.
+        """
+        columns = ['images', 'labels', 'frame_ids', 'times']
+        parts = []
+        with self.cond:
+            user = self.users.get(username)
+            if user is not None:
+                parts.append({key: user[key][:user['count']].copy() for key in columns})
+        for f in sorted(os.listdir(model_dir)) if os.path.exists(model_dir) else []:
+            if not re.search(r"^samples\..+\.npz$", f) or f == self.snapshot_name:
+                continue
+            try:
+                with np.load(os.path.join(model_dir, f)) as snapshot:
+                    parts.append({key: snapshot[key] for key in columns})
+            except (OSError, ValueError, KeyError):
+                # being replaced, or removed by a reset
+                continue
+        if len(parts) == 0:
+            return np.empty((0, self.shape[0] * self.shape[1]), dtype=np.uint8), np.empty(0, dtype=str)
+
+        merged = {key: np.concatenate([part[key] for part in parts]) for key in columns}
+        # the latest sample of each (label, frameId)
+        order = np.argsort(-merged['times'], kind='stable')
+        keys = merged['labels'][order].astype(np.int64) * (1 << 32) + merged['frame_ids'][order]
+        _, first = np.unique(keys, return_index=True)
+        rows = np.sort(order[first])
+        inputs = merged['images'][rows].reshape(-1, self.shape[0] * self.shape[1])
+        return inputs, merged['labels'][rows].astype(str)
+
+    def reset(self, username):
+        """ Forgets the samples of a user. Snapshots that are not written yet are dropped. """
+        with self.cond:
+            self.users.pop(username, None)
+            self.pending.pop(username, None)
+            self.generations[username] = self.generations.get(username, 0) + 1
+
+    def _snapshot_loop(self):
+        while True:
+            with self.cond:
+                while True:
+                    now = time.time()
+                    ready = [u for u, (_, t) in self.pending.items() if now - t >= self.snapshot_delay]
+                    if len(ready) > 0:
+                        break
+                    timeout = None
+                    if len(self.pending) > 0:
+                        timeout = min(t for _, t in self.pending.values()) + self.snapshot_delay - now
+                    self.cond.wait(timeout)
+                snapshots = []
+                for username in ready:
+                    model_dir, _ = self.pending.pop(username)
+                    user = self.users[username]
+                    count = user['count']
+                    snapshots.append((username, self.generations.get(username, 0), model_dir,
+                                      {key: user[key][:count].copy()
+                                       for key in ['images', 'labels', 'frame_ids', 'times']}))
+            for username, generation, model_dir, columns in snapshots:
+                path = os.path.join(model_dir, self.snapshot_name)
+                try:
+                    run_native(self._save, path + '.tmp', columns)
+                    with self.cond:
+                        if self.generations.get(username, 0) == generation:
+                            os.replace(path + '.tmp', path)
+                        else:
+                            os.remove(path + '.tmp')
+                except Exception as e:
+                    logging.getLogger('gunicorn.error').error('failed to save samples of {}: {}'.format(
+                        username, e))
+
+    @staticmethod
+    def _save(path, columns):
+        with open(path, 'wb') as f:
+            np.savez(f, **columns)
+
+
+trainingSamples = TrainingSamples(capacity=2 * TOTAL, snapshot_delay=SNAPSHOT_DELAY)
+
+
+class TrainingJobs:
+    """
+    Trains the initial model of each user in the process pool of training_pool.py, so that requests are not blocked.
+    
+    A user has at most one job at a time. The status of a job is 'queued', 'running', 'done' or 'failed'.
+    When a job is done, the model is stored in the registry as version 0, unless the user has been reset since
+    the job was submitted. This happens when the status of the job is checked, which every request of the user does
+    while it is training, not in a callback: callbacks run in the thread managing the pool, which is not a greenlet.
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+        # username -> (future, generation of the user when submitted, model_dir, whether the result is handled)
+        self.jobs = {}
+        self.lock = Lock()
+
+    def submit(self, username, model_dir, samples):
+        """
+        Submits a training job for a user, unless one is queued or running. Returns the status of the job.
+        :param samples: A TrainingSamples that the crops of the user are collected from.
+        """
+        with self.lock:
+            job = self.jobs.get(username)
+            if job is not None and not job[0].done():
+                return self._status(job[0])
+            generation = self.registry.generation(username)
+            inputs, labels = samples.collect(username, model_dir)
+            # created by the post_fork hook of gunicorn, see training_pool.py
+            future = training_pool.get().submit(training_pool.fit_model, inputs, labels)
+            self.jobs[username] = (future, generation, model_dir, False)
+        return self.status(username)
+
+    def status(self, username):
+        """
+        Returns the status of the latest job of a user, or None if the user has no job.
+        The model of a job that is done is stored in the registry by the first call.
+        """
+        with self.lock:
+            job = self.jobs.get(username)
+            if job is None:
+                return None
+            future, generation, model_dir, handled = job
+            done = future.done()
+            if done and not handled:
+                self.jobs[username] = (future, generation, model_dir, True)
+        if done and not handled:
+            self._on_done(username, model_dir, generation, future)
+        return self._status(future)
+
+    def is_training(self, username):
+        return self.status(username) in ('queued', 'running')
+
+    def cancel(self, username):
+        """ Forgets the job of a user. A job that is already running finishes, but its model is dropped. """
+        with self.lock:
+            job = self.jobs.pop(username, None)
+        if job is not None:
+            job[0].cancel()
+
+    @staticmethod
+    def _status(future):
+        if future.done():
+            return 'failed' if future.cancelled() or future.exception() is not None else 'done'
+        return 'running' if future.running() else 'queued'
+
+    def _on_done(self, username, model_dir, generation, future):
+        logger = logging.getLogger('gunicorn.error')
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            logger.error('training of {} failed: {}'.format(username, future.exception()))
+            return
+        clf, pca, messages = future.result()
+        for message in messages:
+            logger.info(message)
+        if self.registry.generation(username) != generation:
+            logger.info('model of {} is dropped, the user was reset during training'.format(username))
+            return
+        self.registry.put(username, model_dir, 0, clf, pca)
+
+
+trainingJobs = TrainingJobs(modelRegistry)
+
+
+class LandmarkService:
+    """
+    Detects face landmarks for all users with a bounded pool of shared FaceMesh instances.
+    
+    Frames are queued with `submit()` and results are returned through futures. Each instance runs in its own
+    thread, and takes the frames that arrive within `batch_window` seconds (at most `max_batch`) at a time. The
+    future of a frame is resolved as soon as its landmarks are detected, not at the end of the batch.
+
+    Frames of different users are interleaved, so the instances run in static image mode: MediaPipe's tracking would
+    look for a user's face at the landmarks of whichever user the instance processed last. The face of each user is
+    tracked by its own FaceTracker instead, which sends a crop around the face of the user's previous frame.
+    """
+
+    def __init__(self, pool_size=2, max_batch=8, batch_window=0.005):
+        self.pool_size = pool_size
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self.pending = queue.Queue()
+        self.workers = []
+        self.lock = Lock()
+
+    def submit(self, img):
+        """
+        Queues an RGB image.
+        :return: A future of the landmarks of the first face, or None if no face is found.
+        """
+        with self.lock:
+            if len(self.workers) == 0:
+                # started lazily, so that each gunicorn worker has its own instances
+                for _ in range(self.pool_size):
+                    worker = Thread(target=self._detect_loop, daemon=True)
+                    worker.start()
+                    self.workers.append(worker)
+        future = Future()
+        self.pending.put((img, future))
+        return future
+
+    def process(self, img):
+        """ Returns the landmarks of the first face in an RGB image, or None. Blocks until detected. """
+        return self.submit(img).result()
+
+    def _next_batch(self):
+        batch = [self.pending.get()]
+        deadline = time.time() + self.batch_window
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.pending.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _detect_loop(self):
+        facemesh = mp.solutions.face_mesh.FaceMesh(
+            static_image_mode=True,
+            max_num_faces=1,
+            min_detection_confidence=0.5)
+        while True:
+            for img, future in self._next_batch():
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    img.flags.writeable = False
+                    results = run_native(facemesh.process, img)
+                    img.flags.writeable = True
+                    future.set_result(results.multi_face_landmarks[0] if results.multi_face_landmarks else None)
+                except Exception as e:
+                    future.set_exception(e)
+
+
+landmarkService = LandmarkService(pool_size=FACEMESH_POOL_SIZE, max_batch=FACEMESH_MAX_BATCH,
+                                  batch_window=FACEMESH_BATCH_WINDOW)
+
+
 class StatePredictor:
 
     def __init__(self, usrname, logger):
         global FILEPATH
-        self.facemesh = mp.solutions.face_mesh.FaceMesh(
-            max_num_faces=1,
-            min_detection_confidence=0.5)
         self.inputs = []
         self.labels = []
         self.clf = None
@@ -158,29 +715,28 @@ class StatePredictor:
         self.dir = os.path.join(FILEPATH, str(self.username), 'face')
         self.trained = False
         self.model_ver = 0
+        # buffers of extractEyes()
+        self.rgb = None
+        self.resized = None
+        self.frame_lock = Lock()
+        self.tracker = FaceTracker(landmarkService.process, margin=TRACK_MARGIN)
         # Same logger as gunicorn
         self.logger = logger
         # currently we make sure old images and models are removed before each lecture
         if not os.path.exists(self.dir):
             os.makedirs(self.dir)
         else:
-            modelfiles = [f for f in os.listdir(self.dir) if '.joblib' in f]
-            # find pca:
-            pca_suspects = [f for f in modelfiles if re.search(
-                "^pca.\d+.joblib", f) is not None]
-            # find model_pca:
-            model_suspects = [f for f in modelfiles if re.search(
-                "^model_pca.\d+.joblib", f) is not None]
-
-            if len(pca_suspects) == 1 and len(model_suspects) == 1:
-                pca_path = pca_suspects[0]
-                model_path = model_suspects[0]
-                self.clf = load(os.path.join(self.dir, model_path))
-                self.pca = load(os.path.join(self.dir, pca_path))
-                self.model_ver = int(pca_path.split('.')[1])
+            # the latest version written by any worker
+            latest = modelRegistry.latest(self.username, self.dir)
+            if latest is not None:
+                self.model_ver, (self.clf, self.pca) = latest
                 self.trained = True
     
     def model_reset(self):
+        modelRegistry.reset(self.username)
+        incrementalTrainer.reset(self.username)
+        trainingJobs.cancel(self.username)
+        trainingSamples.reset(self.username)
         shutil.rmtree(self.dir)
         os.makedirs(self.dir)
         self.trained = False
@@ -189,60 +745,38 @@ class StatePredictor:
         self.clf = None
 
     def incre_train(self, img, label, ver):
-        old_model_path = 'model_pca.{}.joblib'.format(ver - 1)
-        old_pca_path = 'pca.{}.joblib'.format(ver - 1)
-        if not self.trained:
-            # load latest model
-            # if the model is up-to-date, ver should be exactly model_ver + 1,
-            # otherwise, we should load latest model (ver - 1) before incremental training.
-            # Also remove old models before updating to new ones.
-            if not os.path.exists(os.path.join(self.dir, old_model_path)) or \
-                not os.path.exists(os.path.join(self.dir, old_pca_path)):
-                return
-            self.trained = True
-
-        if ver > self.model_ver + 1 or self.clf is None:
-            self.clf = load(os.path.join(self.dir, old_model_path))
-            self.pca = load(os.path.join(self.dir, old_pca_path))
-            
-        os.remove(os.path.join(self.dir, old_model_path))
-        os.remove(os.path.join(self.dir, old_pca_path))
-
-        # train one step
-        gt_input = np.reshape(img, (1,-1))
-        gt_input = self.pca.transform(gt_input)
-        gt_label = np.array([str(label)])
-        self.clf = self.clf.partial_fit(gt_input, gt_label)
-
-        self.logger.info('model updated: {} -> {}'.format(self.model_ver, ver))
-
-        self.model_ver = ver
-
-        dump(self.clf, os.path.join(
-            self.dir, 'model_pca.{}.joblib'.format(self.model_ver)))
-        dump(self.pca, os.path.join(self.dir, 'pca.{}.joblib'.format(self.model_ver)))
-
+        # applied in a mini-batch in background, see IncrementalTrainer
+        incrementalTrainer.add(self.username, self.dir, img, label, ver)
+
+
+    def extractEyes(self, img):
+        """
+        Returns the grayscale 100x50 eye region of a BGR frame, or None if no face is found.
+        The frame is converted to RGB once, for both FaceMesh and the crop, in buffers reused across frames.
+        Landmarks are detected around the face of the previous frame when possible, see FaceTracker.
+        """
+        with self.frame_lock:
+            if self.rgb is None or self.rgb.shape != img.shape:
+                self.rgb = np.empty_like(img)
+            rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst=self.rgb)
+            face_landmarks = self.tracker.track(rgb)
+            if face_landmarks is None:
+                return None
+            # self.logger.debug(matrix)
+            cropped = getCrop(rgb, face_landmarks)
+            self.resized = cv2.resize(cropped, (100, 50), dst=self.resized)
+            # a new array, it is kept by the training samples
+            return cv2.cvtColor(self.resized, cv2.COLOR_RGB2GRAY)
 
     def addData(self, img, label, frameId, incre=False, ver=0):
         global TOTAL, metricPool
         # if self.trained and not incre:
         #     self.logger.info('Ignore...')
         # Save collected image.
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        img.flags.writeable = False
-        results = self.facemesh.process(img)
-        img.flags.writeable = True
-        img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
-        if results.multi_face_landmarks:
-            face_landmarks = results.multi_face_landmarks[0]
-            # self.logger.debug(matrix)
-            cropped = getCrop(img, face_landmarks)
-            img = cv2.cvtColor(cv2.resize(
-                cropped, (100, 50)), cv2.COLOR_BGR2GRAY)
+        img = self.extractEyes(img)
+        if img is not None:
             if not incre:
-                cv2.imwrite(os.path.join(
-                    self.dir, '{}_{}.jpg'.format(label, frameId)
-                ), img)
+                trainingSamples.add(self.username, self.dir, img, label, frameId)
             else:
                 self.incre_train(img, label, ver)
 
@@ -263,77 +797,33 @@ class StatePredictor:
                 metricPool[self.username].c_file_last = time.time()
         
     
-    def train(self):
-        inputs = []
-        labels = []
-        img_list = [f for f in os.listdir(self.dir) if '.jpg' in f]
-        for f in img_list:
-            label, _ = f.split('_')
-            img = cv2.imread(os.path.join(self.dir, f), cv2.IMREAD_GRAYSCALE)
-            inputs.append(np.reshape(img, (-1)))
-            labels.append(label)
-
-        inputs = np.array(inputs)
-        labels = np.array(labels)
-
-        t0 = time.time()
-        n_component = 150
-        self.pca = PCA(n_component, svd_solver='auto',
-                whiten=True).fit(inputs)
-        self.logger.info('PCA fit done in {}s'.format(time.time() - t0))
-
-        t0 = time.time()
-        X_train_pca = self.pca.transform(inputs)
-        self.logger.info('PCA transform done in {}s'.format(
-            time.time() - t0))
-
-        t0 = time.time()
-        # self.clf = SVC()
-        self.clf = SGDClassifier()
-        self.logger.debug(X_train_pca.shape)
-        self.clf = self.clf.fit(X_train_pca, labels)
-        self.logger.info('SGDClassifier train done in {}s'.format(time.time() - t0))
-
-        dump(self.clf, os.path.join(self.dir, 'model_pca.0.joblib'))
-        dump(self.pca, os.path.join(self.dir, 'pca.0.joblib'))
-
-        self.trained = True
-    
     def threaded_train(self):
-        Thread(target=self.train(), args=(self, )).start()
-        self.logger.info('Threaded Training Started!!!')
-        return 
+        # does nothing if a job of the user is already queued or running
+        status = trainingJobs.submit(self.username, self.dir, trainingSamples)
+        self.logger.info('Training of {}: {}'.format(self.username, status))
+        return status
 
     def confusionDetection(self, img, ver):
-        model_path = 'model_pca.{}.joblib'.format(ver)
-        pca_path = 'pca.{}.joblib'.format(ver)
-        if not self.trained:
-            # return 'training'
-            if not os.path.exists(os.path.join(self.dir, model_path)) or not \
-                os.path.exists(os.path.join(self.dir, pca_path)):
+        if trainingJobs.is_training(self.username):
+            return 'training'
+        model = modelRegistry.get(self.username, self.dir, ver)
+        if model is None:
+            # the version may not be written yet by the worker that trained it, use the latest one we have
+            latest = modelRegistry.latest(self.username, self.dir)
+            if latest is None:
                 return 'training'
-            self.trained = True
-
-        if self.clf is None or self.model_ver != ver:
-            self.clf = load(os.path.join(self.dir, model_path))
-            self.pca = load(os.path.join(self.dir, pca_path))
-            self.model_ver = ver
+            ver, model = latest
+        self.trained = True
+        # local references, the registry never modifies a stored model
+        clf, pca = model
+        self.model_ver = ver
 
         tag = ['Neutral', 'Confused']
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        img.flags.writeable = False
-        results = self.facemesh.process(img)
-        img.flags.writeable = True
-        img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
-        if results.multi_face_landmarks:
-            face_landmarks = results.multi_face_landmarks[0]
-            # self.logger.debug(matrix)
-            cropped = getCrop(img, face_landmarks)
-            img = cv2.cvtColor(cv2.resize(
-                cropped, (100, 50)), cv2.COLOR_BGR2GRAY)
+        img = self.extractEyes(img)
+        if img is not None:
             feature = np.reshape(img, (1, -1))
-            reduced_feature = self.pca.transform(feature)
-            pred = self.clf.predict(reduced_feature)
+            reduced_feature = pca.transform(feature)
+            pred = clf.predict(reduced_feature)
             self.logger.debug(pred)
             res = tag[int(pred[0])]
             return res
@@ -399,10 +889,11 @@ def confusion_detection():
                 else:
                     metricPool[username].nc_req_last = time.time()
         elif stage == 1:
-            if not modelPool[username].trained:
+            result = modelPool[username].confusionDetection(img, ver)
+            # no model yet, and no job has been submitted (e.g., the last frame went to another worker)
+            if result == 'training' and trainingJobs.status(username) in (None, 'failed'):
                 modelPool[username].threaded_train()
                 app.logger.info("Training is triggered at inference stage.")
-            result = modelPool[username].confusionDetection(img, ver)
         else:
             modelPool[username].addData(
                 img, data['label'], data['frameId'], incre=True, ver=ver)
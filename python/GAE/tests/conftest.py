@@ -0,0 +1,6 @@
+import os
+import sys
+
+GAE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+if GAE_DIR not in sys.path:
+    sys.path.insert(0, GAE_DIR)
@@ -0,0 +1,85 @@
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+
+from benchmark_crop import getCropLoop, make_landmarks
+from face_crop import FaceTracker, getCrop
+
+
+def test_get_crop_matches_the_per_landmark_loop():
+    rng = np.random.default_rng(0)
+    for _ in range(20):
+        img = rng.integers(0, 256, (480, 640, 3), dtype=np.uint8)
+        landmarks = make_landmarks(rng)
+        expected, actual = getCropLoop(img, landmarks), getCrop(img, landmarks)
+        assert expected.shape == actual.shape
+        # pixels may differ by rounding of the interpolation
+        assert np.abs(expected.astype(int) - actual.astype(int)).max() <= 2
+
+
+def test_get_crop_does_not_depend_on_the_frame_size():
+    rng = np.random.default_rng(1)
+    landmarks = make_landmarks(rng)
+    # a smooth frame, so that it looks the same at half resolution
+    full = cv2.resize(rng.integers(0, 256, (12, 16, 3), dtype=np.uint8), (640, 480), interpolation=cv2.INTER_CUBIC)
+    for size in ((320, 240), (320, 180)):
+        reduced = cv2.resize(full, size, interpolation=cv2.INTER_AREA)
+        expected, actual = getCrop(full, landmarks), getCrop(reduced, landmarks)
+        # the landmarks used for the alignment are rounded to pixels, which are twice as large in the reduced frame
+        assert np.abs(np.subtract(expected.shape, actual.shape)).max() <= 4
+        expected, actual = cv2.resize(expected, (100, 50)), cv2.resize(actual, (100, 50))
+        assert np.abs(expected.astype(int) - actual.astype(int)).mean() < 8
+
+
+class FakeDetector:
+    """Detects the white rectangle in an image: its corners are the landmarks, normalized to the image."""
+
+    def __init__(self):
+        self.shapes = []
+
+    def __call__(self, rgb):
+        self.shapes.append(rgb.shape)
+        ys, xs = np.nonzero(rgb[:, :, 0])
+        if len(xs) == 0:
+            return None
+        h, w = rgb.shape[:2]
+        corners = [(xs.min(), ys.min()), (xs.max() + 1, ys.max() + 1)]
+        return SimpleNamespace(landmark=[SimpleNamespace(x=x / w, y=y / h) for x, y in corners])
+
+
+def _frame(left, top, right, bottom):
+    rgb = np.zeros((480, 640, 3), dtype=np.uint8)
+    rgb[top:bottom, left:right] = 255
+    return rgb
+
+
+def _points(landmarks):
+    return [(round(lm.x * 640, 6), round(lm.y * 480, 6)) for lm in landmarks.landmark]
+
+
+def test_face_tracker_remaps_landmarks_to_the_frame():
+    detect = FakeDetector()
+    tracker = FaceTracker(detect, margin=0.25)
+
+    assert _points(tracker.track(_frame(200, 100, 300, 200))) == [(200, 100), (300, 200)]
+    assert detect.shapes[-1] == (480, 640, 3)
+    assert tracker.box == (175, 75, 325, 225)
+
+    # detected in the region around the previous face, and returned in the coordinates of the frame
+    assert _points(tracker.track(_frame(210, 110, 310, 200))) == [(210, 110), (310, 200)]
+    assert detect.shapes[-1] == (150, 150, 3)
+    assert tracker.box == (185, 87, 335, 223)
+
+
+def test_face_tracker_falls_back_to_the_whole_frame():
+    detect = FakeDetector()
+    tracker = FaceTracker(detect)
+    tracker.track(_frame(200, 100, 300, 200))
+
+    # the face reaches the border of the region: detected again in the whole frame
+    assert _points(tracker.track(_frame(400, 100, 500, 200))) == [(400, 100), (500, 200)]
+    assert [shape[:2] for shape in detect.shapes[-2:]] == [(150, 150), (480, 640)]
+
+    assert tracker.track(np.zeros((480, 640, 3), dtype=np.uint8)) is None
+    assert tracker.box is None
@@ -0,0 +1,71 @@
+"""Trains the initial models of the users in a process pool, see TrainingJobs in main.py.
+
+gunicorn runs main.py with the gevent worker, which monkey-patches the standard library when the worker starts, and
+forking from a patched worker is unsafe. `start()` is called by the post_fork hook in gunicorn.config.py, before the
+worker is patched and before main.py is loaded: the pool starts a fork server, which forks the training processes,
+and the thread managing the pool is a native thread.
+"""
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from sklearn.decomposition import PCA
+from sklearn.linear_model import SGDClassifier
+
+# Number of processes training the initial models, in each gunicorn worker.
+TRAIN_WORKERS = 2
+
+_executor = None
+
+
+def fit_model(inputs, labels):
+    """
+    Trains the initial model of a user from the collected crops. Runs in a training process.
+    :param inputs: Flattened crops, see TrainingSamples.collect().
+    :param labels: The labels of the crops.
+    :return: (clf, pca, list of log messages)
+    """
+    messages = []
+
+    t0 = time.time()
+    n_component = 150
+    pca = PCA(n_component, svd_solver='auto',
+            whiten=True).fit(inputs)
+    messages.append('PCA fit done in {}s'.format(time.time() - t0))
+
+    t0 = time.time()
+    X_train_pca = pca.transform(inputs)
+    messages.append('PCA transform done in {}s'.format(
+        time.time() - t0))
+
+    t0 = time.time()
+    # clf = SVC()
+    clf = SGDClassifier()
+    clf = clf.fit(X_train_pca, labels)
+    messages.append('SGDClassifier train done in {}s, {} samples'.format(time.time() - t0, X_train_pca.shape[0]))
+    return clf, pca, messages
+
+
+def _ready():
+    return True
+
+
+def start(max_workers=TRAIN_WORKERS):
+    """
+    Creates the pool of this process, unless it exists, and waits until its processes are running.
+    :param max_workers: The number of training processes.
+    :return: The ProcessPoolExecutor.
+    """
+    global _executor
+    if _executor is None:
+        executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('forkserver'))
+        # the processes, and the thread managing them, are started by the first jobs
+        for future in [executor.submit(_ready) for _ in range(max_workers)]:
+            future.result()
+        _executor = executor
+    return _executor
+
+
+def get():
+    """ Returns the pool of this process. It is created now if `start()` was not called, e.g., when run with Flask. """
+    return start()
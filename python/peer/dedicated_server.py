@@ -16,10 +16,13 @@ from timeloop import Timeloop
 import pandas as pd
 
 from shared_info_manager import config_client
-from utilities.csv_logger import CSVLogger
+from utilities.csv_logger_pool import CSVLoggerPool
+from utilities.record_spool import RecordSpool
 from utilities.dataformat import MockLock, TestInfo
 from utilities.global_settings import FILEPATH, CSVLOGPATH, DEDICATED_APP_LOGGER_CONFIG, \
-    MANAGER_HOST, MANAGER_PORT, SECRET, DEDICATED_SERVER_PORT, \
+    MANAGER_HOST, MANAGER_PORT, SECRET, DEDICATED_SERVER_PORT, N_LOGGER_THREAD, \
+    CSVLOG_PARTITIONED, CSVLOG_MAX_BYTES, \
+    SPOOLPATH, SPOOL_FSYNC_INTERVAL, \
     GROUP_THRESHOLDING, \
     group_id_to_setting
 
@@ -28,7 +31,10 @@ dictConfig(DEDICATED_APP_LOGGER_CONFIG)
 
 tl = Timeloop()
 app = Flask(__name__)
-csv_logger = CSVLogger(CSVLOGPATH, app.logger)
+csv_logger = CSVLoggerPool(CSVLOGPATH, app.logger, n_shards=N_LOGGER_THREAD,
+                           partitioned=CSVLOG_PARTITIONED, max_bytes=CSVLOG_MAX_BYTES)
+spool = None  # opened in main()
+checkpoint_lock = threading.Lock()  # keeps spooling and logging of a record atomic w.r.t. checkpoints
 
 manager = config_client(MANAGER_HOST, MANAGER_PORT, SECRET)
 shared_lock = MockLock()
@@ -82,7 +88,9 @@ def get_entry():
 def get_csv_logger_status():
     """Used for testing to retrieve the current status of the CSV logger status."""
     res = flask.Response()
-    res.set_data(json.dumps(csv_logger.get_status_summary()))
+    summary = csv_logger.get_status_summary()
+    summary["spool"] = spool.get_status_summary() if spool is not None else None
+    res.set_data(json.dumps(summary))
     res.headers['Access-Control-Allow-Origin'] = '*'
     res.headers["Access-Control-Allow-Methods"] = "GET,POST,OPTIONS"
     res.headers["Access-Control-Allow-Headers"] = "x-api-key,Content-Type"
@@ -388,7 +396,12 @@ def remove_obs_entries():
 def flush_log():
     """Routinely flush logs to the disk."""
     # The csv_logger needs flush to materialize logs
-    csv_logger.flush()
+    with checkpoint_lock:
+        sealed = spool.rotate() if spool is not None else []
+        csv_logger.flush()
+    # records in the sealed segments are materialized now
+    if spool is not None:
+        spool.discard(sealed)
     app.logger.info("All files are flushed.")
 
 
@@ -404,13 +417,19 @@ def flush_talk_management_df():
 
 
 def logging(stop_event, gunicorn_logger):
-    """todo: possibly threading. csv_logger is not thread safe."""
+    """Dispatch records from the shared queue to the csv_logger pool.
+
+    The pool shards records by student number, so all records of a student are written by one shard process.
+    """
     try:
         while not stop_event.is_set():
             try:
                 record = shared_queue.get(block=True, timeout=2 * update_interval.seconds)
                 # gunicorn_logger.info("csv_logger: {} for {}".format(record.type, record.stu_num))
-                csv_logger.log(record.type, record.stu_num, record.body)
+                with checkpoint_lock:
+                    # write-ahead: the record survives a crash before the csv files are flushed
+                    spool.append(record)
+                    csv_logger.log(record.type, record.stu_num, record.body)
             except (queue.Empty,):
                 """otherwise, the queue.get() will block."""
                 pass
@@ -436,7 +455,13 @@ def exit_handler(*args):
     # close log files
     app.logger.info("Terminating the csv_logger")
     stop_event.set()
+    if csv_logger_thread.is_alive():
+        # wait for the dispatcher so that no record is handed to a stopped shard
+        csv_logger_thread.join(timeout=2 * update_interval.seconds)
     csv_logger.terminate()
+    if spool is not None:
+        # all records are materialized by the csv_logger
+        spool.discard(spool.close())
     # store all dfs
     app.logger.info("Flushing the dataframes")
     flush_talk_management_df()
@@ -465,7 +490,7 @@ def connect_to_shared_info_manager():
 
 
 def main():
-    global user_profile, talk_info_list
+    global user_profile, talk_info_list, spool
     connect_to_shared_info_manager()
     """Read AI workshop related management csv files"""
     user_profile = pd.read_csv(os.path.join(FILEPATH, "registeredInfo", "user_profile.csv"))
@@ -478,6 +503,9 @@ def main():
                         dtype={"student_id": str})
         )
     """Start services"""
+    # the shard processes are forked before any other thread is started
+    csv_logger.start()
+    spool = RecordSpool(SPOOLPATH, app.logger, fsync_interval=SPOOL_FSYNC_INTERVAL)
     csv_logger_thread.start()
     app.logger.info("CSV Logger started.")
     tl.start()
@@ -1,23 +1,39 @@
+import bisect
 import json
 import math
+import multiprocessing
 import os
-from collections import namedtuple
+import queue
+import sys
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from threading import Thread
 
 import cv2
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-from matplotlib.backends.backend_agg import FigureCanvasAgg
-from matplotlib.collections import PatchCollection
-from matplotlib.patches import Polygon
-from tqdm import trange
+from scipy.optimize import linear_sum_assignment
+from tqdm import tqdm, trange
 from webvtt import WebVTT, Caption
 
 from clusterer import SaliencyClusterer
-from gaze_classes import Gaze, StudentInfo, aoi_builder
+from cue_cache import CueCache
+from gaze_archive import GazeArchive
+from gaze_classes import AoIWithTime, Gaze, StudentInfo, aoi_builder
+
+try:
+    from utilities.csv_logger import find_gaze_files
+except ImportError:
+    # run as a script from python/peer/gaze
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+    from utilities.csv_logger import find_gaze_files
 
 ChullNamedtuple = namedtuple("ChullNamedtuple", ["start", "end", "chull_list"])
-AoIWithTime = namedtuple("AoIWithTime", ["start", "end", "slide_id", "aoi_list"])
+UpdateWindows = namedtuple("UpdateWindows", ["starts", "ends", "slides", "slide_windows", "ordered"])
+"""Update windows of all slides. `starts`, `ends` and `slides` are arrays with one entry per window,
+`slide_windows` is the range of window indices of each slide, and `ordered` is (ordered chulls, rectangles) of each
+slide."""
 
 
 class Chull:
@@ -44,40 +60,352 @@ def chull_to_original_size(chulls, shape):
     return new_chulls
 
 
-def visualize_convex_hulls(pic, chulls):
+VIRIDIS_BGR = cv2.applyColorMap(np.arange(256, dtype=np.uint8).reshape(-1, 1), cv2.COLORMAP_VIRIDIS).reshape(256, 3)
+"""The viridis colormap as a lookup table of 256 BGR colors."""
+
+
+def visualize_convex_hulls(pic, chulls, alpha=0.4):
     """
     Returns an array of the image that visualizes the convex hull over the provided picture.
-    :param pic: The original image which convex hulls are detected.
-    :param chulls: A list of convex hulls to be visualized.
-    :return: An array can be plotted directly in BGRA order.
+    Convex hulls are filled with colors from the viridis colormap, blended with the picture.
+    :param pic: The original image which convex hulls are detected. Gray-scale or BGR.
+    :param chulls: A list of convex hulls to be visualized, in pixel scale. See `chull_to_original_size()`.
+    :param alpha: The opacity of the filled convex hulls.
+    :return: An array in BGR order, of the same size as the picture. Can be shown with cv2.imshow directly.
     """
-    nclass = len(chulls)
-    color = plt.cm.get_cmap('viridis', nclass)
+    canvas = cv2.cvtColor(pic, cv2.COLOR_GRAY2BGR) if pic.ndim == 2 else pic.copy()
+    if canvas.dtype != np.uint8:
+        canvas = cv2.normalize(canvas, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
 
-    patches = []
-    for i in range(nclass):
-        polygon = Polygon(np.array(chulls[i]), closed=False)
-        patches.append(polygon)
-    p = PatchCollection(patches, alpha=0.4)
-    p.set_array(range(nclass))
+    nclass = len(chulls)
+    if nclass == 0:
+        return canvas
+    polygons = [np.round(np.asarray(chull)).astype(np.int32).reshape(-1, 1, 2) for chull in chulls]
+    colors = [VIRIDIS_BGR[round(i * 255 / max(nclass - 1, 1))].tolist() for i in range(nclass)]
 
-    fig, ax = plt.subplots(figsize=(20, 12))
-    canvas = FigureCanvasAgg(fig)
-    ax.imshow(pic, cmap=plt.cm.gray)
-    ax.add_collection(p)
-    canvas.draw()
-    arr = cv2.cvtColor(np.asarray(canvas.buffer_rgba()), cv2.COLOR_RGBA2BGRA)
-    plt.close(fig)
-    return arr
+    overlay = canvas.copy()
+    for polygon, color in zip(polygons, colors):
+        cv2.fillPoly(overlay, [polygon], color, lineType=cv2.LINE_AA)
+    cv2.addWeighted(overlay, alpha, canvas, 1 - alpha, 0, dst=canvas)
+    for polygon, color in zip(polygons, colors):
+        cv2.polylines(canvas, [polygon], True, color, thickness=2, lineType=cv2.LINE_AA)
+    return canvas
 
 
-def video_to_chulls(video_filename, clusterer: SaliencyClusterer, interval=1, interactive=False):
+def render_chulls_video(video_filename, all_chulls, output_filename, interval=1, alpha=0.4):
+    """
+    Write a video with the convex hulls of each slide drawn over the frames, for reviewing the detected slides.
+    The video is read sequentially, and every `interval`-th frame is written.
+    :param video_filename: The filename of the video that convex hulls are detected from.
+    :param all_chulls: A list of ChullNamedtuple, e.g., the output of `video_to_chulls()`.
+    :param output_filename: The filename of the annotated video (MP4).
+    :param interval: The interval to write a frame, in frame.
+    :param alpha: The opacity of the filled convex hulls.
+    :return: The number of frames written.
+    """
+    cap = cv2.VideoCapture(video_filename)
+    if not cap.isOpened():
+        print("Error opening video stream or file")
+        return 0
+    length = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    writer = cv2.VideoWriter(output_filename, cv2.VideoWriter_fourcc(*"mp4v"), fps / interval, (width, height))
+
+    starts = [chull.start for chull in all_chulls]
+    # polygons in pixel scale, converted once per slide
+    polygons = [chull_to_original_size(chull.chull_list, (height, width)) for chull in all_chulls]
+
+    n_written = 0
+    try:
+        for frame_index in trange(0, length, interval):
+            if frame_index > 0:
+                for _ in range(interval - 1):
+                    if not cap.grab():
+                        return n_written
+            ret, frame = cap.read()
+            if not ret:
+                break
+            t = frame_index / fps
+            slide_id = bisect.bisect_right(starts, t) - 1
+            if 0 <= slide_id < len(all_chulls) and t < all_chulls[slide_id].end:
+                frame = visualize_convex_hulls(frame, polygons[slide_id], alpha)
+                label = f"slide #{slide_id} {millis_to_vtt_timestamp(t * 1000)}"
+            else:
+                label = millis_to_vtt_timestamp(t * 1000)
+            cv2.putText(frame, label, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 255), 2, cv2.LINE_AA)
+            writer.write(frame)
+            n_written += 1
+    finally:
+        writer.release()
+        cap.release()
+    return n_written
+
+
+def video_to_chulls(video_filename, clusterer: SaliencyClusterer, interval=1, interactive=False, n_workers=None,
+                    scene_threshold=0.002, refine_boundaries=True, detector=None):
     """
     Converting a video to a list of convex hulls.
+
+    Non-interactive conversion is a pipeline of three stages:
+    1. A decoder thread reads the video sequentially, and only decodes every `interval`-th frame. No seek is needed.
+       Sampled frames whose thumbnails look the same as the last kept frame are dropped (see `is_scene_changed()`),
+       and the exact frame where the slide changes can be located by a binary search between two samples.
+    2. A process pool detects salient regions from kept frames in parallel. Its processes are started by a fork
+       server, since forking this process while the decoder thread and the captures are running may deadlock.
+    3. The results are merged in the order of frames, and a new slide starts whenever the convex hulls change.
     :param video_filename: The filename of the video to be processed
     :param clusterer: The clusterer that detects salient regions from frames.
     :param interval: The interval to read a frame from the video, in frame.
     :param interactive: Whether the process of calculation is interactive or not.
+    :param n_workers: The number of processes detecting salient regions. Defaults to the number of CPUs.
+        With n_workers=1, frames are processed in this process.
+    :param scene_threshold: The fraction of thumbnail pixels that must change for a sampled frame to be considered a
+        new slide. If None, salient regions are detected on every sampled frame.
+    :param refine_boundaries: Whether to locate the first frame of each new slide with a binary search. Otherwise,
+        a slide starts at the sampled frame where the change is detected.
+    :param detector: The SlideChangeDetector that decides where a new slide starts.
+    :return: A list of convex hulls for each slide.
+    """
+    if interactive:
+        return video_to_chulls_interactive(video_filename, clusterer, interval)
+
+    cap = cv2.VideoCapture(video_filename)
+    # Check if camera opened successfully
+    if not cap.isOpened():
+        print("Error opening video stream or file")
+        return []
+
+    length = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = cap.get(cv2.CAP_PROP_FPS)  # Gets the frames per second
+    n_samples = math.floor(length / interval)
+    n_workers = n_workers or os.cpu_count() or 1
+
+    # the pool of stage 2 is created before any thread is started
+    executor = None
+    if n_workers > 1:
+        executor = ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("forkserver"),
+                                       initializer=_init_chull_worker, initargs=(clusterer,))
+
+    # stage 1: decoding. The queue is bounded so that decoding does not run too far ahead.
+    frame_queue = queue.Queue(maxsize=2 * n_workers)
+    stop_event = threading.Event()
+    seek_cap = cv2.VideoCapture(video_filename) if scene_threshold is not None and refine_boundaries else None
+    decoder = Thread(target=decode_sampled_frames,
+                     args=(cap, interval, n_samples, frame_queue, stop_event, scene_threshold, seek_cap),
+                     name="video-decoder", daemon=True)
+    decoder.start()
+
+    def sampled_frames():
+        while True:
+            item = frame_queue.get()
+            if item is None:
+                return
+            yield item
+
+    # stage 2: salient regions of sampled frames
+    if executor is None:
+        indexed_chulls = ((frame_index, clusterer.get_salient_regions_hierarchy(frame))
+                          for frame_index, frame in sampled_frames())
+    else:
+        indexed_chulls = _ordered_results(executor, sampled_frames(), max_pending=2 * n_workers)
+
+    # stage 3: ordered merge
+    try:
+        indexed_chulls = tqdm(indexed_chulls, total=n_samples if scene_threshold is None else None)
+        all_chulls = merge_chulls(indexed_chulls, fps, interval, detector, end_frame=n_samples * interval)
+    finally:
+        stop_event.set()
+        # unblock the decoder if it is waiting for a free slot
+        while decoder.is_alive():
+            try:
+                frame_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        decoder.join()
+        if executor is not None:
+            executor.shutdown()
+        if seek_cap is not None:
+            seek_cap.release()
+        cap.release()
+
+    return all_chulls
+
+
+def decode_sampled_frames(cap, interval, n_samples, frame_queue, stop_event, scene_threshold=None, seek_cap=None):
+    """
+    Read the video sequentially and put every `interval`-th frame (in gray scale) into the queue.
+    Skipped frames are only grabbed, not decoded into images. The end is marked by putting None.
+    :param cap: The opened cv2.VideoCapture.
+    :param interval: The interval to sample a frame from the video, in frame.
+    :param n_samples: The number of frames to be sampled.
+    :param frame_queue: The queue receiving (frame index, gray-scale frame).
+    :param stop_event: Set by the consumer to stop decoding early.
+    :param scene_threshold: If specified, only sampled frames that differ from the last kept frame are put.
+        See `is_scene_changed()`.
+    :param seek_cap: Another cv2.VideoCapture of the same video. If specified (with scene_threshold), the index of a
+        kept frame is moved back to the first frame after the previous sample that differs from the last kept frame.
+    """
+    n_kept = 0
+    try:
+        kept_signature = None
+        previous_index = 0
+        for sample in range(n_samples):
+            if stop_event.is_set():
+                return
+            frame_index = sample * interval
+            if sample > 0:
+                # skip to the frame before the next sampled one
+                for _ in range(interval - 1):
+                    if not cap.grab():
+                        return
+            ret, frame = cap.read()
+            if not ret:
+                return
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+            if scene_threshold is not None:
+                signature = frame_signature(frame)
+                if kept_signature is not None:
+                    if not is_scene_changed(signature, kept_signature, scene_threshold):
+                        previous_index = frame_index
+                        continue
+                    if seek_cap is not None:
+                        frame_index = find_scene_change(seek_cap, previous_index, frame_index, kept_signature,
+                                                        scene_threshold)
+                kept_signature = signature
+                previous_index = sample * interval
+
+            frame_queue.put((frame_index, frame))
+            n_kept += 1
+    finally:
+        if scene_threshold is not None:
+            print(f"Salient regions are detected on {n_kept} frame(s) of {n_samples} sampled frame(s).")
+        frame_queue.put(None)
+
+
+def frame_signature(frame, size=(64, 36)):
+    """
+    Returns a small thumbnail of a gray-scale frame in [0, 1], which is cheap to compare.
+    :param frame: The gray-scale frame.
+    :param size: The size (width, height) of the thumbnail.
+    """
+    return cv2.resize(frame, size, interpolation=cv2.INTER_AREA).astype(np.float32) / 255
+
+
+def is_scene_changed(signature, old_signature, threshold, pixel_threshold=0.08):
+    """
+    Compares the thumbnails of two frames.
+    :param signature: The thumbnail of the new frame. See `frame_signature()`.
+    :param old_signature: The thumbnail of the old frame.
+    :param threshold: The fraction of pixels that must change for the frames to be considered different.
+    :param pixel_threshold: The change of intensity for a pixel to be considered changed.
+    :return: True if the frames are different.
+    """
+    changed = np.abs(signature - old_signature) > pixel_threshold
+    return changed.mean() > threshold
+
+
+def find_scene_change(seek_cap, low, high, old_signature, threshold):
+    """
+    Binary search for the first frame in (low, high] that differs from `old_signature`.
+    Frame `low` is assumed to be the same as the old frame, and frame `high` different.
+    :param seek_cap: A cv2.VideoCapture used for seeking.
+    :param low: The index of a frame that is the same as the old frame.
+    :param high: The index of a frame that differs from the old frame.
+    :param old_signature: The thumbnail of the old frame.
+    :param threshold: See `is_scene_changed()`.
+    :return: The index of the first different frame.
+    """
+    while high - low > 1:
+        middle = (low + high) // 2
+        seek_cap.set(cv2.CAP_PROP_POS_FRAMES, middle)
+        ret, frame = seek_cap.read()
+        if not ret:
+            break
+        signature = frame_signature(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+        if is_scene_changed(signature, old_signature, threshold):
+            high = middle
+        else:
+            low = middle
+    return high
+
+
+_worker_clusterer = None
+"""The clusterer used in a worker process of video_to_chulls()."""
+
+
+def _init_chull_worker(clusterer):
+    global _worker_clusterer
+    _worker_clusterer = clusterer
+
+
+def _chulls_of_frame(frame):
+    return _worker_clusterer.get_salient_regions_hierarchy(frame)
+
+
+def _ordered_results(executor, indexed_frames, max_pending):
+    """
+    Submit frames to the executor, and yield (frame index, convex hulls) in the order of frames.
+    At most `max_pending` frames are in flight.
+    """
+    pending = deque()
+    for frame_index, frame in indexed_frames:
+        pending.append((frame_index, executor.submit(_chulls_of_frame, frame)))
+        if len(pending) >= max_pending:
+            frame_index, future = pending.popleft()
+            yield frame_index, future.result()
+    while len(pending) > 0:
+        frame_index, future = pending.popleft()
+        yield frame_index, future.result()
+
+
+def merge_chulls(indexed_chulls, fps, interval, detector=None, end_frame=None):
+    """
+    Split sampled frames into slides. A new slide starts when the convex hulls differ from those of the current slide.
+    :param indexed_chulls: An iterable of (frame index, convex hulls) in the order of frames.
+    :param fps: The frames per second of the video.
+    :param interval: The interval between sampled frames, in frame.
+    :param detector: A SlideChangeDetector. Defaults to one with default parameters.
+    :param end_frame: The index of the frame where the last slide ends. Defaults to one interval after the last frame.
+    :return: A list of ChullNamedtuple.
+    """
+    detector = detector or SlideChangeDetector()
+    all_chulls = []
+    start = 0
+    old_chull = []
+    count = 0
+    for frame_index, new_chull in indexed_chulls:
+        changed = detector.update(new_chull)
+        if len(old_chull) == 0:
+            # old_chull is not updated yet
+            old_chull = new_chull
+        elif changed:
+            # chull is different
+            all_chulls.append(ChullNamedtuple(
+                start, frame_index / fps, old_chull.copy()
+            ))
+
+            start = frame_index / fps
+            old_chull = new_chull
+        count = frame_index + interval
+
+    if len(old_chull) != 0:
+        print("Adding the last chull")
+        if end_frame is not None:
+            count = end_frame
+        all_chulls.append(ChullNamedtuple(start, count / fps, old_chull.copy()))
+    return all_chulls
+
+
+def video_to_chulls_interactive(video_filename, clusterer: SaliencyClusterer, interval=1):
+    """
+    Converting a video to a list of convex hulls, frame by frame.
+    Each sampled frame is shown with its convex hulls. Press `c` to continue and `q` to quit.
+    :param video_filename: The filename of the video to be processed
+    :param clusterer: The clusterer that detects salient regions from frames.
+    :param interval: The interval to read a frame from the video, in frame.
     :return: A list of convex hulls for each slide.
     """
     cap = cv2.VideoCapture(video_filename)
@@ -98,52 +426,34 @@ def video_to_chulls(video_filename, clusterer: SaliencyClusterer, interval=1, in
     for frame_count in trange(math.floor(length / interval)):
         # Capture frame-by-frame
         ret, frame = cap.read()
+        if not ret:
+            break
         frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        if ret:
-            # calculate the chull from the frame
-            # print(f"Frame #{frame_count} shape {frame.shape}")
-            new_chull = clusterer.get_salient_regions_hierarchy(frame)
-
-            if interactive:
-                cv2.imshow('Frame', visualize_convex_hulls(frame, chull_to_original_size(new_chull, frame.shape)))
-                key = cv2.waitKey(0)
-
-                if key & 0xFF == ord('c'):
-                    if len(old_chull) == 0:
-                        # old_chull is not updated yet
-                        print("old chull not initialized")
-                        old_chull = new_chull.copy()
-                    elif not is_chull_same(new_chull, old_chull, 0.1):
-                        # chull is different
-                        all_chulls.append(ChullNamedtuple(
-                            start, count / fps, old_chull.copy()
-                        ))
-
-                        print(f"adding new chull, now length {len(all_chulls)}")
-
-                        start = count / fps
-                        old_chull = new_chull
-
-                    count += interval
-                    cap.set(cv2.CAP_PROP_POS_FRAMES, count)
-                elif key & 0xFF == ord('q'):
-                    break
-            else:
-                if len(old_chull) == 0:
-                    # old_chull is not updated yet
-                    old_chull = new_chull
-                elif not is_chull_same(new_chull, old_chull, 0.1):
-                    # chull is different
-                    all_chulls.append(ChullNamedtuple(
-                        start, count / fps, old_chull.copy()
-                    ))
-
-                    start = count / fps
-                    old_chull = new_chull
-
-                count += interval
-                cap.set(cv2.CAP_PROP_POS_FRAMES, count)
-        else:
+        # calculate the chull from the frame
+        new_chull = clusterer.get_salient_regions_hierarchy(frame)
+
+        cv2.imshow('Frame', visualize_convex_hulls(frame, chull_to_original_size(new_chull, frame.shape)))
+        key = cv2.waitKey(0)
+
+        if key & 0xFF == ord('c'):
+            if len(old_chull) == 0:
+                # old_chull is not updated yet
+                print("old chull not initialized")
+                old_chull = new_chull.copy()
+            elif not is_chull_same(new_chull, old_chull, 0.1):
+                # chull is different
+                all_chulls.append(ChullNamedtuple(
+                    start, count / fps, old_chull.copy()
+                ))
+
+                print(f"adding new chull, now length {len(all_chulls)}")
+
+                start = count / fps
+                old_chull = new_chull
+
+            count += interval
+            cap.set(cv2.CAP_PROP_POS_FRAMES, count)
+        elif key & 0xFF == ord('q'):
             break
 
     if len(old_chull) != 0:
@@ -158,91 +468,313 @@ def video_to_chulls(video_filename, clusterer: SaliencyClusterer, interval=1, in
 def is_chull_same(new_chull_list, old_chull_list, threshold):
     """
     Compares where two list of convex hulls are almost the same.
+    Convex hulls are matched with `chull_similarity()`, so a hull appearing or vanishing because of jitter does not
+    make the lists different by itself.
     :param new_chull_list: The list of new convex hulls.
     :param old_chull_list: The list of old convex hulls.
-    :param threshold: The threshold to allow small fluctuation in convex hull coordinate.
+    :param threshold: The threshold to allow small fluctuation in convex hull coordinate. Centers further apart
+        than this are not considered the same.
     :return:
     """
-    if len(new_chull_list) != len(old_chull_list):
-        # the number of salient regions are different
-        # print(f"chull list size different: new {len(new_chull_list)}, old {len(old_chull_list)}")
-        return False
-    else:
-        # the number of salient regions are the same
-        # check if the coordinates are similar
-        dist = 0
-        for (new_chull, old_chull) in zip(new_chull_list, old_chull_list):
-            # new_chull, old_chull: n_coordinate x 2 or 4 (rectangle) x 2
-            new_center = np.array(new_chull).mean(axis=0)
-            old_center = np.array(old_chull).mean(axis=0)
-            dist += np.linalg.norm(new_center - old_center)
+    return chull_similarity(new_chull_list, old_chull_list, distance_scale=threshold) >= SAME_SLIDE_SIMILARITY
+
 
-        # print(f"Distance: {dist}")
-        return dist < threshold
+SAME_SLIDE_SIMILARITY = 0.7
+"""The similarity (see `chull_similarity()`) above which two lists of convex hulls belong to the same slide."""
+
+
+def chull_similarity(new_chull_list, old_chull_list, distance_scale=0.1, iou_weight=0.5):
+    """
+    Measures how similar two lists of convex hulls are.
+
+    Each convex hull is represented by its bounding rectangle (as in SaliencyClusterer.sort_chulls_by_rectangles)
+    and its center. The similarity of two hulls is a weighted sum of the IoU of their rectangles and the closeness of
+    their centers. Hulls are matched one to one with the optimal assignment (Hungarian algorithm), and unmatched
+    hulls count as 0.
+    :param new_chull_list: The list of new convex hulls.
+    :param old_chull_list: The list of old convex hulls.
+    :param distance_scale: Centers this far apart (or further) have a closeness of 0.
+    :param iou_weight: The weight of IoU. The weight of closeness is 1 - iou_weight.
+    :return: The similarity in [0, 1]. 1 means the lists are the same.
+    """
+    n_new, n_old = len(new_chull_list), len(old_chull_list)
+    if n_new == 0 or n_old == 0:
+        return 1.0 if n_new == n_old else 0.0
+
+    def describe(chull_list):
+        rects = np.array([np.concatenate([np.min(chull, axis=0), np.max(chull, axis=0)]) for chull in chull_list])
+        centers = np.array([np.mean(chull, axis=0) for chull in chull_list])
+        return rects, centers
+
+    new_rects, new_centers = describe(new_chull_list)  # rects: (x_min, y_min, x_max, y_max)
+    old_rects, old_centers = describe(old_chull_list)
+
+    # IoU of every pair of rectangles
+    lower = np.maximum(new_rects[:, np.newaxis, :2], old_rects[np.newaxis, :, :2])
+    upper = np.minimum(new_rects[:, np.newaxis, 2:], old_rects[np.newaxis, :, 2:])
+    intersection = np.prod(np.clip(upper - lower, 0, None), axis=2)
+    new_areas = np.prod(new_rects[:, 2:] - new_rects[:, :2], axis=1)
+    old_areas = np.prod(old_rects[:, 2:] - old_rects[:, :2], axis=1)
+    union = new_areas[:, np.newaxis] + old_areas[np.newaxis, :] - intersection
+    iou = np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
+    distance = np.linalg.norm(new_centers[:, np.newaxis, :] - old_centers[np.newaxis, :, :], axis=2)
+    closeness = np.clip(1 - distance / distance_scale, 0, 1)
+
+    similarity = iou_weight * iou + (1 - iou_weight) * closeness
+    rows, cols = linear_sum_assignment(similarity, maximize=True)
+    return float(similarity[rows, cols].sum() / max(n_new, n_old))
+
+
+class SlideChangeDetector:
+    """Detects slide changes from the convex hulls of consecutive sampled frames, with hysteresis.
+
+    Each frame is compared with a reference (the hulls of the current slide) by `chull_similarity()`:
+    - below `low`: a new slide starts, and the frame becomes the reference.
+    - at least `high`: the same slide. The frame becomes the reference, which follows slow drift.
+    - in between: the same slide, but the reference is kept, so that ambiguous frames neither split the slide nor
+      drag the reference away.
+    """
+
+    def __init__(self, low=0.5, high=0.8, distance_scale=0.1, iou_weight=0.5):
+        """
+        :param low: The similarity below which a new slide starts.
+        :param high: The similarity above which the reference is updated.
+        :param distance_scale: See `chull_similarity()`.
+        :param iou_weight: See `chull_similarity()`.
+        """
+        self.low = low
+        self.high = high
+        self.distance_scale = distance_scale
+        self.iou_weight = iou_weight
+        self.reference = []
+
+    def params(self) -> dict:
+        """Returns the parameters of the detector."""
+        return {"low": self.low, "high": self.high, "distance_scale": self.distance_scale,
+                "iou_weight": self.iou_weight}
+
+    def update(self, chull_list) -> bool:
+        """
+        Compare the convex hulls of a new frame with the reference.
+        :param chull_list: The convex hulls of the new frame.
+        :return: True if a new slide starts at this frame. The first frame with convex hulls does not start a slide.
+        """
+        if len(self.reference) == 0:
+            # not initialized yet
+            self.reference = chull_list
+            return False
+        similarity = chull_similarity(chull_list, self.reference, self.distance_scale, self.iou_weight)
+        if similarity < self.low:
+            self.reference = chull_list
+            return True
+        if similarity >= self.high:
+            self.reference = chull_list
+        return False
 
 
 def gaze_to_aois(all_chulls, clusterer: SaliencyClusterer, gaze_dfs, update_interval: int):
     """
     Align gaze data to the list of all salient regions.
+
+    Each slide is split into windows of `update_interval` seconds. Every gaze sample of a student is put into its
+    window with one binary search, samples of each slide are assigned to its convex hulls at once, and the counts of
+    each (window, AoI) are obtained with a single bincount.
     :param all_chulls: A list of the convex hulls detected from each slide.
     :param clusterer: The cluster that assigns gaze points to clusters.
-    :param gaze_dfs: A list of dataframes that contains gaze of all participants.
+    :param gaze_dfs: A list of dataframes that contains gaze of all participants. See `count_student_gaze()`.
     :param update_interval: The interval for calculating the attention distribution again within a slide.
     :return:
     """
-    all_aois = []
-    for slide_id, chull in enumerate(all_chulls):
-        n_classes = len(chull.chull_list)
-        _, rectangles = clusterer.sort_chulls_by_rectangles(chull.chull_list)
-        print("=" * 20)
-        print(f"Chull #{slide_id} n_classes {n_classes}")
+    windows = build_update_windows(all_chulls, clusterer, update_interval)
+    student_counts = {
+        student_id: count_student_gaze(windows, clusterer, gaze_df) for student_id, gaze_df in gaze_dfs.items()
+    }
+    return counts_to_aois(all_chulls, windows, student_counts)
 
-        n_updates = math.ceil((chull.end - chull.start) / update_interval)
-        print(f"duration: {chull.end - chull.start}, number of updates {n_updates}")
 
+def build_update_windows(all_chulls, clusterer: SaliencyClusterer, update_interval: int) -> UpdateWindows:
+    """
+    Split each slide into windows of `update_interval` seconds.
+    :param all_chulls: A list of the convex hulls detected from each slide.
+    :param clusterer: The cluster that orders the convex hulls.
+    :param update_interval: The interval for calculating the attention distribution again within a slide.
+    :return: The windows of all slides, in the order of time.
+    """
+    window_starts, window_ends, window_slides = [], [], []
+    slide_windows = []
+    ordered = []
+    for slide_id, chull in enumerate(all_chulls):
+        ordered.append(clusterer.sort_chulls_by_rectangles(chull.chull_list))
+        n_updates = math.ceil((chull.end - chull.start) / update_interval)
+        first_window = len(window_starts)
         for update_counter in range(n_updates):
             update_start = chull.start + update_counter * update_interval
-            update_end = min(update_start + update_interval, chull.end)
+            window_starts.append(update_start)
+            window_ends.append(min(update_start + update_interval, chull.end))
+            window_slides.append(slide_id)
+        slide_windows.append(range(first_window, len(window_starts)))
+    return UpdateWindows(
+        starts=np.array(window_starts, dtype=float),
+        ends=np.array(window_ends, dtype=float),
+        slides=np.array(window_slides, dtype=int),
+        slide_windows=slide_windows,
+        ordered=ordered,
+    )
+
+
+def count_student_gaze(windows: UpdateWindows, clusterer: SaliencyClusterer, gaze_df):
+    """
+    Count the gaze samples of a student in each window and each AoI.
+    :param windows: See `build_update_windows()`.
+    :param clusterer: The cluster that assigns gaze points to clusters.
+    :param gaze_df: The dataframe of the student's gaze, or a dictionary of arrays with the same columns
+        (relative_timestamp, gaze_x_percentage, gaze_y_percentage), e.g., from `read_archive()`.
+    :return: A tuple of (sample count of each window, list of fixation counts of each window).
+    """
+    n_windows = windows.starts.shape[0]
+    timestamps = np.asarray(gaze_df["relative_timestamp"], dtype=float)
+    points = np.stack([np.asarray(gaze_df["gaze_x_percentage"], dtype=float),
+                       np.asarray(gaze_df["gaze_y_percentage"], dtype=float)], axis=1)
+
+    window_ids = np.searchsorted(windows.starts, timestamps, side="right") - 1
+    in_window = window_ids >= 0
+    in_window[in_window] = timestamps[in_window] < windows.ends[window_ids[in_window]]
+    window_ids, points = window_ids[in_window], points[in_window]
+
+    sample_count = np.bincount(window_ids, minlength=n_windows)
+    fixation_counts = [np.zeros((len(windows.ordered[slide_id][0]),), dtype=int) for slide_id in windows.slides]
+    sample_slides = windows.slides[window_ids]
+    for slide_id in np.unique(sample_slides):
+        ordered_chulls, _ = windows.ordered[slide_id]
+        n_classes = len(ordered_chulls)
+        in_slide = sample_slides == slide_id
+        labels = clusterer.assign_points(points[in_slide], ordered_chulls)
+        slide_windows = windows.slide_windows[slide_id]
+        local_window_ids = window_ids[in_slide] - slide_windows.start
+        counts = np.bincount(local_window_ids * n_classes + labels, minlength=len(slide_windows) * n_classes)
+        counts = counts.reshape((len(slide_windows), n_classes))
+        for i, window_id in enumerate(slide_windows):
+            fixation_counts[window_id] = counts[i]
+    return sample_count, fixation_counts
+
+
+def counts_to_aois(all_chulls, windows: UpdateWindows, student_counts):
+    """
+    Build the AoIs of each window from the counts of all students.
+    :param all_chulls: A list of the convex hulls detected from each slide.
+    :param windows: See `build_update_windows()`.
+    :param student_counts: A dictionary of student_id: counts. See `count_student_gaze()`.
+    :return: A list of AoIWithTime.
+    """
+    all_aois = []
+    for slide_id, chull in enumerate(all_chulls):
+        _, rectangles = windows.ordered[slide_id]
+        n_classes = len(rectangles)
+        slide_windows = windows.slide_windows[slide_id]
+        print("=" * 20)
+        print(f"Chull #{slide_id} n_classes {n_classes}")
+        print(f"duration: {chull.end - chull.start}, number of updates {len(slide_windows)}")
 
+        for update_counter, window_id in enumerate(slide_windows):
+            update_start, update_end = windows.starts[window_id], windows.ends[window_id]
             print(
                 f"#{update_counter}: {millis_to_vtt_timestamp(update_start * 1000)} ---> {millis_to_vtt_timestamp(update_end * 1000)}")
 
             student_info = {}
-            for [student_id, gaze_df] in gaze_dfs.items():
-                in_range_df = gaze_df.loc[
-                    (gaze_df["relative_timestamp"] >= update_start) & (gaze_df["relative_timestamp"] < update_end)
-                    ]
-
-                if in_range_df.shape[0] == 0:
+            for student_id, (sample_count, fixation_counts) in student_counts.items():
+                if sample_count[window_id] == 0:
                     continue
 
-                gazes = in_range_df.apply(lambda row: Gaze(row["gaze_x_percentage"], row["gaze_y_percentage"]), axis=1)
-
-                result = clusterer.cluster_with_given_chulls({student_id: gazes}, chull.chull_list)
-                result = result[student_id]
-
-                aoi_ids, count = np.unique(result, return_counts=True)
-
-                for [aoi_id, c] in zip(aoi_ids, count):
-                    print(f"\t#{aoi_id} AoI contains {c} gaze(s)/fixations(s).")
-
-                fixation_count = np.zeros((n_classes,))
-                if aoi_ids.shape[0] > 0:
-                    fixation_count[aoi_ids] = count
+                fixation_count = fixation_counts[window_id]
+                for aoi_id in np.flatnonzero(fixation_count):
+                    print(f"\t#{aoi_id} AoI contains {fixation_count[aoi_id]} gaze(s)/fixations(s).")
 
                 student_info[student_id] = StudentInfo(
-                    fixation_count=fixation_count.tolist(),
+                    fixation_count=fixation_count.astype(float).tolist(),
                     confusion_reports=[],
                     inattention_count=0,
                     timestamp=0
                 )
 
             [aoi_list] = aoi_builder(rectangles, student_info)
-            all_aois.append(AoIWithTime(update_start, update_end, slide_id, aoi_list))
+            all_aois.append(AoIWithTime(float(update_start), float(update_end), slide_id, aoi_list))
 
     return all_aois
 
 
+def cached_video_to_chulls(video_filename, clusterer: SaliencyClusterer, cache: CueCache, interval=1, **kwargs):
+    """
+    Same as `video_to_chulls()` (non-interactive), but the convex hulls are read from the cache if the video and
+    the parameters have not changed.
+    :param video_filename: The filename of the video to be processed
+    :param clusterer: The clusterer that detects salient regions from frames.
+    :param cache: The cache of convex hulls.
+    :param interval: The interval to read a frame from the video, in frame.
+    :param kwargs: Other arguments of `video_to_chulls()`.
+    :return: A list of convex hulls for each slide.
+    """
+    params = {
+        "interval": interval,
+        "scene_threshold": kwargs.get("scene_threshold", 0.002),
+        "refine_boundaries": kwargs.get("refine_boundaries", True),
+        "struct_element_type": clusterer._struct_element_type,
+        "struct_element_shape": clusterer._struct_element_shape,
+        "max_area": clusterer.max_area,
+        "min_area": clusterer.min_area,
+        "shape": [clusterer.w_, clusterer.h_],
+        "detector": (kwargs.get("detector") or SlideChangeDetector()).params(),
+    }
+    video_key = cache.video_key(video_filename)
+    cached = cache.load_chulls(video_key, params)
+    if cached is not None:
+        print(f"Convex hulls of {len(cached)} slide(s) are loaded from the cache.")
+        return [ChullNamedtuple(start, end, chull_list) for start, end, chull_list in cached]
+
+    all_chulls = video_to_chulls(video_filename, clusterer, interval=interval, **kwargs)
+    cap = cv2.VideoCapture(video_filename)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    cap.release()
+    cache.save_chulls(video_key, params, all_chulls, fps)
+    return all_chulls
+
+
+def cached_gaze_to_aois(all_chulls, clusterer: SaliencyClusterer, gaze_filenames, lecture_id, update_interval: int,
+                        cache: CueCache):
+    """
+    Same as `gaze_to_aois()`, but only gaze files that are new or modified are read and counted.
+    Counts of other students are read from the cache.
+    :param all_chulls: A list of the convex hulls detected from each slide.
+    :param clusterer: The cluster that assigns gaze points to clusters.
+    :param gaze_filenames: The gaze files of each student. See `read_dataframes()`.
+    :param lecture_id: Specifies the id of lecture to consider
+    :param update_interval: The interval for calculating the attention distribution again within a slide.
+    :param cache: The cache of counts.
+    :return: A list of AoIWithTime.
+    """
+    windows = build_update_windows(all_chulls, clusterer, update_interval)
+    signature = cache.windows_signature(windows.starts, windows.ends, [chulls for chulls, _ in windows.ordered],
+                                        extra={"lecture_id": lecture_id})
+    n_classes = [len(windows.ordered[slide_id][0]) for slide_id in windows.slides]
+
+    student_files = files_by_student(gaze_filenames)
+    student_counts = {}
+    n_cached = 0
+    for student_id, filenames in student_files.items():
+        file_key = cache.files_key(filenames)
+        counts = cache.load_counts(student_id, file_key, signature, n_classes)
+        if counts is None:
+            gaze_df = read_dataframe(filenames, lecture_id, student_id=student_id)
+            counts = count_student_gaze(windows, clusterer, gaze_df)
+            cache.save_counts(student_id, file_key, signature, counts)
+        else:
+            n_cached += 1
+        student_counts[student_id] = counts
+    print(f"Counts of {n_cached} of {len(student_files)} student(s) are loaded from the cache.")
+
+    return counts_to_aois(all_chulls, windows, student_counts)
+
+
 def aoi_to_vtt(vtt_filename, aois):
     """
     Converting the AoIs into a VTT file that can be loaded along with the video.
@@ -285,31 +817,105 @@ def millis_to_vtt_timestamp(millis):
     return f"{hours.zfill(2)}:{minutes.zfill(2)}:{seconds.zfill(2)}.{ms.zfill(3)}"
 
 
-def read_dataframes(gaze_filenames, lecture_id):
+def read_archive(archive_dir, lecture_id, student_ids=None):
+    """
+    Read in the gaze of a lecture from an archive built by gaze_archive.py, in place of `read_dataframes()`.
+    :param archive_dir: The root folder of the archive.
+    :param lecture_id: Specifies the id of lecture to consider
+    :param student_ids: The students to read. Defaults to all students in the archive.
+    :return: A dictionary of student_id: dictionary of arrays, which can be passed to `gaze_to_aois()`.
+    """
+    archive = GazeArchive(archive_dir)
+    gaze = {}
+    for student_id in student_ids if student_ids is not None else archive.students():
+        if int(lecture_id) in archive.lectures(student_id):
+            gaze[str(student_id)] = archive.series(student_id, lecture_id).query_relative()
+    return gaze
+
+
+GAZE_DTYPES = {
+    "timestamp": "float64",
+    "gaze_x": "float32",
+    "gaze_y": "float32",
+    "lecture_id": "float32",
+    "client_width": "float32",
+    "client_height": "float32",
+}
+"""Columns of gaze files used by `read_dataframes()` and their dtypes."""
+
+
+def files_by_student(gaze_filenames):
+    """
+    Returns a dictionary of student_id: list of filenames.
+    :param gaze_filenames: Either such a dictionary (see `find_gaze_files()` in utilities/csv_logger.py), or a list
+        of `{student_id}_*.csv` filenames, one per student.
+    """
+    if isinstance(gaze_filenames, dict):
+        return {str(student_id): filenames for student_id, filenames in gaze_filenames.items()}
+    return {os.path.basename(gaze_filename).split("_")[0]: [gaze_filename] for gaze_filename in gaze_filenames}
+
+
+def read_dataframes(gaze_filenames, lecture_id, n_workers=4, chunksize=500000):
     """
     Read in and process dataframes from the specified filenames.
-    :type gaze_filenames: list[str]
-    :type gaze_filenames: int
-    :param gaze_filenames: A list filenames of the gaze data
+
+    Only the columns in GAZE_DTYPES are read. Each file is read in chunks of `chunksize` rows, and rows of other
+    lectures are dropped chunk by chunk, so the memory used is bounded by the rows of the lecture.
+    Students are read in parallel by `n_workers` threads.
+    :param gaze_filenames: The gaze files of each student. See `files_by_student()`.
     :param lecture_id: Specifies the id of lecture to consider
-    :return:
+    :param n_workers: The number of threads reading files.
+    :param chunksize: The number of rows read at a time.
+    :return: A dictionary of student_id: dataframe, in the order of students.
+    """
+    student_files = files_by_student(gaze_filenames)
+    with ThreadPoolExecutor(max_workers=max(1, n_workers)) as executor:
+        dfs = executor.map(lambda item: read_dataframe(item[1], lecture_id, chunksize, student_id=item[0]),
+                           student_files.items())
+        return dict(zip(student_files.keys(), dfs))
+
+
+def read_dataframe(gaze_filenames, lecture_id, chunksize=500000, student_id=None):
     """
-    dfs = {}
+    Read in the gaze data of one lecture of a student.
+    :param gaze_filenames: The filename of the gaze data, or a list of the files of the student in the order they
+        are written, e.g., partitions of CSVLogger.
+    :param lecture_id: Specifies the id of lecture to consider
+    :param chunksize: The number of rows read at a time.
+    :param student_id: Used in the progress message. Defaults to the prefix of the first filename.
+    :return: A dataframe with the columns in GAZE_DTYPES, relative_timestamp (in second, since the first row of
+        the lecture), gaze_x_percentage and gaze_y_percentage.
+    """
+    if isinstance(gaze_filenames, str):
+        gaze_filenames = [gaze_filenames]
+    if student_id is None:
+        student_id = os.path.basename(gaze_filenames[0]).split("_")[0]
+    print(f"Reading gaze of student {student_id}")
+
+    first_timestamp = None
+    chunks = []
     for gaze_filename in gaze_filenames:
-        student_id = os.path.basename(gaze_filename).split("_")[0]
-        print(f"Reading gaze of student {student_id}")
-        df = pd.read_csv(gaze_filename)
-        # convert in second
-        df["relative_timestamp"] = (df["timestamp"] - df["timestamp"][0]) / 1000
+        for chunk in pd.read_csv(gaze_filename, usecols=list(GAZE_DTYPES.keys()), dtype=GAZE_DTYPES,
+                                 chunksize=chunksize):
+            chunk = chunk[chunk["lecture_id"] == lecture_id]
+            if chunk.shape[0] > 0:
+                if first_timestamp is None:
+                    first_timestamp = chunk["timestamp"].iloc[0]
+                chunks.append(chunk)
+
+    if len(chunks) == 0:
+        df = pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in GAZE_DTYPES.items()})
+    else:
+        df = pd.concat(chunks, ignore_index=True)
 
-        # convert pixel into percentage
-        df["gaze_x_percentage"] = df["gaze_x"] / df["client_width"]
-        df["gaze_y_percentage"] = df["gaze_y"] / df["client_height"]
+    # convert in second
+    df["relative_timestamp"] = (df["timestamp"] - first_timestamp) / 1000 if first_timestamp is not None else 0.0
 
-        # print(df["relative_timestamp"])
-        dfs[student_id] = df[df.lecture_id == lecture_id]
+    # convert pixel into percentage
+    df["gaze_x_percentage"] = df["gaze_x"] / df["client_width"]
+    df["gaze_y_percentage"] = df["gaze_y"] / df["client_height"]
 
-    return dfs
+    return df
 
 
 if __name__ == "__main__":
@@ -325,20 +931,29 @@ if __name__ == "__main__":
     lecture_id = 4
     frame_interval = 100  # in frame
     update_interval = 5  # in seconds
+    render_review_video = False  # write a video with the detected slides drawn
 
     video_filename = f"REPLACE_WITH_YOUR_OWN_FILE_STORAGE_PATH/assets/talk_{lecture_id}.mp4"
     vtt_filename = video_filename.replace("mp4", "vtt")
+    # convex hulls and counts of unchanged files are reused from here
+    cache = CueCache(os.path.join(root_folder, "cue_cache"))
 
-    # read in and process the gaze data of students
     # TODO: read in attention file as while to skip invalid data
-    gaze_filenames = [os.path.join(root_folder, f"{student_id}_gaze_async.csv") for student_id in student_ids]
-    gaze_dfs = read_dataframes(gaze_filenames, lecture_id=0)
+    # both {student_id}_gaze_async.csv and partitioned files (see CSVLogger)
+    gaze_filenames = find_gaze_files(root_folder, lecture_id=lecture_id, stu_nums=student_ids)
 
     # generate a list of convex hulls detected from all slides
-    all_chulls = video_to_chulls(video_filename, clusterer, interval=frame_interval, interactive=False)
+    all_chulls = cached_video_to_chulls(video_filename, clusterer, cache, interval=frame_interval,
+                                        n_workers=os.cpu_count())
+
+    if render_review_video:
+        # for reviewing the detected slides
+        render_chulls_video(video_filename, all_chulls, video_filename.replace(".mp4", "_aoi.mp4"),
+                            interval=frame_interval // 10 or 1)
 
-    # assign gaze points to convex hulls detected from all slides
-    all_aois = gaze_to_aois(all_chulls, clusterer, gaze_dfs, update_interval=update_interval)
+    # read in the gaze data of new students, and assign gaze points to convex hulls detected from all slides
+    all_aois = cached_gaze_to_aois(all_chulls, clusterer, gaze_filenames, lecture_id=lecture_id,
+                                   update_interval=update_interval, cache=cache)
 
     # generate the VTT file
     aoi_to_vtt(vtt_filename, all_aois)
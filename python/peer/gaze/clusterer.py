@@ -213,6 +213,47 @@ class SaliencyClusterer(Clusterer):
             )
         return min(dist)
 
+    def distance_points_chull(self, points, chull_vertices):
+        """
+        Calculate the distances between many points and a convex hull at once.
+
+        Same as `distance_point_chull()` for each point.
+
+        :param points: An array of points. Shape: [n_points, 2].
+        :param chull_vertices: A list of coordinates specifies the convex hull. Shape: [n_vertices, 2].
+        :return: An array of distances. Shape: [n_points,].
+        """
+        p1 = np.asarray(chull_vertices, dtype=float)  # n_vertices x 2
+        p2 = np.roll(p1, -1, axis=0)
+        u = p2 - p1
+        uu = np.einsum("ij,ij->i", u, u)
+        v = points[:, np.newaxis, :] - p1[np.newaxis, :, :]  # n_points x n_vertices x 2
+        with np.errstate(divide="ignore", invalid="ignore"):
+            proj = np.einsum("pij,ij->pi", v, u) / uu
+        # projections outside of a side are clipped to its endpoints. Degenerated sides are points.
+        proj = np.where(uu > 0, np.clip(proj, 0, 1), 0)
+        d = np.linalg.norm(v - proj[:, :, np.newaxis] * u[np.newaxis, :, :], axis=2)
+        return d.min(axis=1)
+
+    def assign_points(self, points, chulls: list = None, chunk_size: int = 8192):
+        """Assign each point to the nearest convex hull.
+
+        :param points: An array of points. Shape: [n_points, 2].
+        :param chulls: A list of convex hull coordinates. Defaults to the ones detected or given last.
+        :param chunk_size: The number of points processed at a time, which bounds the memory used.
+        :return: An array of AoI indices. Shape: [n_points,]. Ties go to the first convex hull.
+        """
+        chulls = self.chulls_ if chulls is None else chulls
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        labels = np.zeros((points.shape[0],), dtype=int)
+        if len(chulls) == 0:
+            return labels
+        for begin in range(0, points.shape[0], chunk_size):
+            chunk = points[begin:begin + chunk_size]
+            dist = np.stack([self.distance_points_chull(chunk, chull_vertices) for chull_vertices in chulls], axis=1)
+            labels[begin:begin + chunk_size] = dist.argmin(axis=1)
+        return labels
+
     def cluster_with_given_chulls(self, fixations: Dict[str, list], chulls: list) -> Dict[str, list]:
         """A wrapper of the cluster method in order to use a convex hull calculated from other gunicorn workers.
 
@@ -234,17 +275,8 @@ class SaliencyClusterer(Clusterer):
         """
         result = {}
         for user_id, fixation_list in fixations.items():
-            categories = []
-            for fixation in fixation_list:
-                dist = []
-                for chull_vertices in self.chulls_:
-                    dist.append(
-                        self.distance_point_chull([fixation.x, fixation.y], chull_vertices)
-                    )
-                c = dist.index(min(dist))
-                categories.append(c)
-
-            result[user_id] = categories
+            points = np.array([[fixation.x, fixation.y] for fixation in fixation_list], dtype=float)
+            result[user_id] = self.assign_points(points).tolist()
         return result
 
 
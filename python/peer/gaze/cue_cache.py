@@ -0,0 +1,149 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+class CueCache:
+    """A persistent cache for generating VTT cues of a lecture incrementally.
+
+    Two kinds of results are cached under the cache folder:
+    ===== =====
+    chulls/<video key>_<params key>.json         convex hulls of each slide, with the frame range of the slide
+    counts/<student id>_<file key>_<windows>.npz  sample and fixation counts of a student in each update window
+    ===== =====
+
+    A video is identified by its size, modification time and sampled content, a gaze file by its path, size and
+    modification time. Counts are only valid for the same update windows and convex hulls, so the signature of
+    the windows (see `windows_signature()`) is part of the key.
+    """
+
+    def __init__(self, cache_dir):
+        """
+        :param cache_dir: The folder where cached results are stored.
+        """
+        self.cache_dir = cache_dir
+        os.makedirs(os.path.join(cache_dir, "chulls"), exist_ok=True)
+        os.makedirs(os.path.join(cache_dir, "counts"), exist_ok=True)
+
+    @staticmethod
+    def video_key(video_filename, sample_size: int = 1024 * 1024) -> str:
+        """Returns the key of a video: a hash of its size, modification time, and its first and last `sample_size`
+        bytes. Hashing the whole video would take as long as decoding it."""
+        stat = os.stat(video_filename)
+        h = hashlib.sha1("{}:{}".format(stat.st_size, stat.st_mtime_ns).encode())
+        with open(video_filename, "rb") as f:
+            h.update(f.read(sample_size))
+            if stat.st_size > sample_size:
+                f.seek(max(sample_size, stat.st_size - sample_size))
+                h.update(f.read(sample_size))
+        return h.hexdigest()
+
+    @staticmethod
+    def file_key(filename) -> str:
+        """Returns the key of a gaze file: a hash of its absolute path, size and modification time."""
+        stat = os.stat(filename)
+        return hashlib.sha1(
+            "{}:{}:{}".format(os.path.abspath(filename), stat.st_size, stat.st_mtime_ns).encode()).hexdigest()
+
+    @staticmethod
+    def files_key(filenames) -> str:
+        """Returns the key of the gaze files of a student, see `file_key()`."""
+        if isinstance(filenames, str):
+            return CueCache.file_key(filenames)
+        return hashlib.sha1(":".join(CueCache.file_key(filename) for filename in filenames).encode()).hexdigest()
+
+    @staticmethod
+    def params_key(params: dict) -> str:
+        """Returns the key of a dictionary of parameters, which must be JSON serializable."""
+        return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+    @staticmethod
+    def windows_signature(window_starts, window_ends, ordered_chulls, extra=None) -> str:
+        """Returns the signature of update windows and the convex hulls that gaze samples are assigned to.
+
+        :param window_starts: The start of each window, in seconds.
+        :param window_ends: The end of each window, in seconds.
+        :param ordered_chulls: The ordered convex hulls of each slide.
+        :param extra: Anything else (JSON serializable) that the counts depend on, e.g., the lecture id.
+        """
+        h = hashlib.sha1()
+        h.update(np.ascontiguousarray(window_starts, dtype=float).tobytes())
+        h.update(np.ascontiguousarray(window_ends, dtype=float).tobytes())
+        for chulls in ordered_chulls:
+            h.update(json.dumps([np.asarray(c, dtype=float).round(6).tolist() for c in chulls]).encode())
+        h.update(json.dumps(extra, sort_keys=True).encode())
+        return h.hexdigest()
+
+    def _chulls_filename(self, video_key, params):
+        return os.path.join(self.cache_dir, "chulls", "{}_{}.json".format(video_key, CueCache.params_key(params)))
+
+    def _counts_filename(self, student_id, file_key, signature):
+        return os.path.join(self.cache_dir, "counts", "{}_{}_{}.npz".format(student_id, file_key, signature))
+
+    def load_chulls(self, video_key, params: dict):
+        """Returns the cached slides as a list of (start, end, chull_list), or None if they are not cached.
+
+        :param video_key: See `video_key()`.
+        :param params: The parameters that the convex hulls were detected with.
+        """
+        filename = self._chulls_filename(video_key, params)
+        if not os.path.isfile(filename):
+            return None
+        with open(filename) as f:
+            slides = json.load(f)["slides"]
+        return [(slide["start"], slide["end"], slide["chull_list"]) for slide in slides]
+
+    def save_chulls(self, video_key, params: dict, all_chulls, fps):
+        """Cache the slides of a video.
+
+        :param video_key: See `video_key()`.
+        :param params: The parameters that the convex hulls were detected with.
+        :param all_chulls: A list of (start, end, chull_list), in seconds.
+        :param fps: The frames per second of the video, used to record the frame range of each slide.
+        """
+        slides = []
+        for start, end, chull_list in all_chulls:
+            slides.append({
+                "start": start,
+                "end": end,
+                "frames": [int(round(start * fps)), int(round(end * fps))],
+                "chull_list": [np.asarray(c, dtype=float).tolist() for c in chull_list],
+            })
+        self._dump_json(self._chulls_filename(video_key, params), {"params": params, "slides": slides})
+
+    def load_counts(self, student_id, file_key, signature, n_classes):
+        """Returns the cached counts of a student, or None if they are not cached.
+
+        :param student_id: The student id.
+        :param file_key: See `file_key()`.
+        :param signature: See `windows_signature()`.
+        :param n_classes: The number of AoIs in each window.
+        :return: A tuple of (sample count of each window, list of fixation counts of each window).
+        """
+        filename = self._counts_filename(student_id, file_key, signature)
+        if not os.path.isfile(filename):
+            return None
+        with np.load(filename) as data:
+            sample_count, flat_counts = data["sample_count"], data["fixation_counts"]
+        fixation_counts = np.split(flat_counts, np.cumsum(n_classes)[:-1]) if len(n_classes) > 0 else []
+        return sample_count, fixation_counts
+
+    def save_counts(self, student_id, file_key, signature, counts):
+        """Cache the counts of a student.
+
+        :param counts: A tuple of (sample count of each window, list of fixation counts of each window).
+        """
+        sample_count, fixation_counts = counts
+        flat_counts = np.concatenate(fixation_counts) if len(fixation_counts) > 0 else np.zeros((0,), dtype=int)
+        filename = self._counts_filename(student_id, file_key, signature)
+        with open(filename + ".tmp", "wb") as f:
+            np.savez(f, sample_count=sample_count, fixation_counts=flat_counts)
+        os.replace(filename + ".tmp", filename)
+
+    @staticmethod
+    def _dump_json(filename, obj):
+        with open(filename + ".tmp", "w") as f:
+            json.dump(obj, f)
+        os.replace(filename + ".tmp", filename)
@@ -0,0 +1,169 @@
+import bisect
+import json
+import os
+import re
+import threading
+
+import numpy as np
+
+from .gaze_classes import AoIWithTime
+
+_TIMING = re.compile(r"^\s*(\S+)\s+-->\s+(\S+)")
+
+SOURCES = {
+    "peer": "talk_{}.vtt",
+    "expert": "talk_{}_expert.vtt",
+}
+"""The VTT file of each source of AoIs, formatted with the lecture id. See async_cues.aoi_to_vtt()."""
+
+
+def vtt_timestamp_to_seconds(timestamp: str) -> float:
+    """
+    Converts a VTT timestamp ([hh:]mm:ss.ttt) into seconds.
+    :param timestamp: The VTT timestamp.
+    :return: Time in second.
+    """
+    seconds = 0.0
+    for part in timestamp.split(":"):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def parse_vtt(vtt_filename) -> list:
+    """
+    Read the AoIs from a VTT file generated by async_cues.aoi_to_vtt().
+    Each cue payload is a JSON object with fields `slide_id` and `aoi_list`. Other cues are skipped.
+    :param vtt_filename: The filename of the VTT file.
+    :return: A list of AoIWithTime, sorted by start.
+    """
+    with open(vtt_filename, encoding="utf-8") as f:
+        blocks = re.split(r"\n\s*\n", f.read().replace("\r\n", "\n"))
+
+    aois = []
+    for block in blocks:
+        lines = block.strip().split("\n")
+        for i, line in enumerate(lines):
+            m = _TIMING.match(line)
+            if m is None:
+                continue
+            try:
+                payload = json.loads("\n".join(lines[i + 1:]))
+                aois.append(AoIWithTime(vtt_timestamp_to_seconds(m.group(1)), vtt_timestamp_to_seconds(m.group(2)),
+                                        payload["slide_id"], payload["aoi_list"]))
+            except (ValueError, KeyError, TypeError):
+                pass
+            break
+    aois.sort(key=lambda aoi: (aoi.start, aoi.end))
+    return aois
+
+
+class LectureCues:
+    """An interval index of the AoIs of one lecture and source.
+
+    Cues are sorted by start. `max_ends[i]` is the latest end among the first i + 1 cues, so that a query can stop
+    scanning backwards as soon as no earlier cue can reach the queried time, even if cues overlap.
+    """
+
+    def __init__(self, aois: list, version: str):
+        """
+        :param aois: A list of AoIWithTime, sorted by start.
+        :param version: Identifies the content, e.g., from the modification time of the VTT file.
+        """
+        self.aois = aois
+        self.version = version
+        self.starts = [aoi.start for aoi in aois]
+        self.max_ends = np.maximum.accumulate([aoi.end for aoi in aois]).tolist() if len(aois) > 0 else []
+
+    def at(self, t: float) -> list:
+        """Returns the AoIs with start <= t < end."""
+        return self.between(t, t, inclusive_start=True)
+
+    def between(self, t0: float, t1: float, inclusive_start: bool = False) -> list:
+        """Returns the AoIs overlapping [t0, t1), in the order of start.
+
+        :param t0: The start of the range, in seconds.
+        :param t1: The end of the range, in seconds.
+        :param inclusive_start: Whether AoIs starting at t1 are included. Used for point queries (t0 == t1).
+        """
+        if inclusive_start:
+            hi = bisect.bisect_right(self.starts, t1)
+        else:
+            hi = bisect.bisect_left(self.starts, t1)
+        result = []
+        i = hi - 1
+        while i >= 0 and self.max_ends[i] > t0:
+            if self.aois[i].end > t0:
+                result.append(self.aois[i])
+            i -= 1
+        result.reverse()
+        return result
+
+
+class CueIndex:
+    """Serves AoIs precomputed by async_cues for each lecture and source ("peer", "expert").
+
+    VTT files are loaded when first queried, and reloaded when they are modified, so that cues can be updated
+    without restarting the server.
+    """
+
+    def __init__(self, assets_dir):
+        """
+        :param assets_dir: The folder where VTT files are stored.
+        """
+        self.assets_dir = assets_dir
+        # (lecture_id, source) -> LectureCues
+        self._lectures = {}
+        self._lock = threading.Lock()
+
+    def filename(self, lecture_id, source: str):
+        """Returns the filename of the VTT file of a lecture and source.
+
+        :raise ValueError: The source is unknown.
+        """
+        if source not in SOURCES:
+            raise ValueError("Invalid AoI source! Valid sources: {}, got {}".format(", ".join(SOURCES), source))
+        return os.path.join(self.assets_dir, SOURCES[source].format(int(lecture_id)))
+
+    def get(self, lecture_id, source: str) -> LectureCues:
+        """Returns the cues of a lecture and source.
+
+        :raise FileNotFoundError: The VTT file does not exist.
+        """
+        filename = self.filename(lecture_id, source)
+        stat = os.stat(filename)
+        version = "{}-{}".format(stat.st_mtime_ns, stat.st_size)
+        key = (int(lecture_id), source)
+
+        cues = self._lectures.get(key)
+        if cues is not None and cues.version == version:
+            return cues
+        with self._lock:
+            cues = self._lectures.get(key)
+            if cues is None or cues.version != version:
+                cues = LectureCues(parse_vtt(filename), version)
+                self._lectures[key] = cues
+        return cues
+
+
+def blend_aoi_list(aoi_list: list, slide_id, live_aoi_list: list, live_slide_id, weight: float) -> list:
+    """
+    Blend the AoIs of a cue with live AoIs aggregated from the students in the lecture.
+    The blend only applies when both are from the same slide and have the same number of AoIs. Otherwise, the AoIs of
+    the cue are returned unchanged.
+    :param aoi_list: The AoIs of a cue. See AoI.minimize() in gaze_classes.
+    :param slide_id: The slide id of the cue.
+    :param live_aoi_list: The live AoIs.
+    :param live_slide_id: The id of the slide that the live AoIs are detected from.
+    :param weight: The weight of the live AoIs, in [0, 1].
+    :return: The blended AoIs. Positions are those of the cue.
+    """
+    if slide_id != live_slide_id or len(aoi_list) != len(live_aoi_list) or weight <= 0:
+        return aoi_list
+    weight = min(weight, 1.0)
+    blended = []
+    for aoi, live_aoi in zip(aoi_list, live_aoi_list):
+        aoi = dict(aoi)
+        aoi["status"] = (1 - weight) * aoi["status"] + weight * live_aoi["status"]
+        aoi["percentage"] = (1 - weight) * aoi["percentage"] + weight * live_aoi["percentage"]
+        blended.append(aoi)
+    return blended
@@ -0,0 +1,176 @@
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+try:
+    from utilities.csv_logger import find_gaze_files
+except ImportError:
+    # run as a script from python/peer/gaze
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+    from utilities.csv_logger import find_gaze_files
+
+COLUMNS = {
+    "timestamp": ("timestamp", np.float64),
+    "x": ("gaze_x", np.float32),
+    "y": ("gaze_y", np.float32),
+    "width": ("client_width", np.float32),
+    "height": ("client_height", np.float32),
+}
+"""Columns of the archive: name -> (column in the gaze CSV files, dtype)."""
+
+
+class GazeSeries:
+    """The gaze of one student in one lecture, as memory-mapped columns sorted by timestamp.
+
+    A sparse index holds every `stride`-th timestamp, so a time range is located by a binary search over the index,
+    then over one block of the timestamp column. Only those pages of the column are touched.
+    """
+
+    def __init__(self, dirname):
+        """
+        :param dirname: The folder of the columns, `<root>/<stu_num>/lecture_<lecture_id>`.
+        """
+        with open(os.path.join(dirname, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.first_timestamp = self.meta["first_timestamp"]
+        self.stride = self.meta["stride"]
+        self.columns = {name: np.load(os.path.join(dirname, name + ".npy"), mmap_mode="r") for name in COLUMNS}
+        self.index = np.load(os.path.join(dirname, "index.npy"))
+
+    def __len__(self):
+        return self.columns["timestamp"].shape[0]
+
+    def locate(self, t0=None, t1=None) -> slice:
+        """Returns the slice of samples with t0 <= timestamp < t1 (timestamps in ms).
+
+        :param t0: The start of the range. Unbounded if None.
+        :param t1: The end of the range. Unbounded if None.
+        """
+        return slice(self._search(t0) if t0 is not None else 0, self._search(t1) if t1 is not None else len(self))
+
+    def _search(self, t) -> int:
+        """Returns the index of the first sample with timestamp >= t."""
+        block = max(int(np.searchsorted(self.index, t, side="left")) - 1, 0)
+        lo = block * self.stride
+        hi = min(lo + 2 * self.stride, len(self))
+        return lo + int(np.searchsorted(self.columns["timestamp"][lo:hi], t, side="left"))
+
+    def query(self, t0=None, t1=None) -> dict:
+        """Returns the samples with t0 <= timestamp < t1, as read-only views of the memory-mapped columns.
+
+        :param t0: The start of the range (ms). Unbounded if None.
+        :param t1: The end of the range (ms). Unbounded if None.
+        :return: A dictionary of column name: array. See COLUMNS.
+        """
+        s = self.locate(t0, t1)
+        return {name: column[s] for name, column in self.columns.items()}
+
+    def query_relative(self, start=None, end=None) -> dict:
+        """Same as `query()`, with the range in seconds since the first sample of the lecture.
+
+        :return: A dictionary with the columns, and relative_timestamp, gaze_x_percentage and gaze_y_percentage
+            which are computed for the range (as in async_cues.read_dataframe()).
+        """
+        samples = self.query(None if start is None else self.first_timestamp + start * 1000,
+                             None if end is None else self.first_timestamp + end * 1000)
+        samples["relative_timestamp"] = (samples["timestamp"] - self.first_timestamp) / 1000
+        samples["gaze_x_percentage"] = samples["x"] / samples["width"]
+        samples["gaze_y_percentage"] = samples["y"] / samples["height"]
+        return samples
+
+
+class GazeArchive:
+    """Per-student, per-lecture gaze converted from the CSV files for fast window queries.
+
+    The layout under the root folder is:
+    ===== =====
+    <stu_num>/lecture_<lecture_id>/<column>.npy  one file per column in COLUMNS, sorted by timestamp
+    <stu_num>/lecture_<lecture_id>/index.npy     every `stride`-th timestamp
+    <stu_num>/lecture_<lecture_id>/meta.json     number of samples, stride, first timestamp of the lecture
+    ===== =====
+    """
+
+    def __init__(self, root_dir):
+        """
+        :param root_dir: The root folder of the archive.
+        """
+        self.root_dir = root_dir
+
+    def students(self) -> list:
+        """Returns the student numbers in the archive."""
+        if not os.path.exists(self.root_dir):
+            return []
+        return sorted(name for name in os.listdir(self.root_dir) if os.path.isdir(os.path.join(self.root_dir, name)))
+
+    def lectures(self, stu_num) -> list:
+        """Returns the lecture ids (int) of a student in the archive."""
+        dirname = os.path.join(self.root_dir, str(stu_num))
+        if not os.path.exists(dirname):
+            return []
+        return sorted(int(name[len("lecture_"):]) for name in os.listdir(dirname) if name.startswith("lecture_"))
+
+    def series(self, stu_num, lecture_id) -> GazeSeries:
+        """Open the gaze of a student in a lecture.
+
+        :raise FileNotFoundError: The student has no gaze in the lecture.
+        """
+        return GazeSeries(os.path.join(self.root_dir, str(stu_num), "lecture_{}".format(int(lecture_id))))
+
+    def add_student(self, stu_num, filenames, stride: int = 4096, chunksize: int = 500000) -> int:
+        """Convert the gaze files of a student. Existing columns of the student are replaced.
+
+        :param stu_num: The student number.
+        :param filenames: The gaze files of the student, in the order they are written. See `find_gaze_files()` in
+            utilities/csv_logger.py.
+        :param stride: A timestamp of every `stride` samples is kept in the sparse index.
+        :param chunksize: The number of rows read at a time.
+        :return: The number of samples converted.
+        """
+        usecols = [source for source, _ in COLUMNS.values()] + ["lecture_id"]
+        dtypes = {source: dtype for source, dtype in COLUMNS.values()}
+        # as in async_cues.read_dataframe(), times are relative to the first row of the lecture
+        first_timestamps = {}
+        lectures = {}  # lecture_id -> {name: list of arrays}
+        for filename in filenames:
+            for chunk in pd.read_csv(filename, usecols=usecols, dtype=dtypes, chunksize=chunksize):
+                for lecture_id, lecture_chunk in chunk.groupby("lecture_id", sort=False):
+                    first_timestamps.setdefault(int(lecture_id), float(lecture_chunk["timestamp"].iloc[0]))
+                    columns = lectures.setdefault(int(lecture_id), {name: [] for name in COLUMNS})
+                    for name, (source, _) in COLUMNS.items():
+                        columns[name].append(lecture_chunk[source].to_numpy())
+
+        n_samples = 0
+        for lecture_id, columns in lectures.items():
+            dirname = os.path.join(self.root_dir, str(stu_num), "lecture_{}".format(lecture_id))
+            os.makedirs(dirname, exist_ok=True)
+            timestamp = np.concatenate(columns["timestamp"])
+            order = np.argsort(timestamp, kind="stable")
+            for name, (_, dtype) in COLUMNS.items():
+                np.save(os.path.join(dirname, name + ".npy"), np.concatenate(columns[name]).astype(dtype)[order])
+            np.save(os.path.join(dirname, "index.npy"), timestamp[order][::stride])
+            with open(os.path.join(dirname, "meta.json"), "w") as f:
+                json.dump({"n_samples": int(timestamp.shape[0]), "stride": stride,
+                           "first_timestamp": first_timestamps[lecture_id], "sources": list(filenames)}, f, indent=1)
+            n_samples += timestamp.shape[0]
+        return n_samples
+
+
+if __name__ == "__main__":
+    """Convert the gaze files written by the dedicated server into an archive.
+
+    Run from python/peer/gaze: python gaze_archive.py GAZE_DIR ARCHIVE_DIR
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Convert gaze CSV files into memory-mapped columns.")
+    parser.add_argument("gaze_dir", help="The folder of CSV files written by the dedicated server.")
+    parser.add_argument("archive_dir", help="The root folder of the archive.")
+    parser.add_argument("--stride", type=int, default=4096, help="Samples between entries of the sparse index.")
+    args = parser.parse_args()
+
+    archive = GazeArchive(args.archive_dir)
+    for stu_num, filenames in find_gaze_files(args.gaze_dir).items():
+        print(f"Student {stu_num}: {archive.add_student(stu_num, filenames, stride=args.stride)} sample(s).")
@@ -152,8 +152,14 @@ class TransitionMatrix:
 
 
 StudentInfo = namedtuple("StudentInfo", ["fixation_count", "confusion_reports",
-                                         "inattention_count", "timestamp"])
-"""Represents the information associated with a student."""
+                                         "inattention_count", "timestamp", "lecture_id", "slide_id"],
+                         defaults=(None, None))
+"""Represents the information associated with a student. `lecture_id` and `slide_id` are those of the post that
+`fixation_count` is counted from, if known."""
+
+AoIWithTime = namedtuple("AoIWithTime", ["start", "end", "slide_id", "aoi_list"])
+"""AoIs of a time range in a lecture video. `start` and `end` are in seconds, and `aoi_list` is the output of
+aoi_builder()."""
 
 
 def aoi_builder(ordered_rectangles: list, student_information: Dict[str, StudentInfo],
@@ -0,0 +1,195 @@
+"""Re-analyze the raw gaze logged in async lectures offline.
+
+Fixations are detected again with the EK detector from the raw gaze of every student, and written as columnar tables
+(one .npz per student). Students are processed in parallel by a process pool.
+
+Run from python/peer:
+    python reanalyze.py GAZE_DIR OUTPUT_DIR [--lam 3] [--workers 8] [--chulls LECTURE_ID=CHULLS_JSON ...]
+
+GAZE_DIR is the folder of CSV files written by the dedicated server, either `{stu_num}_gaze_async.csv` files or
+the partitioned layout (see CSVLogger).
+"""
+import argparse
+import bisect
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from gaze.clusterer import SaliencyClusterer
+from gaze.engbert_kliegl import EKDetector
+from utilities.csv_logger import find_gaze_files
+
+GAZE_COLUMNS = ["timestamp", "gaze_x", "gaze_y", "lecture_id", "client_width", "client_height"]
+
+FIXATION_COLUMNS = ["lecture_id", "segment", "start", "end", "duration", "x", "y", "x_percentage", "y_percentage",
+                    "n_samples", "slide_id", "aoi_id"]
+"""Columns of the fixation tables. Times are timestamps (ms), except start/end relative to the first sample of the
+student, in seconds, when AoIs are assigned. slide_id and aoi_id are -1 if AoIs are not assigned."""
+
+
+def load_chulls(chulls_filename):
+    """Load the slides cached by gaze.cue_cache.CueCache.
+
+    :return: A tuple of (starts of slides, ends of slides, list of ordered convex hulls of each slide).
+    """
+    with open(chulls_filename) as f:
+        slides = json.load(f)["slides"]
+    ordered = [SaliencyClusterer.sort_chulls_by_rectangles(slide["chull_list"])[0] for slide in slides]
+    return [slide["start"] for slide in slides], [slide["end"] for slide in slides], ordered
+
+
+def split_segments(t, max_gap):
+    """Returns the (start, end) indices of segments, split wherever two samples are more than max_gap apart."""
+    breaks = np.flatnonzero(np.diff(t) > max_gap) + 1
+    bounds = np.concatenate([[0], breaks, [t.shape[0]]])
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def reanalyze_student(stu_num, filenames, output_dir, detector_kwargs, max_gap, chulls_files, min_samples=5):
+    """Detect the fixations of a student and write them as a columnar table `{output_dir}/{stu_num}_fixations.npz`.
+
+    Runs in a worker process.
+
+    :param stu_num: The student number.
+    :param filenames: The gaze files of the student.
+    :param output_dir: The folder where tables are written.
+    :param detector_kwargs: Keyword arguments of EKDetector.detect().
+    :param max_gap: Samples more than this (ms) apart belong to different segments, which are detected separately.
+    :param chulls_files: A dictionary of lecture_id: chulls file. AoIs are assigned for these lectures.
+    :param min_samples: Segments with fewer samples are skipped. The detector needs a few samples to estimate velocity.
+    :return: A tuple of (stu_num, number of samples, number of fixations).
+    """
+    dfs = [pd.read_csv(filename, usecols=GAZE_COLUMNS, dtype={"timestamp": "float64"}) for filename in filenames]
+    df = pd.concat(dfs, ignore_index=True)
+    if df.shape[0] == 0:
+        return stu_num, 0, 0
+    # same as async_cues.read_dataframe(): the first row of the lecture
+    first_timestamps = df.groupby("lecture_id", sort=False)["timestamp"].first().to_dict()
+
+    detector = EKDetector()
+    clusterer = SaliencyClusterer("square", 20)
+    columns = {column: [] for column in FIXATION_COLUMNS}
+    for lecture_id, lecture_df in df.groupby("lecture_id", sort=True):
+        t = lecture_df["timestamp"].to_numpy(dtype=float)
+        x = lecture_df["gaze_x"].to_numpy(dtype=float)
+        y = lecture_df["gaze_y"].to_numpy(dtype=float)
+        width = lecture_df["client_width"].to_numpy(dtype=float)
+        height = lecture_df["client_height"].to_numpy(dtype=float)
+
+        fixations = []  # (segment, fixation, offset in the lecture)
+        for segment, (start, end) in enumerate(split_segments(t, max_gap)):
+            if end - start < min_samples:
+                continue
+            segment_fixations, _ = detector.detect([t[start:end], x[start:end], y[start:end]], one_shot=True,
+                                                   **detector_kwargs)
+            fixations.extend((segment, fixation, start) for fixation in segment_fixations)
+        if len(fixations) == 0:
+            continue
+
+        first = np.array([offset + fixation.indexslice[0] for _, fixation, offset in fixations])
+        n_samples = np.array([fixation.indexslice[1] - fixation.indexslice[0] for _, fixation, _ in fixations])
+        fx = np.array([fixation.x for _, fixation, _ in fixations])
+        fy = np.array([fixation.y for _, fixation, _ in fixations])
+        columns["lecture_id"].append(np.full(first.shape, lecture_id, dtype=np.int32))
+        columns["segment"].append(np.array([segment for segment, _, _ in fixations], dtype=np.int32))
+        columns["start"].append(np.array([fixation.start for _, fixation, _ in fixations], dtype=float))
+        columns["end"].append(np.array([fixation.end for _, fixation, _ in fixations], dtype=float))
+        columns["duration"].append(columns["end"][-1] - columns["start"][-1])
+        columns["x"].append(fx)
+        columns["y"].append(fy)
+        # screen size of the first sample in the fixation
+        columns["x_percentage"].append(fx / width[first])
+        columns["y_percentage"].append(fy / height[first])
+        columns["n_samples"].append(n_samples.astype(np.int32))
+
+        slide_ids = np.full(first.shape, -1, dtype=np.int32)
+        aoi_ids = np.full(first.shape, -1, dtype=np.int32)
+        if lecture_id in chulls_files:
+            starts, ends, ordered = load_chulls(chulls_files[lecture_id])
+            relative = (columns["start"][-1] - first_timestamps[lecture_id]) / 1000
+            for i, t_fixation in enumerate(relative):
+                slide_id = bisect.bisect_right(starts, t_fixation) - 1
+                if slide_id >= 0 and t_fixation < ends[slide_id]:
+                    slide_ids[i] = slide_id
+            points = np.stack([columns["x_percentage"][-1], columns["y_percentage"][-1]], axis=1)
+            for slide_id in np.unique(slide_ids[slide_ids >= 0]):
+                in_slide = slide_ids == slide_id
+                aoi_ids[in_slide] = clusterer.assign_points(points[in_slide], ordered[slide_id])
+        columns["slide_id"].append(slide_ids)
+        columns["aoi_id"].append(aoi_ids)
+
+    table = {column: np.concatenate(values) if len(values) > 0 else np.zeros((0,))
+             for column, values in columns.items()}
+    np.savez(os.path.join(output_dir, "{}_fixations.npz".format(stu_num)), **table)
+    return stu_num, df.shape[0], table["start"].shape[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Detect fixations again from the logged raw gaze.")
+    parser.add_argument("gaze_dir", help="The folder of CSV files written by the dedicated server.")
+    parser.add_argument("output_dir", help="The folder where fixation tables are written.")
+    parser.add_argument("--students", nargs="*", help="Only re-analyze these students.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="The number of processes.")
+    parser.add_argument("--max-gap", type=float, default=1000,
+                        help="Samples more than this (ms) apart are detected as separate segments.")
+    parser.add_argument("--min-samples", type=int, default=5, help="Segments with fewer samples are skipped.")
+    parser.add_argument("--chulls", nargs="*", default=[], metavar="LECTURE_ID=CHULLS_JSON",
+                        help="Assign fixations to AoIs with the slides cached by gaze/cue_cache.py.")
+    # parameters of the EK detector
+    parser.add_argument("--buf-size", type=int, default=20)
+    parser.add_argument("--lam", type=float, default=3)
+    parser.add_argument("--window", type=int, default=3)
+    parser.add_argument("--smooth-saccades", action="store_true")
+    parser.add_argument("--smooth-artifacts", action="store_true")
+    parser.add_argument("--artifact-lam", type=float, default=3)
+    args = parser.parse_args()
+
+    detector_kwargs = {
+        "buf_size": args.buf_size,
+        "lam": args.lam,
+        "window": args.window,
+        "smooth_saccades": args.smooth_saccades,
+        "smooth_artifacts": args.smooth_artifacts,
+        "artifact_lam": args.artifact_lam,
+    }
+    chulls_files = {}
+    for item in args.chulls:
+        lecture_id, filename = item.split("=", 1)
+        chulls_files[int(lecture_id)] = filename
+
+    files = find_gaze_files(args.gaze_dir, stu_nums=args.students or None)
+    os.makedirs(args.output_dir, exist_ok=True)
+    with open(os.path.join(args.output_dir, "params.json"), "w") as f:
+        json.dump({"detector": detector_kwargs, "max_gap": args.max_gap, "min_samples": args.min_samples,
+                   "chulls": chulls_files}, f, indent=1)
+
+    total_samples, total_fixations = 0, 0
+    start_time = time.time()
+    with ProcessPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        futures = {
+            executor.submit(reanalyze_student, stu_num, filenames, args.output_dir, detector_kwargs, args.max_gap,
+                            chulls_files, args.min_samples): stu_num
+            for stu_num, filenames in files.items()
+        }
+        for future in as_completed(futures):
+            try:
+                stu_num, n_samples, n_fixations = future.result()
+            except Exception as e:
+                # one broken file should not stop the batch
+                print("Student {} failed. {} : {}".format(futures[future], type(e).__name__, e))
+                continue
+            total_samples += n_samples
+            total_fixations += n_fixations
+            print("Student {}: {} sample(s), {} fixation(s).".format(stu_num, n_samples, n_fixations))
+
+    elapsed = time.time() - start_time
+    print("{} student(s), {} sample(s), {} fixation(s) in {:.1f}s: {:.0f} samples/s.".format(
+        len(files), total_samples, total_fixations, elapsed, total_samples / max(elapsed, 1e-9)))
+
+
+if __name__ == "__main__":
+    main()
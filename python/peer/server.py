@@ -1,3 +1,4 @@
+import atexit
 import json
 from logging.config import dictConfig
 import time
@@ -11,14 +12,18 @@ from flask import Flask, request
 from skimage import io as skio
 
 from gaze.clusterer import SaliencyClusterer
+from gaze.cue_index import CueIndex, blend_aoi_list
 from gaze.engbert_kliegl import EKPartialDetector
 from gaze.gaze_classes import aoi_builder, StudentInfo
 from shared_info_manager import config_client
 # for unit testing
 from utilities.dataformat import MockLock, MockValue, Record, RecordType
-from utilities.global_settings import MANAGER_HOST, MANAGER_PORT, SECRET, SERVER_PORT, APP_LOGGER_CONFIG, FILEPATH
-from utilities.server_util import b64_to_image, remove_black_margin, calculate_padding, save_screenshot, \
-    save_facial_expression
+from utilities.global_settings import MANAGER_HOST, MANAGER_PORT, SECRET, SERVER_PORT, APP_LOGGER_CONFIG, FILEPATH, \
+    CUE_ASSETS_PATH, N_IMAGE_WRITER_THREAD, IMAGE_WRITER_QUEUE_SIZE, FACIAL_EXPRESSION_STORAGE
+from utilities.frame_store import FrameStore
+from utilities.image_writer import FacialExpressionWriter, ImageFile
+from utilities.server_util import b64_to_image, remove_black_margin, calculate_padding, save_screenshot
+from utilities.stream_parser import parse_facial_expression_upload
 
 """EK detector"""
 detector = EKPartialDetector()
@@ -42,6 +47,20 @@ shared_queue = Queue()
 """Set up logger."""
 dictConfig(APP_LOGGER_CONFIG)
 app = Flask(__name__)
+"""Facial expressions are written in background threads."""
+facial_expression_writer = FacialExpressionWriter(
+    os.path.join(FILEPATH, "ai-workshop"), app.logger,
+    n_threads=N_IMAGE_WRITER_THREAD, max_queue_size=IMAGE_WRITER_QUEUE_SIZE,
+    frame_store=FrameStore(os.path.join(FILEPATH, "ai-workshop", "frames"))
+    if FACIAL_EXPRESSION_STORAGE == "segment" else None
+)
+facial_expression_writer.start()
+atexit.register(facial_expression_writer.join)  # write queued images before the worker exits
+# frames are decoded into temporary files here while the request is parsed, then renamed in place by the writer
+frame_tmp_dir = os.path.join(FILEPATH, "ai-workshop", ".incoming")
+os.makedirs(frame_tmp_dir, exist_ok=True)
+"""Visual cues of async lectures, loaded from VTT files."""
+cue_index = CueIndex(CUE_ASSETS_PATH)
 
 
 @app.route('/', methods=['GET'])
@@ -207,7 +226,9 @@ def cluster():
             fixation_count=fixation_count.tolist(),
             confusion_reports=confusion_reports,
             inattention_count=inattention_count,
-            timestamp=time.time()
+            timestamp=time.time(),
+            lecture_id=lecture_id,
+            slide_id=local_slide_id,
         )
 
         local_student_info = shared_student_info.copy()
@@ -254,13 +275,20 @@ def cluster():
     return res
 
 
+def queue_facial_expression(fields, timestamp, path):
+    """Hand a facial expression parsed from the request stream over to the writer."""
+    facial_expression_writer.submit(ImageFile(path), fields["stuNum"], fields["lectureId"], timestamp)
+
+
 @app.route('/service/workshop', methods=['POST'])
 def record():
     """Handles the information posted from each student participant.
+
+    Facial expressions are decoded and queued for writing while the request body is being parsed.
     """
     # parse request from the students
-    data = request.data  # .decode('utf-8')
-    body = json.loads(data)
+    body, _ = parse_facial_expression_upload(request.stream, queue_facial_expression,
+                                             required_keys=("stuNum", "lectureId"), tmp_dir=frame_tmp_dir)
 
     student_number = body["stuNum"]
     group_id = body["groupId"]
@@ -268,7 +296,6 @@ def record():
 
     update_counter = body["updateCounter"]
 
-    facial_expression = body["facialExpression"]
     confusion_info = body["confusion"]
     mouse_events = body["mouse_events"]
     inattention_info = body["inattention"]
@@ -306,14 +333,6 @@ def record():
             "group_id": group_id,
         }))
 
-    # save facial expressions collected
-    if len(facial_expression) > 0:
-        for r in facial_expression:
-            # record = [timestamp, b64string]
-            dirname = os.path.join(FILEPATH, "ai-workshop", str(student_number))
-            filename = f"{r[0]}_talk_{lecture_id}"
-            save_facial_expression(r[1], dirname, filename)
-
     res = flask.make_response({
         'message': "Posted information received"
     })
@@ -327,20 +346,9 @@ def record():
 
 @app.route('/service/image', methods=['POST'])
 def record_image():
-    # save facial expressions collected
-    data = request.data  # .decode('utf-8')
-    body = json.loads(data)
-
-    student_number = body["stuNum"]
-    lecture_id = body["lectureId"]
-
-    facial_expression = body["facialExpression"]
-    for r in facial_expression:
-        # record = [timestamp, b64string]
-        # print(f"Writting image {r[0]}")
-        dirname = os.path.join(FILEPATH, "ai-workshop", str(student_number))
-        filename = f"{r[0]}_talk_{lecture_id}"
-        save_facial_expression(r[1], dirname, filename)
+    # save facial expressions collected. record = [timestamp, b64string]
+    parse_facial_expression_upload(request.stream, queue_facial_expression, required_keys=("stuNum", "lectureId"),
+                                   tmp_dir=frame_tmp_dir)
 
     res = flask.make_response({
         'message': "Face screenshot received"
@@ -353,18 +361,83 @@ def record_image():
     return res
 
 
-@app.route('/service/visual_cue', methods=['POST'])
+@app.route('/service/visual_cue', methods=['GET', 'POST'])
 def get_visual_cue():
-    """Provide visual cues back to the students.
+    """Provide visual cues precomputed for async lectures back to the students.
 
-    DEPRECATED: This is not used. Visual cues are generated using VTT files.
+    Parameters are given as query arguments (GET) or in the JSON body (POST):
+    - `lectureId`: The id of the lecture.
+    - `aoiSource`: "peer" or "expert".
+    - `timestamp`: The time in the video, in seconds. Cues at this time are returned.
+    - `start` and `end`: Alternative to `timestamp`. Cues overlapping [start, end) are returned.
+    - `blend`: Optional, in [0, 1]. The weight of live AoIs aggregated from the students in the lecture,
+        which are blended into cues of the current slide (same slide id and number of AoIs).
+
+    Structure of the response body should meet:
+    - `lectureId`: The id of the lecture.
+    - `aoiSource`: The source of AoIs.
+    - `cues`: A list of cues with fields: start, end, slide_id, aoi_list.
+
+    The response carries an ETag, and 304 is returned when the cues are not changed.
     """
-    data = request.data  # .decode('utf-8')
-    body = json.loads(data)
-    aoi_source = body["aoiSource"]
-    timestamp = body["timestamp"]
+    global local_slide_id, local_chulls
+    params = {}
+    status = 200
+    try:
+        params = request.args if request.method == 'GET' else json.loads(request.data)
+        if not isinstance(params, dict):
+            raise ValueError("The body should be a JSON object.")
+        lecture_id = int(params["lectureId"])
+        aoi_source = str(params["aoiSource"]).lower()
+        if "timestamp" in params:
+            cues = cue_index.get(lecture_id, aoi_source).at(float(params["timestamp"]))
+        else:
+            cues = cue_index.get(lecture_id, aoi_source).between(float(params["start"]), float(params["end"]))
+        blend = float(params.get("blend", 0))
+    except (KeyError, TypeError, ValueError) as e:
+        status, body = 400, {'message': "Invalid request. {} : {}".format(type(e).__name__, e)}
+    except FileNotFoundError:
+        status, body = 404, {'message': "No visual cues for lecture {} ({}).".format(
+            params.get("lectureId"), params.get("aoiSource"))}
+
+    if status == 200:
+        live_aoi_list = []
+        if blend > 0:
+            with shared_lock:
+                if local_slide_id != shared_slide_id.value:
+                    local_slide_id = shared_slide_id.value
+                    local_chulls = shared_chulls[:]
+                local_student_info = shared_student_info.copy()
+            _, rectangles = clusterer.sort_chulls_by_rectangles(local_chulls)
+            # only students in this lecture who have posted since the slide changed are aggregated
+            local_student_info = {stu_num: info for stu_num, info in local_student_info.items()
+                                  if info.lecture_id is not None and str(info.lecture_id) == str(lecture_id)
+                                  and info.slide_id == local_slide_id
+                                  and len(info.fixation_count) == len(rectangles)}
+            if len(local_student_info) > 0:
+                [live_aoi_list] = aoi_builder(rectangles, local_student_info)
+
+        body = {
+            'lectureId': lecture_id,
+            'aoiSource': aoi_source,
+            'cues': [{
+                "start": cue.start,
+                "end": cue.end,
+                "slide_id": cue.slide_id,
+                "aoi_list": blend_aoi_list(cue.aoi_list, cue.slide_id, live_aoi_list, local_slide_id, blend),
+            } for cue in cues],
+        }
+
+    res = flask.make_response(body, status)
+    res.headers['Access-Control-Allow-Origin'] = '*'
+    res.headers["Access-Control-Allow-Methods"] = "GET,POST,OPTIONS"
+    res.headers["Access-Control-Allow-Headers"] = "x-api-key,Content-Type"
+    res.headers['Content-Type'] = 'application/json'
+    if status == 200:
+        res.add_etag()
+        res.make_conditional(request)
 
-    pass
+    return res
 
 
 def connect_to_shared_info_manager():
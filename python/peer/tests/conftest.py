@@ -0,0 +1,8 @@
+import os
+import sys
+
+# modules under gaze/ import each other as top-level modules (run from python/peer/gaze), others as packages
+PEER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (PEER_DIR, os.path.join(PEER_DIR, "gaze")):
+    if path not in sys.path:
+        sys.path.insert(0, path)
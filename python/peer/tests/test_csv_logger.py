@@ -0,0 +1,129 @@
+import csv
+import logging
+import os
+from types import SimpleNamespace
+
+from utilities.csv_logger import CSVLogger, find_gaze_files, last_column_value, read_manifest, select_partitions
+from utilities.dataformat import RecordType
+
+LOGGER = logging.getLogger("test")
+
+
+def _gaze_async(lecture_id, timestamps):
+    n = len(timestamps)
+    return {"gaze": {"timestamp": timestamps, "x": [1] * n, "y": [2] * n, "clientWidth": [10] * n,
+                     "clientHeight": [10] * n}, "lecture_id": lecture_id, "group_id": 0}
+
+
+def _gaze(lecture_id, n_samples, fixation_bounds):
+    body = _gaze_async(lecture_id, list(range(n_samples)))
+    body.update({
+        "fixations": [SimpleNamespace(indexslice=bounds, x=0.5, y=0.5) for bounds in fixation_bounds],
+        "aoi_ids": [0] * len(fixation_bounds),
+        "slide_id": 1,
+    })
+    return body
+
+
+def _read_rows(filename):
+    with open(filename, newline="") as f:
+        return list(csv.reader(f))
+
+
+def test_partitions_manifest_and_rotation(tmp_path):
+    logger = CSVLogger(str(tmp_path), LOGGER, partitioned=True, max_bytes=100)
+    for i in range(3):
+        logger.log(RecordType.GAZE_ASYNC, "101", _gaze_async(4, [1000 * i, 1000 * i + 1]))
+    logger.log(RecordType.GAZE_ASYNC, "102", _gaze_async(5, [7]))
+    logger.terminate()
+
+    partitions = read_manifest(str(tmp_path))
+    assert sum(p["rows"] for p in partitions if p["stu_num"] == "101") == 6
+    parts_101 = select_partitions(str(tmp_path), RecordType.GAZE_ASYNC, lecture_id=4, stu_num="101")
+    # rotated at max_bytes, in the order they are written
+    assert len(parts_101) > 1
+    assert [os.path.basename(path) for path in parts_101] == ["gaze_async.{}.csv".format(i)
+                                                             for i in range(len(parts_101))]
+    assert select_partitions(str(tmp_path), RecordType.GAZE_ASYNC, start=2000) == [parts_101[-1]]
+    rows = [row for path in parts_101 for row in _read_rows(path)[1:]]
+    assert [float(row[0]) for row in rows] == [0, 1, 1000, 1001, 2000, 2001]
+
+    assert find_gaze_files(str(tmp_path), lecture_id=4) == {"101": parts_101}
+    assert list(find_gaze_files(str(tmp_path), stu_nums=[102])) == ["102"]
+
+
+def test_find_gaze_files_of_both_layouts(tmp_path):
+    flat = CSVLogger(str(tmp_path), LOGGER)
+    flat.log(RecordType.GAZE_ASYNC, "101", _gaze_async(4, [1]))
+    flat.terminate()
+    partitioned = CSVLogger(str(tmp_path), LOGGER, partitioned=True)
+    partitioned.log(RecordType.GAZE_ASYNC, "101", _gaze_async(4, [2]))
+    partitioned.terminate()
+
+    files = find_gaze_files(str(tmp_path), lecture_id=4)["101"]
+    assert files[0] == os.path.join(str(tmp_path), "101_gaze_async.csv")
+    assert files[1:] == select_partitions(str(tmp_path), RecordType.GAZE_ASYNC)
+
+
+def test_fixation_seq_continues_across_records_and_restarts(tmp_path):
+    logger = CSVLogger(str(tmp_path), LOGGER)
+    logger.log(RecordType.GAZE, "101", _gaze(1, 6, [(0, 2), (3, 6)]))
+    logger.log(RecordType.GAZE, "101", _gaze(1, 4, [(1, 3)]))
+    logger.terminate()
+
+    rows = _read_rows(os.path.join(str(tmp_path), "101_gaze.csv"))[1:]
+    column = CSVLogger.headers[RecordType.GAZE].index("fixation_seq")
+    assert [row[column] for row in rows] == ["0", "0", "nan", "1", "1", "1", "nan", "2", "2", "nan"]
+
+    logger = CSVLogger(str(tmp_path), LOGGER)
+    logger.load_state("101")
+    assert logger.fixation_seqs["101"] == 3
+
+
+def test_fixation_seq_is_recovered_from_gaze_files(tmp_path):
+    # crashed before the state was saved on flush
+    logger = CSVLogger(str(tmp_path), LOGGER, partitioned=True)
+    logger.log(RecordType.GAZE, "101", _gaze(1, 4, [(0, 2), (2, 4)]))
+    for file_objects in logger.file_objects.values():
+        for file_object in file_objects.values():
+            file_object.close()
+    assert not os.path.exists(logger.state_filename("101"))
+
+    logger = CSVLogger(str(tmp_path), LOGGER, partitioned=True)
+    logger.load_state("101")
+    assert logger.fixation_seqs["101"] == 2
+
+
+def test_last_column_value_reads_backwards(tmp_path):
+    filename = str(tmp_path / "rows.csv")
+    with open(filename, "w") as f:
+        f.write("a,b\n")
+        for i in range(5000):
+            f.write("{},{}\n".format(i, i if i % 7 == 0 else ""))
+        f.write("5000,nan\n5001,1x")  # a partially written row
+    assert last_column_value(filename, 1, block_size=64) == 4998
+    assert last_column_value(filename, 5) is None
+
+
+def test_partitions_are_listed_before_the_first_flush(tmp_path):
+    logger = CSVLogger(str(tmp_path), LOGGER, partitioned=True)
+    logger.log(RecordType.GAZE_ASYNC, "101", _gaze_async(4, [1000, 1001]))
+    [partition] = find_gaze_files(str(tmp_path), lecture_id=4)["101"]
+    [entry] = read_manifest(str(tmp_path))
+    assert entry["open"] and entry["rows"] == 0
+
+    # an open partition is not skipped by its (outdated) time range
+    assert select_partitions(str(tmp_path), RecordType.GAZE_ASYNC, start=5000) == [partition]
+
+    # crashed: the rows which reached the file are still found
+    for file_objects in logger.file_objects.values():
+        for file_object in file_objects.values():
+            file_object.close()
+    assert [float(row[0]) for row in _read_rows(partition)[1:]] == [1000, 1001]
+
+    logger = CSVLogger(str(tmp_path), LOGGER, partitioned=True)
+    logger.log(RecordType.GAZE_ASYNC, "101", _gaze_async(4, [1002]))
+    logger.terminate()
+    [entry] = read_manifest(str(tmp_path))
+    assert not entry["open"] and entry["end"] == 1002
+    assert select_partitions(str(tmp_path), RecordType.GAZE_ASYNC, start=5000) == []
@@ -0,0 +1,61 @@
+import logging
+import os
+
+import pandas as pd
+import pytest
+
+from utilities.csv_logger_pool import CSVLoggerPool
+from utilities.dataformat import RecordType
+
+LOGGER = logging.getLogger("test")
+
+
+def _gaze_async(timestamps):
+    n = len(timestamps)
+    return {"gaze": {"timestamp": timestamps, "x": [1] * n, "y": [2] * n, "clientWidth": [10] * n,
+                     "clientHeight": [10] * n}, "lecture_id": 1, "group_id": 0}
+
+
+def test_shard_of_is_stable_and_in_range(tmp_path):
+    pool = CSVLoggerPool(str(tmp_path), LOGGER, n_shards=3)
+    shards = [pool.shard_of(stu_num) for stu_num in range(100)]
+    assert set(shards) == {0, 1, 2}
+    # the same across instances (and restarts), and for int or str student numbers
+    assert shards == [CSVLoggerPool(str(tmp_path), LOGGER, n_shards=3).shard_of(str(stu_num))
+                      for stu_num in range(100)]
+
+
+def test_records_of_a_student_are_written_in_order(tmp_path):
+    pool = CSVLoggerPool(str(tmp_path), LOGGER, n_shards=4)
+    pool.start()
+    for i in range(50):
+        for stu_num in ("101", "102", "103"):
+            pool.log(RecordType.GAZE_ASYNC, stu_num, _gaze_async([2 * i, 2 * i + 1]))
+    pool.flush()
+    for stu_num in ("101", "102", "103"):
+        df = pd.read_csv(os.path.join(str(tmp_path), "{}_gaze_async.csv".format(stu_num)))
+        assert df["timestamp"].tolist() == list(range(100))
+    # only the shard of the student has opened its files
+    shards = pool.get_status_summary()["shards"]
+    for stu_num in ("101", "102", "103"):
+        assert [stu_num in shard["writers"]["stu_nums"] for shard in shards].count(True) == 1
+        assert stu_num in shards[pool.shard_of(stu_num)]["writers"]["stu_nums"]
+    pool.terminate()
+    assert not any(process.is_alive() for process in pool.processes)
+
+
+def test_malformed_record_does_not_stop_the_shard(tmp_path):
+    pool = CSVLoggerPool(str(tmp_path), LOGGER, n_shards=1)
+    pool.start()
+    pool.log(RecordType.GAZE_ASYNC, "101", {"lecture_id": 1})
+    pool.log(RecordType.GAZE_ASYNC, "101", _gaze_async([5]))
+    pool.terminate()
+    assert pd.read_csv(os.path.join(str(tmp_path), "101_gaze_async.csv"))["timestamp"].tolist() == [5]
+
+
+def test_records_are_only_accepted_by_a_started_pool(tmp_path):
+    pool = CSVLoggerPool(str(tmp_path), LOGGER, n_shards=2)
+    with pytest.raises(RuntimeError):
+        pool.log(RecordType.GAZE_ASYNC, "101", _gaze_async([5]))
+    pool.flush()
+    pool.terminate()
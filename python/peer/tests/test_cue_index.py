@@ -0,0 +1,96 @@
+import os
+
+import pytest
+
+from gaze.cue_index import CueIndex, LectureCues, blend_aoi_list, parse_vtt, vtt_timestamp_to_seconds
+from gaze.gaze_classes import AoIWithTime
+
+VTT = """WEBVTT
+
+00:00:00.000 --> 00:00:10.000
+{"slide_id": 0, "aoi_list": [{"status": 1, "percentage": 0.5}]}
+
+NOTE not a cue
+
+00:00:05.500 --> 00:01:00.000
+{"slide_id": 1, "aoi_list": []}
+
+00:00:20.000 --> 00:00:30.000
+not json
+
+01:00:00.000 --> 01:00:01.000
+{"slide_id": 2, "aoi_list": []}
+"""
+
+
+def _lecture(*intervals):
+    return LectureCues([AoIWithTime(start, end, i, []) for i, (start, end) in enumerate(intervals)], "v")
+
+
+def _slow_between(cues, t0, t1, inclusive_start=False):
+    return [aoi for aoi in cues.aois
+            if aoi.end > t0 and (aoi.start <= t1 if inclusive_start else aoi.start < t1)]
+
+
+def test_vtt_timestamp_to_seconds():
+    assert vtt_timestamp_to_seconds("01:02.500") == 62.5
+    assert vtt_timestamp_to_seconds("01:00:02.250") == 3602.25
+
+
+def test_parse_vtt_skips_other_blocks(tmp_path):
+    filename = os.path.join(str(tmp_path), "talk_1.vtt")
+    with open(filename, "w", encoding="utf-8") as f:
+        f.write(VTT)
+    aois = parse_vtt(filename)
+    assert [(aoi.start, aoi.end, aoi.slide_id) for aoi in aois] == [(0, 10, 0), (5.5, 60, 1), (3600, 3601, 2)]
+    assert aois[0].aoi_list == [{"status": 1, "percentage": 0.5}]
+
+
+def test_at_and_between_with_overlapping_cues():
+    # a long cue overlapping shorter ones, so that max_ends must be used to stop scanning
+    cues = _lecture((0, 100), (10, 20), (15, 30), (40, 50), (50, 60), (60, 61))
+    assert [aoi.slide_id for aoi in cues.at(0)] == [0]
+    assert [aoi.slide_id for aoi in cues.at(50)] == [0, 4]
+    assert [aoi.slide_id for aoi in cues.at(100)] == []
+    assert [aoi.slide_id for aoi in cues.between(18, 40)] == [0, 1, 2]
+    for t0 in range(-5, 105, 3):
+        assert cues.at(t0) == _slow_between(cues, t0, t0, inclusive_start=True)
+        for t1 in range(t0, 110, 7):
+            assert cues.between(t0, t1) == _slow_between(cues, t0, t1)
+    assert _lecture().at(5) == []
+
+
+def test_cue_index_reloads_modified_files(tmp_path):
+    index = CueIndex(str(tmp_path))
+    with pytest.raises(FileNotFoundError):
+        index.get(1, "peer")
+    with pytest.raises(ValueError):
+        index.filename(1, "unknown")
+
+    filename = index.filename(1, "expert")
+    assert os.path.basename(filename) == "talk_1_expert.vtt"
+    with open(filename, "w", encoding="utf-8") as f:
+        f.write(VTT)
+    cues = index.get("1", "expert")
+    assert len(cues.aois) == 3
+    assert index.get(1, "expert") is cues
+
+    with open(filename, "w", encoding="utf-8") as f:
+        f.write(VTT.split("\n\n01:00:00")[0])
+    stat = os.stat(filename)
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+    reloaded = index.get(1, "expert")
+    assert reloaded is not cues
+    assert len(reloaded.aois) == 2
+
+
+def test_blend_only_live_aois_of_the_same_slide():
+    aoi_list = [{"status": 1.0, "percentage": 0.2}, {"status": 0.0, "percentage": 0.8}]
+    live_aoi_list = [{"status": 0.0, "percentage": 0.6}, {"status": 1.0, "percentage": 0.4}]
+    blended = blend_aoi_list(aoi_list, 3, live_aoi_list, 3, 0.5)
+    assert [(aoi["status"], aoi["percentage"]) for aoi in blended] == [(0.5, pytest.approx(0.4)),
+                                                                      (0.5, pytest.approx(0.6))]
+    # another slide, even with the same number of AoIs
+    assert blend_aoi_list(aoi_list, 3, live_aoi_list, 4, 0.5) is aoi_list
+    assert blend_aoi_list(aoi_list, 3, live_aoi_list[:1], 3, 0.5) is aoi_list
+    assert blend_aoi_list(aoi_list, 3, live_aoi_list, 3, 0) is aoi_list
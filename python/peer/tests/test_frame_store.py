@@ -0,0 +1,61 @@
+import os
+
+from utilities.frame_store import FrameStore, format_timestamp
+
+
+def test_duplicated_frames_are_stored_once(tmp_path):
+    store = FrameStore(str(tmp_path))
+    assert store.append_many("101", 2, [(1000, b"a" * 10), (1001.5, b"b" * 5), (1002, b"a" * 10)]) == 1
+    assert store.append_many("101", 2, [(1003, b"b" * 5), (1004, b"c")]) == 1
+
+    segment_path, _ = store.paths("101", 2)
+    assert os.path.getsize(segment_path) == 16
+    entries = store.read_index("101", 2)
+    assert [e.timestamp for e in entries] == [1000, 1001.5, 1002, 1003, 1004]
+    assert entries[0].offset == entries[2].offset and entries[1].offset == entries[3].offset
+
+    assert list(store.iter_frames("101", 2)) == [
+        (1000, b"a" * 10), (1001.5, b"b" * 5), (1002, b"a" * 10), (1003, b"b" * 5), (1004, b"c")]
+    assert list(store.iter_frames("101", 2, start=1001, end=1004, unique=True)) == [
+        (1001.5, b"b" * 5), (1002, b"a" * 10)]
+
+
+def test_digests_are_shared_across_instances(tmp_path):
+    # e.g., two gunicorn workers appending to the same segment
+    first, second = FrameStore(str(tmp_path)), FrameStore(str(tmp_path))
+    assert first.append_many("101", 1, [(1, b"x")]) == 0
+    assert second.append_many("101", 1, [(2, b"x"), (3, b"y")]) == 1
+    assert first.append_many("101", 1, [(4, b"y")]) == 1
+
+
+def test_evicted_segments_are_read_again(tmp_path):
+    store = FrameStore(str(tmp_path), max_cached_segments=2)
+    for lecture_id in range(3):
+        store.append_many("101", lecture_id, [(1, b"frame")])
+    assert list(store._digests) == [("101", "1"), ("101", "2")]
+    assert store.append_many("101", 0, [(2, b"frame")]) == 1
+    assert list(store._digests) == [("101", "2"), ("101", "0")]
+
+
+def test_export_images(tmp_path):
+    store = FrameStore(str(tmp_path / "store"))
+    store.append_many("101", 4, [(1000, b"a"), (1000.25, b"b")])
+    out_dir = tmp_path / "images"
+    assert store.export_images("101", 4, str(out_dir)) == 2
+    assert sorted(os.listdir(out_dir)) == ["1000.25_talk_4.png", "1000_talk_4.png"]
+    assert format_timestamp(1000.0) == "1000"
+    assert store.list_students() == ["101"] and store.list_lectures("101") == ["4"]
+
+
+def test_partial_entry_of_a_torn_write_is_dropped(tmp_path):
+    store = FrameStore(str(tmp_path))
+    store.append_many("101", 1, [(1, b"a"), (2, b"b")])
+    _, index_path = store.paths("101", 1)
+    with open(index_path, "ab") as f:
+        f.write(FrameStore.entry.pack(3.0, 2, 1, b"\x00" * 20)[:7])
+
+    # a new process, without cached digests
+    store = FrameStore(str(tmp_path))
+    assert store.append_many("101", 1, [(4, b"c"), (5, b"a")]) == 1
+    assert os.path.getsize(index_path) == 4 * FrameStore.entry.size
+    assert list(store.iter_frames("101", 1)) == [(1, b"a"), (2, b"b"), (4, b"c"), (5, b"a")]
@@ -0,0 +1,37 @@
+import logging
+
+import numpy as np
+
+from async_cues import read_dataframe
+from gaze_archive import GazeArchive
+from utilities.csv_logger import CSVLogger, find_gaze_files
+from utilities.dataformat import RecordType
+
+LOGGER = logging.getLogger("test")
+
+
+def _gaze_async(lecture_id, timestamps):
+    n = len(timestamps)
+    return {"gaze": {"timestamp": timestamps, "x": [1] * n, "y": [2] * n, "clientWidth": [10] * n,
+                     "clientHeight": [10] * n}, "lecture_id": lecture_id, "group_id": 0}
+
+
+def test_relative_time_starts_at_the_lecture_in_a_mixed_layout(tmp_path):
+    # an earlier lecture in the flat file, then the lecture continues in partitions
+    flat = CSVLogger(str(tmp_path), LOGGER)
+    flat.log(RecordType.GAZE_ASYNC, "101", _gaze_async(3, [0, 500]))
+    flat.log(RecordType.GAZE_ASYNC, "101", _gaze_async(4, [899000]))
+    flat.terminate()
+    partitioned = CSVLogger(str(tmp_path), LOGGER, partitioned=True)
+    partitioned.log(RecordType.GAZE_ASYNC, "101", _gaze_async(4, [900000]))
+    partitioned.terminate()
+
+    files = find_gaze_files(str(tmp_path), lecture_id=4)["101"]
+    df = read_dataframe(files, 4)
+    assert df["relative_timestamp"].tolist() == [0, 1]
+
+    archive = GazeArchive(str(tmp_path / "archive"))
+    archive.add_student("101", files)
+    samples = archive.series("101", 4).query_relative()
+    np.testing.assert_array_equal(samples["relative_timestamp"], df["relative_timestamp"].to_numpy())
+    assert archive.series("101", 3).query_relative()["relative_timestamp"].tolist() == [0, 0.5]
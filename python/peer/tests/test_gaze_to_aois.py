@@ -0,0 +1,95 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from async_cues import ChullNamedtuple, build_update_windows, count_student_gaze, gaze_to_aois
+from clusterer import SaliencyClusterer
+from gaze_classes import Gaze, StudentInfo, aoi_builder
+
+
+@pytest.fixture(scope="module")
+def clusterer():
+    return SaliencyClusterer("square", 20)
+
+
+def _square(x, y, size):
+    return np.array([[x, y], [x + size, y], [x + size, y + size], [x, y + size]], dtype=float)
+
+
+def _slides():
+    return [
+        ChullNamedtuple(0.0, 12.0, [_square(0.1, 0.1, 0.2), _square(0.6, 0.1, 0.2), _square(0.3, 0.6, 0.3)]),
+        ChullNamedtuple(12.0, 20.0, [_square(0.5, 0.5, 0.4)]),
+        ChullNamedtuple(20.0, 31.0, [_square(0.1, 0.5, 0.2), _square(0.6, 0.5, 0.2)]),
+    ]
+
+
+def _gaze_df(rng, n):
+    return pd.DataFrame({
+        "relative_timestamp": np.sort(rng.uniform(-1, 33, n)),
+        "gaze_x_percentage": rng.uniform(0, 1, n),
+        "gaze_y_percentage": rng.uniform(0, 1, n),
+    })
+
+
+def _loop_counts(all_chulls, clusterer, gaze_df, update_interval):
+    """The per-window loop replaced by the time buckets: (sample count, fixation counts) of each window."""
+    sample_count, fixation_counts = [], []
+    for chull in all_chulls:
+        ordered, _ = clusterer.sort_chulls_by_rectangles(chull.chull_list)
+        update_start = chull.start
+        while update_start < chull.end:
+            update_end = min(update_start + update_interval, chull.end)
+            in_range = gaze_df[(gaze_df["relative_timestamp"] >= update_start)
+                               & (gaze_df["relative_timestamp"] < update_end)]
+            counts = np.zeros((len(ordered),), dtype=int)
+            for x, y in zip(in_range["gaze_x_percentage"], in_range["gaze_y_percentage"]):
+                dist = [clusterer.distance_point_chull(Gaze(x, y), chull_vertices) for chull_vertices in ordered]
+                counts[dist.index(min(dist))] += 1
+            sample_count.append(in_range.shape[0])
+            fixation_counts.append(counts)
+            update_start += update_interval
+    return sample_count, fixation_counts
+
+
+def test_assign_points_matches_the_per_point_loop(clusterer):
+    rng = np.random.default_rng(0)
+    points = rng.uniform(-0.2, 1.2, (500, 2))
+    # on a shared side: ties go to the first hull
+    points[0] = (0.5, 0.5)
+    chulls = [_square(0.2, 0.2, 0.3), _square(0.5, 0.2, 0.3), _square(0.1, 0.7, 0.1)]
+    expected = [int(np.argmin([clusterer.distance_point_chull(point, chull) for chull in chulls])) for point in points]
+    assert clusterer.assign_points(points, chulls, chunk_size=64).tolist() == expected
+    assert expected[0] == 0
+    assert clusterer.assign_points(points[:3], []).tolist() == [0, 0, 0]
+
+
+def test_count_student_gaze_matches_the_per_window_loop(clusterer):
+    rng = np.random.default_rng(1)
+    all_chulls = _slides()
+    windows = build_update_windows(all_chulls, clusterer, 5)
+    for gaze_df in (_gaze_df(rng, 2000), _gaze_df(rng, 0)):
+        sample_count, fixation_counts = count_student_gaze(windows, clusterer, gaze_df)
+        expected_count, expected_fixations = _loop_counts(all_chulls, clusterer, gaze_df, 5)
+        assert sample_count.tolist() == expected_count
+        assert [counts.tolist() for counts in fixation_counts] == [counts.tolist() for counts in expected_fixations]
+
+
+def test_gaze_to_aois_matches_the_per_window_loop(clusterer):
+    rng = np.random.default_rng(1)
+    all_chulls = _slides()
+    gaze_dfs = {"1": _gaze_df(rng, 2000), "2": _gaze_df(rng, 300), "3": _gaze_df(rng, 0)}
+    aois = gaze_to_aois(all_chulls, clusterer, gaze_dfs, 5)
+    assert [(aoi.start, aoi.end, aoi.slide_id) for aoi in aois] == [
+        (0, 5, 0), (5, 10, 0), (10, 12, 0), (12, 17, 1), (17, 20, 1), (20, 25, 2), (25, 30, 2), (30, 31, 2)]
+
+    student_counts = {student_id: _loop_counts(all_chulls, clusterer, gaze_df, 5)
+                      for student_id, gaze_df in gaze_dfs.items()}
+    for window_id, aoi in enumerate(aois):
+        _, rectangles = clusterer.sort_chulls_by_rectangles(all_chulls[aoi.slide_id].chull_list)
+        student_info = {
+            student_id: StudentInfo(fixation_count=fixation_counts[window_id].astype(float).tolist(),
+                                    confusion_reports=[], inattention_count=0, timestamp=0)
+            for student_id, (sample_count, fixation_counts) in student_counts.items() if sample_count[window_id] > 0}
+        [aoi_list] = aoi_builder(rectangles, student_info)
+        assert aoi.aoi_list == aoi_list
@@ -0,0 +1,43 @@
+import logging
+import os
+
+from utilities.frame_store import FrameStore
+from utilities.image_writer import FacialExpressionWriter, ImageFile
+
+LOGGER = logging.getLogger("test")
+
+
+def _image_file(tmp_path, name, data):
+    path = str(tmp_path / name)
+    with open(path, "wb") as f:
+        f.write(data)
+    return ImageFile(path)
+
+
+def test_image_files_are_renamed_in_place(tmp_path):
+    root_dir = tmp_path / "images"
+    writer = FacialExpressionWriter(str(root_dir), LOGGER)
+    writer.submit(_image_file(tmp_path, "a.frame", b"a"), "101", 2, 1000)
+    writer.submit(b"b", "101", 2, 1001)
+    assert sorted(os.listdir(str(root_dir / "101"))) == ["1000_talk_2.png", "1001_talk_2.png"]
+    with open(str(root_dir / "101" / "1000_talk_2.png"), "rb") as f:
+        assert f.read() == b"a"
+    assert not os.path.exists(str(tmp_path / "a.frame"))
+
+
+def test_image_files_are_removed_once_stored_in_segments(tmp_path):
+    store = FrameStore(str(tmp_path / "frames"))
+    writer = FacialExpressionWriter(str(tmp_path), LOGGER, frame_store=store)
+    writer.submit(_image_file(tmp_path, "a.frame", b"a"), "101", 2, 1000)
+    assert list(store.iter_frames("101", 2)) == [(1000, b"a")]
+    assert not os.path.exists(str(tmp_path / "a.frame"))
+
+
+def test_dropped_image_files_are_removed(tmp_path):
+    writer = FacialExpressionWriter(str(tmp_path / "images"), LOGGER, max_queue_size=1)
+    # not started: fill the queue directly, as if the writer threads were busy
+    writer.threads = [None]
+    writer.submit(b"a", "101", 2, 1000)
+    writer.submit(_image_file(tmp_path, "b.frame", b"b"), "101", 2, 1001)
+    assert writer.dropped == 1
+    assert not os.path.exists(str(tmp_path / "b.frame"))
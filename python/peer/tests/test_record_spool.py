@@ -0,0 +1,92 @@
+import logging
+import os
+
+from utilities.dataformat import Record, RecordType
+from utilities.record_spool import RecordSpool, iter_records, list_segments, replay
+
+LOGGER = logging.getLogger("test")
+
+
+class _Logger:
+    def __init__(self):
+        self.records = []
+
+    def log(self, record_type, stu_num, body):
+        self.records.append((record_type, stu_num, body))
+
+
+def _records(n, stu_num="101"):
+    return [Record(type=RecordType.CONFUSION, stu_num=stu_num, body={"i": i, "lecture_id": 1}) for i in range(n)]
+
+
+def test_append_and_read_back(tmp_path):
+    spool = RecordSpool(str(tmp_path), LOGGER, fsync_interval=60)
+    for record in _records(5):
+        spool.append(record)
+    spool.commit()
+    [segment] = list_segments(str(tmp_path))
+    assert list(iter_records(segment)) == _records(5)
+    spool.close()
+
+
+def test_corrupted_or_truncated_tail_ends_the_segment(tmp_path):
+    spool = RecordSpool(str(tmp_path), LOGGER, fsync_interval=60)
+    for record in _records(3):
+        spool.append(record)
+    [segment] = spool.close()
+    size = os.path.getsize(segment)
+
+    # flip a byte of the last payload: its CRC does not match
+    with open(segment, "r+b") as f:
+        f.seek(size - 1)
+        last = f.read(1)
+        f.seek(size - 1)
+        f.write(bytes([last[0] ^ 0xFF]))
+    assert list(iter_records(segment)) == _records(2)
+
+    # a frame cut in the middle, as left by a crash while appending
+    with open(segment, "r+b") as f:
+        f.truncate(size - 3)
+    assert list(iter_records(segment)) == _records(2)
+
+
+def test_rotate_replay_and_discard(tmp_path):
+    spool = RecordSpool(str(tmp_path), LOGGER, fsync_interval=60)
+    records = _records(4)
+    spool.append(records[0])
+    spool.append(records[1])
+    sealed = spool.rotate()
+    spool.append(records[2])
+    spool.append(records[3])
+    spool.close()
+
+    # segments are replayed in the order they are written
+    logger = _Logger()
+    assert replay(str(tmp_path), logger) == 4
+    assert logger.records == [tuple(record) for record in records]
+
+    spool.discard(sealed)
+    assert [list(iter_records(path)) for path in list_segments(str(tmp_path))] == [records[2:]]
+
+
+def test_segments_of_a_previous_run_are_quarantined(tmp_path):
+    spool_dir = str(tmp_path / "spool")
+    spool = RecordSpool(spool_dir, LOGGER, fsync_interval=60)
+    spool.append(_records(1)[0])
+    [segment] = spool.close()
+
+    # left by a crashed run: moved out of the spool, so they are neither replayed into the live folder nor
+    # warned about again on the next start
+    spool = RecordSpool(spool_dir, LOGGER, fsync_interval=60)
+    [pending] = spool.pending_segments
+    assert os.path.dirname(os.path.dirname(pending)) == os.path.join(spool_dir, "quarantine")
+    assert os.path.basename(pending) == os.path.basename(segment)
+    assert list(iter_records(pending)) == _records(1)
+    spool.discard(spool.close())
+    assert list_segments(spool_dir) == []
+    spool = RecordSpool(spool_dir, LOGGER, fsync_interval=60)
+    assert spool.pending_segments == []
+    spool.close()
+
+    logger = _Logger()
+    assert replay(os.path.dirname(pending), logger) == 1
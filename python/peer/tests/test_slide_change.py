@@ -0,0 +1,27 @@
+import numpy as np
+
+from async_cues import SlideChangeDetector
+
+
+def _square(x, y, size):
+    return np.array([[x, y], [x + size, y], [x + size, y + size], [x, y + size]], dtype=float)
+
+
+def test_slide_change_detector_hysteresis():
+    detector = SlideChangeDetector(low=0.5, high=0.8)
+    slide = [_square(0.1, 0.1, 0.2), _square(0.6, 0.6, 0.2)]
+    assert not detector.update(slide)
+    # the same slide, drifted a little: the reference follows
+    drifted = [chull + 0.005 for chull in slide]
+    assert not detector.update(drifted)
+    assert detector.reference is drifted
+
+    # ambiguous: one hull moved. Still the same slide, and the reference is kept
+    ambiguous = [drifted[0], _square(0.2, 0.6, 0.2)]
+    assert not detector.update(ambiguous)
+    assert detector.reference is drifted
+
+    # a different slide
+    other = [_square(0.5, 0.1, 0.1)]
+    assert detector.update(other)
+    assert detector.reference is other
@@ -0,0 +1,77 @@
+import base64
+import io
+import json
+import os
+
+import pytest
+
+from utilities.stream_parser import parse_facial_expression_upload
+
+
+def _read_frame(path):
+    with open(path, "rb") as f:
+        image = f.read()
+    os.remove(path)
+    return image
+
+
+def _parse(body, chunk_size, tmp_dir=None, **kwargs):
+    frames = []
+    fields, n_frames = parse_facial_expression_upload(
+        io.BytesIO(body), lambda fields, timestamp, path: frames.append((dict(fields), timestamp, _read_frame(path))),
+        chunk_size=chunk_size, tmp_dir=tmp_dir, **kwargs)
+    return fields, n_frames, frames
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 64 * 1024])
+def test_frames_and_fields_match_json(chunk_size):
+    images = [bytes(range(256)) * 3, b"\x00", b"png" * 101]
+    payload = {
+        "stuNum": "101",
+        "nested": {"a": [1, {"b": "}]\\" + '"'}], "c": None},
+        "facialExpression": [[1.5 + i, base64.b64encode(image).decode()] for i, image in enumerate(images)],
+        "lectureId": 3,
+    }
+    # the client escapes slashes in base64
+    body = json.dumps(payload).replace("/", "\\/").encode()
+
+    fields, n_frames, frames = _parse(body, chunk_size)
+    assert n_frames == 3
+    assert fields == {key: value for key, value in payload.items() if key != "facialExpression"}
+    assert [(timestamp, image) for _, timestamp, image in frames] == [(1.5 + i, image) for i, image in
+                                                                      enumerate(images)]
+
+
+def test_frames_are_decoded_into_temporary_files(tmp_path):
+    paths = []
+    body = json.dumps({"stuNum": "7", "facialExpression": [[1, base64.b64encode(b"abc" * 1000).decode()]]}).encode()
+    parse_facial_expression_upload(io.BytesIO(body), lambda fields, timestamp, path: paths.append(path),
+                                   chunk_size=16, tmp_dir=str(tmp_path))
+    assert os.listdir(str(tmp_path)) == [os.path.basename(path) for path in paths]
+    assert _read_frame(paths[0]) == b"abc" * 1000
+
+
+def test_frames_before_required_keys_are_deferred(tmp_path):
+    body = json.dumps({"facialExpression": [[1, base64.b64encode(b"abc").decode()]], "stuNum": "7"}).encode()
+    _, _, frames = _parse(body, 4, tmp_dir=str(tmp_path), required_keys=("stuNum",))
+    assert frames == [({"stuNum": "7"}, 1, b"abc")]
+    assert os.listdir(str(tmp_path)) == []
+
+    # the required keys never come: the deferred frames are removed
+    body = json.dumps({"facialExpression": [[1, base64.b64encode(b"abc").decode()]]}).encode()
+    with pytest.raises(ValueError):
+        _parse(body, 4, tmp_dir=str(tmp_path), required_keys=("stuNum",))
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_empty_object_and_list():
+    assert _parse(b"{}", 2) == ({}, 0, [])
+    assert _parse(b'{"facialExpression": []}', 2) == ({}, 0, [])
+
+
+@pytest.mark.parametrize("body", [b"", b"[]", b'{"a": 1', b'{"facialExpression": [[1, "YWJj"]', b'{"a" 1}'])
+def test_malformed_body(body, tmp_path):
+    with pytest.raises(ValueError):
+        _parse(body, 3, tmp_dir=str(tmp_path), required_keys=("stuNum",))
+    # no temporary file is left behind
+    assert os.listdir(str(tmp_path)) == []
@@ -0,0 +1,34 @@
+import cv2
+import numpy as np
+import pytest
+
+from async_cues import video_to_chulls
+from clusterer import SaliencyClusterer
+
+
+@pytest.fixture(scope="module")
+def video_filename(tmp_path_factory):
+    """Two slides with blocks of text-like stripes, 12 frames each."""
+    filename = str(tmp_path_factory.mktemp("video") / "talk.avi")
+    out = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*"MJPG"), 4, (320, 180))
+    for boxes in ([(20, 20, 140, 60), (180, 100, 300, 160)], [(40, 90, 280, 150)]):
+        frame = np.full((180, 320, 3), 255, dtype=np.uint8)
+        for x0, y0, x1, y1 in boxes:
+            for y in range(y0, y1, 8):
+                cv2.rectangle(frame, (x0, y), (x1, y + 3), (0, 0, 0), -1)
+        for _ in range(12):
+            out.write(frame)
+    out.release()
+    return filename
+
+
+def test_process_pool_gives_the_same_slides(video_filename):
+    clusterer = SaliencyClusterer("square", 20)
+    expected = video_to_chulls(video_filename, clusterer, interval=2, n_workers=1)
+    actual = video_to_chulls(video_filename, clusterer, interval=2, n_workers=2)
+    assert len(expected) == 2
+    assert [(chull.start, chull.end) for chull in actual] == [(chull.start, chull.end) for chull in expected]
+    for chull, expected_chull in zip(actual, expected):
+        assert len(chull.chull_list) == len(expected_chull.chull_list)
+        for vertices, expected_vertices in zip(chull.chull_list, expected_chull.chull_list):
+            np.testing.assert_array_equal(vertices, expected_vertices)
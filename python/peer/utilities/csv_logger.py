@@ -1,6 +1,11 @@
-import os.path
-from csv import writer
-
+import datetime
+import glob
+import json
+import os
+import re
+from csv import reader, writer
+
+import numpy as np
 import pandas as pd
 
 from .dataformat import RecordType
@@ -26,6 +31,14 @@ class CSVLogger:
     ===== ===== ===== ===== ===== ===== =====
     timestamp mouse_x mouse_y slide_id aoi_id lecture_id group_id
     ===== ===== ===== ===== ===== ===== =====
+
+    By default, each student has one file per record type, `{stu_num}_{record_type}.csv`.
+    With `partitioned=True`, files are partitioned by lecture, date (when written) and student:
+    `lecture_{lecture_id}/{date}/{stu_num}/{record_type}.{part}.csv`. A new part is started once a file exceeds
+    `max_bytes`. Each student has a manifest `_manifest/{stu_num}.json` listing the partitions with their row counts
+    and time ranges. See `read_manifest()` and `select_partitions()`. A partition is added to the manifest as soon as
+    it is opened, so readers (and a restarted logger) see it even if the logger crashes before flushing. Its counts are
+    persisted on flush, so it is marked `open` until it is rotated or closed.
     """
     headers = {
         RecordType.GAZE: ["timestamp", "gaze_x", "gaze_y", "fixation_seq", "fixation_x", "fixation_y",
@@ -40,9 +53,19 @@ class CSVLogger:
         RecordType.CLICK_ASYNC: ["timestamp", "event", "mouse_x", "mouse_y", "lecture_id", "group_id"],
     }
 
-    def __init__(self, filepath, gunicorn_logger):
+    part_pattern = re.compile(r"^(\w+)\.(\d+)\.csv$")
+
+    def __init__(self, filepath, gunicorn_logger, partitioned: bool = False, max_bytes: int = None):
+        """
+        :param filepath: The folder where csv files are stored.
+        :param gunicorn_logger: The logger used to report the progress.
+        :param partitioned: Whether to partition the files by lecture, date and student.
+        :param max_bytes: The size in bytes that a partition is rotated at. Used when partitioned=True.
+        """
         self.filepath = filepath
         self.gunicorn_logger = gunicorn_logger
+        self.partitioned = partitioned
+        self.max_bytes = max_bytes
 
         if not os.path.exists(filepath):
             os.makedirs(filepath)
@@ -51,12 +74,24 @@ class CSVLogger:
         self.writers = {}
 
         self.fixation_seqs = {}
+        # students whose fixation sequence number is not persisted yet
+        self.dirty_seqs = set()
+
+        # partitioned=True only. stu_num -> {relative path of partition: entry}
+        self.manifests = {}
+        # students whose manifest is not persisted yet
+        self.dirty_manifests = set()
 
     def __call__(self, *args, **kwargs):
         self.log(*args, **kwargs)
 
     def terminate(self):
         """Terminate the logger by closing all file handlers."""
+        if self.partitioned:
+            for stu_num, file_object_dict in self.file_objects.items():
+                for file_object in file_object_dict.values():
+                    self.close_manifest_entry(stu_num, file_object)
+        self.flush()
         for file_object_dict in self.file_objects.values():
             for file_object in file_object_dict.values():
                 file_object.close()
@@ -68,10 +103,66 @@ class CSVLogger:
         self.writers = {}
 
     def flush(self):
-        """Flush all file objects."""
+        """Flush all file objects to the disk, and persist the fixation sequence numbers."""
         for file_object_dict in self.file_objects.values():
             for file_object in file_object_dict.values():
-                file_object.flush()
+                if not file_object.closed:
+                    file_object.flush()
+                    os.fsync(file_object.fileno())
+        for stu_num in list(self.dirty_seqs):
+            self.save_state(stu_num)
+        self.dirty_seqs.clear()
+        for stu_num in list(self.dirty_manifests):
+            self.save_manifest(stu_num)
+        self.dirty_manifests.clear()
+
+    def state_filename(self, stu_num):
+        """Returns the filename of the persisted state of a student."""
+        return os.path.join(self.filepath, "{}_state.json".format(stu_num))
+
+    def load_state(self, stu_num):
+        """Load the fixation sequence number of a student. Starts with 0 for new students.
+
+        The state is only saved on flush, so after a crash it can be older than the rows already written. The
+        number continues from the last fixation_seq in the student's gaze files if that is larger.
+        """
+        filename = self.state_filename(stu_num)
+        fixation_seq = 0
+        if os.path.isfile(filename):
+            with open(filename) as f:
+                fixation_seq = int(json.load(f)["fixation_seq"])
+        last_seq = self.last_fixation_seq(stu_num)
+        if last_seq is not None and last_seq + 1 > fixation_seq:
+            self.gunicorn_logger.warning("stu. #{}: fixation_seq recovered from the gaze files: {} -> {}".format(
+                stu_num, fixation_seq, last_seq + 1))
+            fixation_seq = last_seq + 1
+        self.fixation_seqs[stu_num] = fixation_seq
+
+    def gaze_filenames(self, stu_num) -> list:
+        """Returns the gaze files of a student written by this logger, in any layout."""
+        name = RecordType.GAZE.name.lower()
+        filenames = glob.glob(os.path.join(self.filepath, "lecture_*", "*", str(stu_num), "{}.*.csv".format(name)))
+        flat = os.path.join(self.filepath, "{}_{}.csv".format(stu_num, name))
+        if os.path.isfile(flat):
+            filenames.append(flat)
+        return filenames
+
+    def last_fixation_seq(self, stu_num):
+        """Returns the largest fixation_seq written in the gaze files of a student, or None if there is none."""
+        column = CSVLogger.headers[RecordType.GAZE].index("fixation_seq")
+        last_seq = None
+        for filename in self.gaze_filenames(stu_num):
+            seq = last_column_value(filename, column)
+            if seq is not None and (last_seq is None or seq > last_seq):
+                last_seq = seq
+        return last_seq
+
+    def save_state(self, stu_num):
+        """Persist the fixation sequence number of a student. The file is replaced atomically."""
+        filename = self.state_filename(stu_num)
+        with open(filename + ".tmp", "w") as f:
+            json.dump({"fixation_seq": self.fixation_seqs[stu_num]}, f)
+        os.replace(filename + ".tmp", filename)
 
     def log(self, record_type, record_stu_num, record_body):
         """Write the record into the CSV.
@@ -81,8 +172,6 @@ class CSVLogger:
         if record_stu_num not in self.writers:
             self.add_new_user(record_stu_num)
 
-        csv_writer = self.writers[record_stu_num][record_type]
-
         if record_type == RecordType.GAZE:
             # got a gaze record.
             rows = self.record_to_gaze_rows(record_stu_num, record_body)
@@ -95,17 +184,27 @@ class CSVLogger:
 
         self.gunicorn_logger.info(
             "Writing {}: stu. #{}:{} data points(s)".format(record_type.name, record_stu_num, len(rows)))
-        csv_writer.writerows(rows)
+        if self.partitioned:
+            self.write_partition(record_type, record_stu_num, record_body["lecture_id"], rows)
+        else:
+            self.writers[record_stu_num][record_type].writerows(rows)
 
     def add_new_user(self, stu_num):
         """Create new files and writer for a new user.
 
         :param stu_num: The student identification.
         """
-        self.fixation_seqs[stu_num] = 0
+        if stu_num not in self.fixation_seqs:
+            self.load_state(stu_num)
         self.file_objects[stu_num] = {}
         self.writers[stu_num] = {}
 
+        if self.partitioned:
+            # partitions are opened when written
+            if stu_num not in self.manifests:
+                self.load_manifest(stu_num)
+            return
+
         for record_type in RecordType:
             filename = os.path.join(self.filepath, "{}_{}.csv".format(stu_num, record_type.name.lower()))
             write_header = not os.path.isfile(filename)
@@ -122,6 +221,105 @@ class CSVLogger:
                 # A new file. Write the header
                 self.writers[stu_num][record_type].writerow(CSVLogger.headers[record_type])
 
+    def write_partition(self, record_type, stu_num, lecture_id, rows):
+        """Write rows to the current partition of the student, and rotate the partition if it is too large.
+
+        :param record_type: The type of record.
+        :param stu_num: The student identification.
+        :param lecture_id: The id of the lecture that rows belong to.
+        :param rows: Rows to be written.
+        """
+        today = datetime.date.today().isoformat()
+        key = (record_type, str(lecture_id), today)
+        if key not in self.writers[stu_num]:
+            self.open_partition(stu_num, key)
+        file_object = self.file_objects[stu_num][key]
+        self.writers[stu_num][key].writerows(rows)
+
+        # book-keeping in the manifest
+        entry = self.manifests[stu_num][os.path.relpath(file_object.name, self.filepath)]
+        timestamps = [row[0] for row in rows if isinstance(row[0], (int, float))]
+        if len(timestamps) > 0:
+            entry["start"] = min(timestamps) if entry["start"] is None else min(entry["start"], min(timestamps))
+            entry["end"] = max(timestamps) if entry["end"] is None else max(entry["end"], max(timestamps))
+        entry["rows"] += len(rows)
+        self.dirty_manifests.add(stu_num)
+
+        if self.max_bytes is not None and file_object.tell() >= self.max_bytes:
+            # rotate. The next write opens a new part.
+            file_object.close()
+            del self.file_objects[stu_num][key]
+            del self.writers[stu_num][key]
+            self.close_manifest_entry(stu_num, file_object)
+            self.save_manifest(stu_num)
+
+    def open_partition(self, stu_num, key):
+        """Open the last part of a partition, or a new part if the last one is full.
+
+        Partitions of the same record type and lecture written on previous days are closed.
+        """
+        record_type, lecture_id, date = key
+        for old_key in list(self.file_objects[stu_num].keys()):
+            if old_key[:2] == key[:2]:
+                old_file_object = self.file_objects[stu_num].pop(old_key)
+                old_file_object.close()
+                del self.writers[stu_num][old_key]
+                self.close_manifest_entry(stu_num, old_file_object)
+
+        dirname = os.path.join(self.filepath, "lecture_{}".format(lecture_id), date, str(stu_num))
+        os.makedirs(dirname, exist_ok=True)
+        name = record_type.name.lower()
+        parts = [int(m.group(2)) for m in map(CSVLogger.part_pattern.match, os.listdir(dirname))
+                 if m is not None and m.group(1) == name]
+        part = max(parts, default=0)
+        filename = os.path.join(dirname, "{}.{}.csv".format(name, part))
+        if self.max_bytes is not None and os.path.isfile(filename) and os.path.getsize(filename) >= self.max_bytes:
+            filename = os.path.join(dirname, "{}.{}.csv".format(name, part + 1))
+
+        write_header = not os.path.isfile(filename)
+        file_object = open(file=filename, mode="a", newline="")
+        self.file_objects[stu_num][key] = file_object
+        self.writers[stu_num][key] = writer(file_object)
+        if write_header:
+            self.writers[stu_num][key].writerow(CSVLogger.headers[record_type])
+
+        # listed before any row is written, so that the partition is found after a crash
+        entry = self.manifests[stu_num].setdefault(os.path.relpath(filename, self.filepath), {
+            "stu_num": str(stu_num), "record_type": name, "lecture_id": str(lecture_id),
+            "date": date, "rows": 0, "start": None, "end": None,
+        })
+        entry["open"] = True
+        self.save_manifest(stu_num)
+        self.dirty_manifests.discard(stu_num)
+
+    def close_manifest_entry(self, stu_num, file_object):
+        """Mark the manifest entry of a closed partition as complete. Persisted with the manifest."""
+        entry = self.manifests[stu_num].get(os.path.relpath(file_object.name, self.filepath))
+        if entry is not None and entry.get("open", False):
+            entry["open"] = False
+            self.dirty_manifests.add(stu_num)
+
+    def manifest_filename(self, stu_num):
+        """Returns the filename of the manifest of a student."""
+        return os.path.join(self.filepath, "_manifest", "{}.json".format(stu_num))
+
+    def load_manifest(self, stu_num):
+        """Load the manifest of a student. Starts with an empty one for new students."""
+        filename = self.manifest_filename(stu_num)
+        if os.path.isfile(filename):
+            with open(filename) as f:
+                self.manifests[stu_num] = json.load(f)
+        else:
+            self.manifests[stu_num] = {}
+
+    def save_manifest(self, stu_num):
+        """Persist the manifest of a student. The file is replaced atomically."""
+        filename = self.manifest_filename(stu_num)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename + ".tmp", "w") as f:
+            json.dump(self.manifests[stu_num], f, indent=1)
+        os.replace(filename + ".tmp", filename)
+
     def record_to_gaze_rows(self, record_stu_num, record_body) -> list:
         """Convert gaze record body to rows of csv files.
 
@@ -135,33 +333,44 @@ class CSVLogger:
             4. `lecture_id`: The id of current lecture.
             5. `group_id`: The id of the group that the student is assigned to.
             6. `aoi_ids`: A list of the classification result of fixations w.r.t. AoIs.
+        Fixations are numbered by `fixation_seq`, continuing from the previous record of the student.
         :return: A list of rows in the csv file with the following fields:
             (Note that the slide_id is associated with gaze, while the aoi_id is associated with fixations.)
             ===== ===== ===== ===== ===== ===== ===== ===== ===== ===== ===== =====
             timestamp gaze_x gaze_y fixation_seq fixation_x fixation_y slide_id aoi_id lecture_id group_id client_width client_height
             ===== ===== ===== ===== ===== ===== ===== ===== ===== ===== ===== =====
         """
-        df = pd.DataFrame(columns=CSVLogger.headers[RecordType.GAZE])
-
-        df["timestamp"] = record_body["gaze"]["timestamp"]
-        df["gaze_x"] = record_body["gaze"]["x"]
-        df["gaze_y"] = record_body["gaze"]["y"]
-        df["client_width"] = record_body["gaze"]["clientWidth"]
-        df["client_height"] = record_body["gaze"]["clientHeight"]
-
-        aoi_ids = record_body["aoi_ids"]
-        for i, fixation in enumerate(record_body["fixations"]):
-            fixation_loc_slice = range(*fixation.indexslice)
-            df.loc[fixation_loc_slice, "fixation_seq"] = self.fixation_seqs[record_stu_num]
-            df.loc[fixation_loc_slice, "fixation_x"] = fixation.x
-            df.loc[fixation_loc_slice, "fixation_y"] = fixation.y
-            df.loc[fixation_loc_slice, "aoi_id"] = aoi_ids[i]
-
-        df["slide_id"] = record_body["slide_id"]
-        df["lecture_id"] = record_body["lecture_id"]
-        df["group_id"] = record_body["group_id"]
-
-        return df.values.tolist()
+        gaze = record_body["gaze"]
+        n_rows = len(gaze["timestamp"])
+        rows = np.full((n_rows, len(CSVLogger.headers[RecordType.GAZE])), np.nan, dtype=object)
+
+        rows[:, 0] = gaze["timestamp"]
+        rows[:, 1] = gaze["x"]
+        rows[:, 2] = gaze["y"]
+        rows[:, 6] = record_body["slide_id"]
+        rows[:, 8] = record_body["lecture_id"]
+        rows[:, 9] = record_body["group_id"]
+        rows[:, 10] = gaze["clientWidth"]
+        rows[:, 11] = gaze["clientHeight"]
+
+        fixations = record_body["fixations"]
+        if len(fixations) > 0:
+            # gaze row indices of each fixation, and the fixation each of these rows belongs to
+            bounds = np.array([fixation.indexslice for fixation in fixations], dtype=int).reshape(-1, 2)
+            lengths = bounds[:, 1] - bounds[:, 0]
+            fixation_index = np.repeat(np.arange(len(fixations)), lengths)
+            row_index = np.repeat(bounds[:, 0] - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+            seq_offset = self.fixation_seqs[record_stu_num]
+            rows[row_index, 3] = seq_offset + fixation_index
+            rows[row_index, 4] = np.array([fixation.x for fixation in fixations], dtype=object)[fixation_index]
+            rows[row_index, 5] = np.array([fixation.y for fixation in fixations], dtype=object)[fixation_index]
+            rows[row_index, 7] = np.array(record_body["aoi_ids"], dtype=object)[fixation_index]
+
+            self.fixation_seqs[record_stu_num] = seq_offset + len(fixations)
+            self.dirty_seqs.add(record_stu_num)
+
+        return rows.tolist()
 
     @staticmethod
     def record_to_async_gaze_rows(record_body) -> list:
@@ -233,4 +442,125 @@ class CSVLogger:
         for record in record_body[record_name]:
             # print(record)
             result.append(record + [lecture_id, group_id])
-        return result
\ No newline at end of file
+        return result
+
+
+def last_column_value(filename, column: int, block_size: int = 65536):
+    """Returns the value (int) of a column in the last row of a CSV file where it is not empty, or None.
+
+    The file is read backwards in blocks, so only its tail is read in general. Rows that cannot be parsed, e.g., a
+    partially written last row, are skipped.
+    """
+    with open(filename, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        size = block_size
+        while True:
+            start = max(end - size, 0)
+            f.seek(start)
+            lines = f.read(end - start).decode("utf-8", errors="replace").splitlines()
+            if start > 0:
+                # the first line is likely incomplete
+                lines = lines[1:]
+            for row in reader(reversed(lines)):
+                if len(row) <= column or row[column] in ("", "nan"):
+                    continue
+                try:
+                    return int(float(row[column]))
+                except ValueError:
+                    continue
+            if start == 0:
+                return None
+            size *= 2
+
+
+def read_manifest(filepath) -> list:
+    """Read the manifests of all students written by a partitioned CSVLogger.
+
+    :param filepath: The folder where csv files are stored.
+    :return: A list of partitions. Each is a dictionary with fields: path (absolute), stu_num, record_type,
+        lecture_id, date, rows, start and end (the range of timestamps), and open. The rows and time range of an open
+        partition are as of the last flush, and rows may have been written since.
+    """
+    manifest_dir = os.path.join(filepath, "_manifest")
+    if not os.path.exists(manifest_dir):
+        return []
+    partitions = []
+    for filename in sorted(os.listdir(manifest_dir)):
+        if not filename.endswith(".json"):
+            continue
+        with open(os.path.join(manifest_dir, filename)) as f:
+            manifest = json.load(f)
+        for path, entry in manifest.items():
+            partitions.append(dict(entry, path=os.path.join(filepath, path)))
+    return partitions
+
+
+def select_partitions(filepath, record_type=None, lecture_id=None, stu_num=None, start=None, end=None) -> list:
+    """Returns the paths of the partitions which match all specified conditions.
+
+    :param filepath: The folder where csv files are stored.
+    :param record_type: A RecordType.
+    :param lecture_id: The id of the lecture.
+    :param stu_num: The student identification.
+    :param start: Partitions which only contain rows with timestamp < start are skipped.
+    :param end: Partitions which only contain rows with timestamp >= end are skipped.
+    Open partitions are not skipped by time, since their time range may be outdated.
+    :return: A list of paths, ordered by student, date and part.
+    """
+    selected = []
+    for entry in read_manifest(filepath):
+        if record_type is not None and entry["record_type"] != record_type.name.lower():
+            continue
+        if lecture_id is not None and entry["lecture_id"] != str(lecture_id):
+            continue
+        if stu_num is not None and entry["stu_num"] != str(stu_num):
+            continue
+        if not entry.get("open", False):
+            if start is not None and entry["end"] is not None and entry["end"] < start:
+                continue
+            if end is not None and entry["start"] is not None and entry["start"] >= end:
+                continue
+        selected.append(entry["path"])
+
+    def order(path):
+        m = CSVLogger.part_pattern.match(os.path.basename(path))
+        return os.path.dirname(path), int(m.group(2)) if m is not None else 0
+    return sorted(selected, key=order)
+
+
+def find_student_files(filepath, record_type, lecture_id=None, stu_nums=None) -> dict:
+    """Returns the CSV files of each student for a record type, in either layout.
+
+    Partitions are taken from the manifests (see `select_partitions()`), which list a partition as soon as it is
+    opened. `{stu_num}_{record_type}.csv` files are included too; they hold all lectures of a student, so rows of
+    other lectures still have to be filtered out by the reader.
+    :param filepath: The folder where csv files are stored.
+    :param record_type: A RecordType.
+    :param lecture_id: Only partitions of this lecture are returned, if specified.
+    :param stu_nums: Only files of these students are returned, if specified.
+    :return: A dictionary of stu_num (str): list of paths, the flat file first, then partitions ordered by lecture,
+        date and part.
+    """
+    stu_nums = None if stu_nums is None else {str(stu_num) for stu_num in stu_nums}
+    files = {}
+    suffix = "_{}.csv".format(record_type.name.lower())
+    if os.path.exists(filepath):
+        for filename in sorted(os.listdir(filepath)):
+            if filename.endswith(suffix):
+                stu_num = filename[:-len(suffix)]
+                if stu_nums is None or stu_num in stu_nums:
+                    files.setdefault(stu_num, []).append(os.path.join(filepath, filename))
+    for path in select_partitions(filepath, record_type, lecture_id=lecture_id):
+        stu_num = os.path.basename(os.path.dirname(path))
+        if stu_nums is None or stu_num in stu_nums:
+            files.setdefault(stu_num, []).append(path)
+    return files
+
+
+def find_gaze_files(filepath, lecture_id=None, stu_nums=None) -> dict:
+    """Returns the async gaze files of each student. See `find_student_files()`.
+
+    Used by the offline tools (gaze/async_cues.py, gaze/gaze_archive.py and reanalyze.py).
+    """
+    return find_student_files(filepath, RecordType.GAZE_ASYNC, lecture_id=lecture_id, stu_nums=stu_nums)
@@ -0,0 +1,146 @@
+import multiprocessing
+import signal
+import threading
+import zlib
+
+from .csv_logger import CSVLogger
+
+
+class CSVLoggerPool:
+    """Materialize records with a pool of CSV loggers, each running in its own process.
+
+    Converting records to rows with pandas and formatting them with csv hold the GIL, so shards are processes in
+    order to use several cores. Every shard owns a private CSVLogger (thus its own file handles and fixation
+    sequence counters) and a private queue. Records are routed to shards by hashing the student number, so all
+    records of one student are written by the same shard in the order they are received.
+
+    `start()` forks the shard processes. It must be called before the server starts other threads (the record
+    spool, the dispatcher, the timeloop), as forking a process with running threads may deadlock the children.
+    """
+    _FLUSH = "flush"
+    _STOP = "stop"
+    _STATUS = "status"
+
+    def __init__(self, filepath, gunicorn_logger, n_shards: int = 2, **logger_kwargs):
+        """Configure the shards. Processes are started by `start()`.
+
+        :param filepath: The folder where csv files are stored.
+        :param gunicorn_logger: The logger used to report the progress.
+        :param n_shards: The number of shards (processes).
+        :param logger_kwargs: Passed to every CSVLogger, e.g., partitioned and max_bytes.
+        """
+        self.filepath = filepath
+        self.gunicorn_logger = gunicorn_logger
+        self.n_shards = max(1, int(n_shards))
+        self.logger_kwargs = logger_kwargs
+
+        self.queues = []
+        self.replies = []
+        self.processes = []
+        # control commands of different threads (timeloop, exit handler) are not interleaved
+        self._control_lock = threading.Lock()
+        self._started = False
+
+    def __call__(self, *args, **kwargs):
+        self.log(*args, **kwargs)
+
+    def start(self):
+        """Fork all shard processes."""
+        if self._started:
+            return
+        context = multiprocessing.get_context("fork")
+        self.queues = [context.Queue() for _ in range(self.n_shards)]
+        self.replies = [context.Queue() for _ in range(self.n_shards)]
+        self.processes = [
+            context.Process(target=self._consume, args=(shard,), name="csv-logger-{}".format(shard), daemon=True)
+            for shard in range(self.n_shards)
+        ]
+        for process in self.processes:
+            process.start()
+        self._started = True
+
+    def shard_of(self, stu_num) -> int:
+        """Returns the shard responsible for the student. The hash is stable across restarts."""
+        return zlib.crc32(str(stu_num).encode("utf-8")) % self.n_shards
+
+    def log(self, record_type, record_stu_num, record_body):
+        """Hand the record over to the shard of the student. Same arguments as `CSVLogger.log()`.
+
+        :raise RuntimeError: The pool is not started.
+        """
+        if not self._started:
+            raise RuntimeError("CSVLoggerPool is not started.")
+        self.queues[self.shard_of(record_stu_num)].put((record_type, record_stu_num, record_body))
+
+    def flush(self):
+        """Flush all file objects. Each shard flushes its own files once previously queued records are written.
+
+        Blocks until all shards are flushed.
+        """
+        self._broadcast(CSVLoggerPool._FLUSH)
+
+    def terminate(self):
+        """Write the queued records, close all file handlers and stop the shard processes."""
+        if not self._started:
+            return
+        self._broadcast(CSVLoggerPool._STOP)
+        for process in self.processes:
+            process.join()
+        for shard_queue in self.queues + self.replies:
+            shard_queue.close()
+        self._started = False
+
+    def _broadcast(self, command) -> list:
+        """Send a control command to all shards and wait until they are processed.
+
+        :return: The reply of each shard.
+        """
+        if not self._started:
+            return []
+        with self._control_lock:
+            for shard_queue in self.queues:
+                shard_queue.put((command,))
+            return [reply.get() for reply in self.replies]
+
+    def _consume(self, shard: int):
+        """The loop of a shard process. Only this process has a CSVLogger for the students of the shard."""
+        # the parent terminates the shards on SIGINT, after the queued records are handed over
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        csv_logger = CSVLogger(self.filepath, self.gunicorn_logger, **self.logger_kwargs)
+        shard_queue, reply = self.queues[shard], self.replies[shard]
+        while True:
+            item = shard_queue.get()
+            if len(item) == 1:
+                # control command
+                [command] = item
+                result = None
+                try:
+                    if command == CSVLoggerPool._FLUSH:
+                        csv_logger.flush()
+                    elif command == CSVLoggerPool._STATUS:
+                        result = csv_logger.get_status_summary()
+                    elif command == CSVLoggerPool._STOP:
+                        csv_logger.terminate()
+                except Exception as e:
+                    self.gunicorn_logger.error("csv_logger shard #{}: {} failed. {} : {}".format(
+                        shard, command, type(e).__name__, e))
+                finally:
+                    reply.put(result)
+                if command == CSVLoggerPool._STOP:
+                    return
+            else:
+                try:
+                    csv_logger.log(*item)
+                except Exception as e:
+                    # one malformed record should not stop the shard
+                    self.gunicorn_logger.error("csv_logger shard #{}: {} : {}".format(shard, type(e).__name__, e))
+
+    def get_status_summary(self):
+        """Returns a dictionary of the current status of all CSV loggers in the pool."""
+        return {
+            "filepath": self.filepath,
+            "n_shards": self.n_shards,
+            "queue_sizes": [q.qsize() for q in self.queues],
+            "alive": [process.is_alive() for process in self.processes],
+            "shards": self._broadcast(CSVLoggerPool._STATUS),
+        }
@@ -0,0 +1,204 @@
+import fcntl
+import hashlib
+import mmap
+import os
+import re
+import struct
+import threading
+from collections import OrderedDict, namedtuple
+
+FrameEntry = namedtuple("FrameEntry", ["timestamp", "offset", "length", "digest"])
+"""Describes one frame in a segment. `timestamp` is a float, as posted by the client (ms). `digest` is the sha1 of the
+image bytes."""
+
+
+def format_timestamp(timestamp: float) -> str:
+    """Formats a timestamp as in the filenames of individual images: without a fraction if it is a whole number."""
+    return str(int(timestamp)) if float(timestamp).is_integer() else repr(float(timestamp))
+
+
+class FrameStore:
+    """Packs the facial expressions of each student and lecture into one segment file with an offset index.
+
+    The layout under the root folder is:
+    ===== =====
+    <stu_num>/talk_<lecture_id>.frames  image bytes (PNG) appended back to back
+    <stu_num>/talk_<lecture_id>.index   one fixed-size entry per frame: timestamp, offset, length, sha1
+    ===== =====
+
+    Frames with the same content are stored once; their index entries point to the same offset.
+    Segments are append-only, so appends from several gunicorn workers are serialized with a file lock on the index,
+    and each process keeps a cache of the digests it has seen, for the `max_cached_segments` segments most recently
+    appended to. An evicted segment is read again from its index on its next append.
+    """
+    entry = struct.Struct("<dQI20s")
+    segment_pattern = re.compile(r"^talk_(.+)\.index$")
+
+    def __init__(self, root_dir, max_cached_segments: int = 64):
+        """
+        :param root_dir: The root folder of all segments.
+        :param max_cached_segments: The number of segments whose digests are cached.
+        """
+        self.root_dir = root_dir
+        self.max_cached_segments = max(1, int(max_cached_segments))
+        # (stu_num, lecture_id) -> [digest -> (offset, length), bytes of index consumed], least recently used first
+        self._digests = OrderedDict()
+        self._digests_lock = threading.Lock()
+        # (stu_num, lecture_id) -> lock. Threads of this process append to a segment one at a time.
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def paths(self, stu_num, lecture_id):
+        """Returns the paths of the segment and the index of a student and lecture."""
+        dirname = os.path.join(self.root_dir, str(stu_num))
+        return (os.path.join(dirname, f"talk_{lecture_id}.frames"),
+                os.path.join(dirname, f"talk_{lecture_id}.index"))
+
+    def append_many(self, stu_num, lecture_id, frames, fsync: bool = True):
+        """Append frames of one student and lecture.
+
+        :param stu_num: The student number.
+        :param lecture_id: The id of the lecture.
+        :param frames: A list of (timestamp, image bytes).
+        :param fsync: Whether to fsync the segment and index before returning.
+        :return: The number of frames whose content is already stored.
+        """
+        segment_path, index_path = self.paths(stu_num, lecture_id)
+        os.makedirs(os.path.dirname(segment_path), exist_ok=True)
+        key = (str(stu_num), str(lecture_id))
+
+        duplicated = 0
+        with self._segment_lock(key), \
+                open(index_path, "a+b") as index_file, open(segment_path, "ab") as segment_file:
+            fcntl.flock(index_file.fileno(), fcntl.LOCK_EX)
+            try:
+                # a torn write (e.g., a crash while appending) leaves a partial entry, which would misalign
+                # every entry appended after it
+                size = index_file.seek(0, os.SEEK_END)
+                if size % FrameStore.entry.size != 0:
+                    index_file.truncate(size - size % FrameStore.entry.size)
+                digests = self._refresh_digests(key, index_file)
+
+                segment_file.seek(0, os.SEEK_END)
+                offset = segment_file.tell()
+                entries = []
+                for timestamp, image in frames:
+                    digest = hashlib.sha1(image).digest()
+                    if digest in digests:
+                        duplicated += 1
+                        frame_offset, length = digests[digest]
+                    else:
+                        segment_file.write(image)
+                        frame_offset, length = offset, len(image)
+                        offset += length
+                        digests[digest] = (frame_offset, length)
+                    entries.append(FrameStore.entry.pack(float(timestamp), frame_offset, length, digest))
+
+                # the segment must hold the bytes before the index refers to them
+                segment_file.flush()
+                if fsync:
+                    os.fsync(segment_file.fileno())
+                index_file.seek(0, os.SEEK_END)
+                index_file.write(b"".join(entries))
+                index_file.flush()
+                if fsync:
+                    os.fsync(index_file.fileno())
+                self._cache_digests(key, digests, index_file.tell())
+            finally:
+                fcntl.flock(index_file.fileno(), fcntl.LOCK_UN)
+        return duplicated
+
+    def _segment_lock(self, key):
+        """Returns the lock of a segment in this process."""
+        with self._locks_lock:
+            if key not in self._locks:
+                self._locks[key] = threading.Lock()
+            return self._locks[key]
+
+    def _refresh_digests(self, key, index_file):
+        """Read the index entries appended since the last call (possibly by other processes)."""
+        with self._digests_lock:
+            digests, consumed = self._digests.pop(key, ({}, 0))
+
+        index_file.seek(consumed)
+        data = index_file.read()
+        n_entries = len(data) // FrameStore.entry.size
+        for i in range(n_entries):
+            _, offset, length, digest = FrameStore.entry.unpack_from(data, i * FrameStore.entry.size)
+            digests.setdefault(digest, (offset, length))
+        self._cache_digests(key, digests, consumed + n_entries * FrameStore.entry.size)
+        return digests
+
+    def _cache_digests(self, key, digests, consumed):
+        """Cache the digests of a segment as the most recently used, evicting the least recently used ones."""
+        with self._digests_lock:
+            self._digests[key] = (digests, consumed)
+            self._digests.move_to_end(key)
+            while len(self._digests) > self.max_cached_segments:
+                self._digests.popitem(last=False)
+
+    def list_students(self):
+        """Returns the student numbers which have frames stored."""
+        if not os.path.exists(self.root_dir):
+            return []
+        return sorted(name for name in os.listdir(self.root_dir)
+                      if os.path.isdir(os.path.join(self.root_dir, name)))
+
+    def list_lectures(self, stu_num):
+        """Returns the ids of lectures (as strings) which the student has frames stored."""
+        dirname = os.path.join(self.root_dir, str(stu_num))
+        if not os.path.exists(dirname):
+            return []
+        matches = [FrameStore.segment_pattern.match(name) for name in os.listdir(dirname)]
+        return sorted(m.group(1) for m in matches if m is not None)
+
+    def read_index(self, stu_num, lecture_id):
+        """Returns the list of FrameEntry of a student and lecture, in the order they were appended."""
+        _, index_path = self.paths(stu_num, lecture_id)
+        if not os.path.exists(index_path):
+            return []
+        with open(index_path, "rb") as f:
+            data = f.read()
+        n_entries = len(data) // FrameStore.entry.size
+        return [FrameEntry(*FrameStore.entry.unpack_from(data, i * FrameStore.entry.size)) for i in range(n_entries)]
+
+    def iter_frames(self, stu_num, lecture_id, start=None, end=None, unique: bool = False):
+        """Iterate over the frames of a student and lecture.
+
+        :param stu_num: The student number.
+        :param lecture_id: The id of the lecture.
+        :param start: Only frames with timestamp >= start are returned, if specified.
+        :param end: Only frames with timestamp < end are returned, if specified.
+        :param unique: Whether to skip frames whose content is the same as an earlier frame.
+        :return: A generator of (timestamp, image bytes).
+        """
+        entries = self.read_index(stu_num, lecture_id)
+        if len(entries) == 0:
+            return
+        segment_path, _ = self.paths(stu_num, lecture_id)
+        with open(segment_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as segment:
+            seen = set()
+            for e in entries:
+                if start is not None and e.timestamp < start:
+                    continue
+                if end is not None and e.timestamp >= end:
+                    continue
+                if unique:
+                    if e.digest in seen:
+                        continue
+                    seen.add(e.digest)
+                yield e.timestamp, segment[e.offset:e.offset + e.length]
+
+    def export_images(self, stu_num, lecture_id, out_dir):
+        """Write the frames back as individual images named `{timestamp}_talk_{lecture_id}.png`, as written by
+        FacialExpressionWriter in "png" mode.
+
+        :return: The number of images written.
+        """
+        os.makedirs(out_dir, exist_ok=True)
+        count = 0
+        for timestamp, image in self.iter_frames(stu_num, lecture_id):
+            with open(os.path.join(out_dir, f"{format_timestamp(timestamp)}_talk_{lecture_id}.png"), "wb") as f:
+                f.write(image)
+            count += 1
+        return count
@@ -14,6 +14,19 @@ else:
     """The domain name is defined in /deployment/py-deployment-dedicated.yaml"""
 
 CSVLOGPATH = os.path.join(FILEPATH, "ai-workshop")
+CSVLOG_PARTITIONED = False
+"""Whether CSV files are partitioned by lecture, date and student (`lecture_{id}/{date}/{stu_num}/{type}.{part}.csv`).
+Otherwise, each student has one file per record type (`{stu_num}_{type}.csv`).
+Before turning it on, make sure the consumers of the CSV files find partitions, e.g., with
+`csv_logger.find_student_files()` (used by the offline tools under gaze/ and reanalyze.py). Files written before stay
+in the per-student layout and are still found by those functions, so existing data does not need to be converted."""
+CSVLOG_MAX_BYTES = 64 * 1024 * 1024
+"""Size in bytes that a partitioned CSV file is rotated at."""
+CUE_ASSETS_PATH = os.path.join(FILEPATH, "assets")
+"""Where VTT files of visual cues are stored (`talk_{id}.vtt` for peers, `talk_{id}_expert.vtt` for experts)."""
+SPOOLPATH = os.path.join(CSVLOGPATH, "spool")
+SPOOL_FSYNC_INTERVAL = 0.2
+"""Interval of group commits (fsync) of the record spool in the dedicated server, in seconds."""
 
 MANAGER_PORT = 12580
 SECRET = b"cogteach"
@@ -22,6 +35,16 @@ SERVER_PORT = 5000
 DEDICATED_SERVER_PORT = 9000
 
 N_LOGGER_THREAD = 2
+"""Number of CSV logger shards (processes) in the dedicated server. Records are sharded by student number."""
+
+N_IMAGE_WRITER_THREAD = 2
+"""Number of threads writing facial expressions in each server worker."""
+IMAGE_WRITER_QUEUE_SIZE = 256
+"""Maximum number of facial expressions waiting to be written in each server worker. Further frames are dropped."""
+FACIAL_EXPRESSION_STORAGE = "png"
+"""How facial expressions are stored. "png": one file per image, `ai-workshop/<stu_num>/<timestamp>_talk_<id>.png`.
+"segment": packed per student and lecture under `ai-workshop/frames` (see utilities/frame_store.py). Tools that read
+the PNG files do not read segments; convert them back with `FrameStore.export_images()` before using those tools."""
 
 
 def get_filename(server_type: str):
@@ -0,0 +1,229 @@
+import base64
+import os
+import queue
+import threading
+from collections import namedtuple
+from threading import Thread
+
+ImageFile = namedtuple("ImageFile", ["path"])
+"""A decoded image in a temporary file, e.g., written by parse_facial_expression_upload(). The writer renames it into
+place, or removes it once it is stored in a segment or dropped."""
+
+
+class FacialExpressionWriter:
+    """Write facial expressions posted by students to the drive in background threads.
+
+    Requests only enqueue the base64 strings (or decoded bytes, or ImageFiles). Worker threads decode the images and
+    write them in batches with one of the following storages:
+    - "png": one image per file, `<root_dir>/<stu_num>/<timestamp>_talk_<lecture_id>.png`. Images are written to
+      temporary files, fsynced together and renamed in place, so that readers never see partially written images.
+    - "segment": images are packed into per-student, per-lecture segments. See FrameStore.
+    Folders known to exist are cached. A frame that fails to be decoded or written is logged and skipped, the rest
+    of its batch is still written. When the queue is full, the frame is dropped and counted in `dropped`, so that
+    requests never wait for the drive.
+    """
+
+    def __init__(self, root_dir, gunicorn_logger, n_threads: int = 2, max_queue_size: int = 256,
+                 batch_size: int = 32, frame_store=None):
+        """Create the writer. Threads are started by `start()`.
+
+        :param root_dir: The root folder of the facial expressions of all students.
+        :param gunicorn_logger: The logger used to report errors.
+        :param n_threads: The number of writer threads.
+        :param max_queue_size: The maximum number of images waiting to be written.
+        :param batch_size: The maximum number of images fsynced together.
+        :param frame_store: A FrameStore. Images are written as individual PNG files if it is not specified.
+        """
+        self.root_dir = root_dir
+        self.gunicorn_logger = gunicorn_logger
+        self.n_threads = max(1, int(n_threads))
+        self.batch_size = max(1, int(batch_size))
+        self.frame_store = frame_store
+        self.dropped = 0
+        """Number of frames dropped because the queue was full."""
+
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.threads = []
+
+        self._known_dirs = set()
+        self._dir_lock = threading.Lock()
+
+    def start(self):
+        """Start the writer threads."""
+        if len(self.threads) > 0:
+            return
+        for i in range(self.n_threads):
+            thread = Thread(target=self._consume, name="image-writer-{}".format(i), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, image, stu_num, lecture_id, timestamp):
+        """Queue a facial expression to be written.
+
+        :param image: The base64 encoded image (str), the decoded image (bytes), or an ImageFile.
+        :param stu_num: The student number.
+        :param lecture_id: The id of the lecture.
+        :param timestamp: The timestamp when the image is captured.
+        """
+        item = (image, stu_num, lecture_id, timestamp)
+        if len(self.threads) == 0:
+            self._write_batch([item])
+            return
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            if isinstance(image, ImageFile):
+                self._discard(image.path)
+            with self._dir_lock:
+                self.dropped += 1
+                dropped = self.dropped
+            # log the first drop of every 100, not every frame of an overloaded worker
+            if dropped % 100 == 1:
+                self.gunicorn_logger.warning(
+                    "Image writer queue is full. Dropped stu. #{}'s image ({} dropped so far).".format(
+                        stu_num, dropped))
+
+    def join(self):
+        """Block until all queued images are written."""
+        self.queue.join()
+
+    def ensure_dir(self, dirname):
+        """Create the folder if it is not known to exist."""
+        if dirname in self._known_dirs:
+            return
+        os.makedirs(dirname, exist_ok=True)
+        with self._dir_lock:
+            self._known_dirs.add(dirname)
+
+    def _consume(self):
+        """The loop of a writer thread. Takes up to `batch_size` queued images at a time."""
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                self.gunicorn_logger.error("Image writer: {} : {}".format(type(e).__name__, e))
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _log_frame_error(self, stu_num, timestamp, e):
+        self.gunicorn_logger.error("Image writer: stu. #{}'s image at {} is skipped. {} : {}".format(
+            stu_num, timestamp, type(e).__name__, e))
+
+    def _write_batch(self, batch):
+        """Write a batch of (image, stu_num, lecture_id, timestamp)."""
+        if self.frame_store is not None:
+            self._write_segments(batch)
+        else:
+            self._write_files(batch)
+
+    def _write_segments(self, batch):
+        """Append images to the segments of their student and lecture, one fsync per segment."""
+        groups = {}
+        for image, stu_num, lecture_id, timestamp in batch:
+            try:
+                image = self._read(image)
+                float(timestamp)
+            except Exception as e:
+                self._log_frame_error(stu_num, timestamp, e)
+                continue
+            groups.setdefault((stu_num, lecture_id), []).append((timestamp, image))
+        for (stu_num, lecture_id), frames in groups.items():
+            try:
+                self.frame_store.append_many(stu_num, lecture_id, frames)
+            except Exception as e:
+                # a segment that cannot be written does not affect other students
+                self.gunicorn_logger.error("Image writer: {} image(s) of stu. #{} in lecture {} are skipped. "
+                                           "{} : {}".format(len(frames), stu_num, lecture_id, type(e).__name__, e))
+
+    def _write_files(self, batch):
+        """Write images as individual files: write temporary files, fsync them, then rename them in place."""
+        pending = []  # (file_object, tmp_path, final_path, stu_num, timestamp)
+        written = []
+        try:
+            for image, stu_num, lecture_id, timestamp in batch:
+                file_object = None
+                # an ImageFile is already written, and only needs to be renamed
+                tmp_path = image.path if isinstance(image, ImageFile) else None
+                try:
+                    dirname = os.path.join(self.root_dir, str(stu_num))
+                    filename = f"{timestamp}_talk_{lecture_id}"
+                    self.ensure_dir(dirname)
+                    final_path = os.path.join(dirname, f"{filename}.png")
+                    if tmp_path is not None:
+                        file_object = open(tmp_path, "rb")
+                    else:
+                        if isinstance(image, str):
+                            image = base64.b64decode(image)
+                        tmp_path = os.path.join(dirname, f".{filename}.png.tmp")
+                        file_object = open(tmp_path, "wb")
+                        file_object.write(image)
+                    pending.append((file_object, tmp_path, final_path, stu_num, timestamp))
+                except Exception as e:
+                    if file_object is not None:
+                        file_object.close()
+                    if tmp_path is not None:
+                        self._discard(tmp_path)
+                    self._log_frame_error(stu_num, timestamp, e)
+
+            for file_object, tmp_path, final_path, stu_num, timestamp in pending:
+                try:
+                    file_object.flush()
+                    os.fsync(file_object.fileno())
+                    written.append((tmp_path, final_path))
+                except Exception as e:
+                    self._discard(tmp_path)
+                    self._log_frame_error(stu_num, timestamp, e)
+        finally:
+            for file_object, _, _, _, _ in pending:
+                file_object.close()
+
+        dirnames = set()
+        for tmp_path, final_path in written:
+            try:
+                os.replace(tmp_path, final_path)
+            except OSError as e:
+                self._discard(tmp_path)
+                self.gunicorn_logger.error("Image writer: {} is skipped. {} : {}".format(
+                    final_path, type(e).__name__, e))
+                continue
+            dirnames.add(os.path.dirname(final_path))
+
+        # make the renames durable, once per folder
+        for dirname in dirnames:
+            try:
+                fd = os.open(dirname, os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                os.fsync(fd)
+            except OSError:
+                pass
+            finally:
+                os.close(fd)
+
+    def _read(self, image) -> bytes:
+        """Returns the decoded image. The file of an ImageFile is removed."""
+        if isinstance(image, str):
+            return base64.b64decode(image)
+        if isinstance(image, ImageFile):
+            try:
+                with open(image.path, "rb") as f:
+                    return f.read()
+            finally:
+                self._discard(image.path)
+        return image
+
+    @staticmethod
+    def _discard(tmp_path):
+        """Remove the temporary file of a frame that is skipped."""
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
@@ -0,0 +1,257 @@
+import os
+import pickle
+import re
+import struct
+import threading
+import time
+import zlib
+from threading import Thread
+
+from .dataformat import Record
+
+
+class RecordSpool:
+    """An append-only write-ahead spool of the records received by the dedicated server.
+
+    Records are pickled and appended to segment files with a length-prefixed frame:
+    ===== ===== =====
+    length (uint32) crc32 (uint32) payload (pickled Record)
+    ===== ===== =====
+
+    Appends go to a buffered file. A background thread flushes and fsyncs the active segment every
+    `fsync_interval` seconds (group commit), so at most that much data is lost on a crash.
+    Once the CSV files are flushed, the segments sealed before the flush can be discarded (see `rotate()`).
+
+    Segments left by a crashed server hold records which may already be in the CSV files, as they were only
+    discarded after a flush. They are moved to `quarantine/<time of the restart>/` on startup, instead of being
+    replayed into the live CSV folder, and can be materialized into another folder with the replay CLI at the
+    bottom of this module, e.g., `python -m utilities.record_spool SPOOL_DIR/quarantine/<time> OUTPUT_DIR`.
+    """
+    header = struct.Struct("<II")
+    segment_pattern = re.compile(r"^segment-(\d+)\.spool$")
+
+    def __init__(self, spool_dir, gunicorn_logger, fsync_interval: float = 0.2):
+        """Open a new segment in the spool folder.
+
+        :param spool_dir: The folder where segments are stored.
+        :param gunicorn_logger: The logger used to report the progress.
+        :param fsync_interval: The interval of group commits, in seconds.
+        """
+        self.spool_dir = spool_dir
+        self.gunicorn_logger = gunicorn_logger
+        self.fsync_interval = fsync_interval
+
+        if not os.path.exists(spool_dir):
+            os.makedirs(spool_dir)
+
+        # left by a previous run which was not terminated properly
+        self.pending_segments = quarantine(spool_dir)
+        if len(self.pending_segments) > 0:
+            quarantine_dir = os.path.dirname(self.pending_segments[0])
+            self.gunicorn_logger.warning(
+                "Spool: {} segment(s) of a previous run are moved to {}. Replay them into a separate folder with "
+                "`python -m utilities.record_spool {} OUTPUT_DIR`.".format(
+                    len(self.pending_segments), quarantine_dir, quarantine_dir))
+
+        self._lock = threading.Lock()
+        self._closed = False
+        self._dirty = False
+        self._seq = 0
+        self._segment_path, self._file_object = self._open_segment()
+
+        self._stop_event = threading.Event()
+        self._thread = Thread(target=self._group_commit, name="record-spool", daemon=True)
+        self._thread.start()
+
+    def _open_segment(self):
+        """Open the next segment. Must be called with the lock held (or during init)."""
+        path = os.path.join(self.spool_dir, "segment-{:08d}.spool".format(self._seq))
+        self._seq += 1
+        return path, open(path, "ab")
+
+    def append(self, record: Record):
+        """Append a record to the active segment. The record becomes durable at the next group commit."""
+        payload = pickle.dumps(tuple(record), protocol=pickle.HIGHEST_PROTOCOL)
+        frame = RecordSpool.header.pack(len(payload), zlib.crc32(payload)) + payload
+        with self._lock:
+            if self._closed:
+                raise ValueError("Appending to a closed spool.")
+            self._file_object.write(frame)
+            self._dirty = True
+
+    def commit(self):
+        """Flush and fsync the active segment."""
+        with self._lock:
+            if self._closed or not self._dirty:
+                return
+            self._file_object.flush()
+            fd = self._file_object.fileno()
+            self._dirty = False
+            # fsync while holding the lock, so that rotate() can not close the fd in between
+            os.fsync(fd)
+
+    def rotate(self) -> list:
+        """Seal the active segment and continue with a new one.
+
+        :return: The paths of sealed segments. They can be discarded once all records before this call
+            are materialized.
+        """
+        with self._lock:
+            if self._closed:
+                return []
+            sealed = self._seal()
+            self._segment_path, self._file_object = self._open_segment()
+            self._dirty = False
+        return [sealed]
+
+    def close(self) -> list:
+        """Seal the active segment and stop the group commit thread.
+
+        :return: The paths of sealed segments.
+        """
+        self._stop_event.set()
+        with self._lock:
+            if self._closed:
+                return []
+            self._closed = True
+            sealed = self._seal()
+        return [sealed]
+
+    def discard(self, segments: list):
+        """Remove segments whose records are materialized."""
+        for path in segments:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _seal(self):
+        """Flush, fsync and close the active segment. Must be called with the lock held."""
+        self._file_object.flush()
+        os.fsync(self._file_object.fileno())
+        self._file_object.close()
+        return self._segment_path
+
+    def _group_commit(self):
+        """The loop of the group commit thread."""
+        while not self._stop_event.wait(self.fsync_interval):
+            try:
+                self.commit()
+            except (OSError, ValueError) as e:
+                self.gunicorn_logger.error("Spool: group commit failed. {} : {}".format(type(e).__name__, e))
+
+    def get_status_summary(self):
+        """Returns a dictionary of the current status of the spool."""
+        return {
+            "spool_dir": self.spool_dir,
+            "active_segment": self._segment_path,
+            "pending_segments": self.pending_segments,
+            "closed": self._closed,
+        }
+
+
+def segment_seq(path) -> int:
+    """Returns the sequence number of a segment."""
+    return int(RecordSpool.segment_pattern.match(os.path.basename(path)).group(1))
+
+
+def list_segments(spool_dir) -> list:
+    """Returns the paths of all segments in the spool folder, in the order they are written."""
+    if not os.path.exists(spool_dir):
+        return []
+    names = [name for name in os.listdir(spool_dir) if RecordSpool.segment_pattern.match(name) is not None]
+    return [os.path.join(spool_dir, name) for name in sorted(names, key=segment_seq)]
+
+
+def quarantine(spool_dir) -> list:
+    """Move all segments in the spool folder to a new folder `quarantine/<time>/` under it.
+
+    :param spool_dir: The folder where segments are stored.
+    :return: The new paths of the moved segments, in the order they are written.
+    """
+    segments = list_segments(spool_dir)
+    if len(segments) == 0:
+        return []
+    name = time.strftime("%Y%m%d-%H%M%S")
+    quarantine_dir = os.path.join(spool_dir, "quarantine", name)
+    suffix = 1
+    while os.path.exists(quarantine_dir):
+        quarantine_dir = os.path.join(spool_dir, "quarantine", "{}-{}".format(name, suffix))
+        suffix += 1
+    os.makedirs(quarantine_dir)
+    moved = []
+    for path in segments:
+        new_path = os.path.join(quarantine_dir, os.path.basename(path))
+        os.rename(path, new_path)
+        moved.append(new_path)
+    return moved
+
+
+def iter_records(segment_path):
+    """Iterate over the records in a segment.
+
+    A truncated or corrupted tail (e.g., the server crashed while appending) ends the iteration.
+
+    :param segment_path: The path of the segment.
+    :return: A generator of Records.
+    """
+    with open(segment_path, "rb") as f:
+        while True:
+            header = f.read(RecordSpool.header.size)
+            if len(header) < RecordSpool.header.size:
+                return
+            length, crc = RecordSpool.header.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                return
+            yield Record(*pickle.loads(payload))
+
+
+def replay(spool_dir, csv_logger):
+    """Materialize all records in the spool folder with the given logger.
+
+    :param spool_dir: The folder where segments are stored.
+    :param csv_logger: A CSVLogger (or CSVLoggerPool) to write the records.
+    :return: The number of records replayed.
+    """
+    count = 0
+    for segment_path in list_segments(spool_dir):
+        for record in iter_records(segment_path):
+            csv_logger.log(record.type, record.stu_num, record.body)
+            count += 1
+    return count
+
+
+if __name__ == "__main__":
+    """Rebuild the CSV files from the spool left by a crashed dedicated server.
+
+    Run from python/peer: python -m utilities.record_spool SPOOL_DIR OUTPUT_DIR
+    SPOOL_DIR is usually a folder under `quarantine/`, where the server moves the segments on restart.
+    The output folder should not be the folder used by the running server: records flushed before the crash are
+    in both the spool and the CSV files of the server.
+    """
+    import argparse
+    import logging
+
+    from .csv_logger import CSVLogger
+
+    parser = argparse.ArgumentParser(description="Replay spooled records into CSV files.")
+    parser.add_argument("spool_dir", help="The folder where segments are stored.")
+    parser.add_argument("output_dir", help="The folder where CSV files are written.")
+    parser.add_argument("--partitioned", action="store_true",
+                        help="Partition the CSV files by lecture, date and student.")
+    parser.add_argument("--max-bytes", type=int, default=None, help="Size in bytes that a partition is rotated at.")
+    parser.add_argument("--discard", action="store_true", help="Remove the segments after replaying.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    logger = CSVLogger(args.output_dir, logging.getLogger("replay"),
+                       partitioned=args.partitioned, max_bytes=args.max_bytes)
+    segments = list_segments(args.spool_dir)
+    n_records = replay(args.spool_dir, logger)
+    logger.terminate()
+    print("{} record(s) replayed from {} segment(s).".format(n_records, len(segments)))
+
+    if args.discard:
+        for path in segments:
+            os.remove(path)
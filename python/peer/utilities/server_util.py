@@ -92,23 +92,3 @@ def save_screenshot(screenshot, root_dir, slide_id):
         os.makedirs(root_dir)
     filename = os.path.join(root_dir, f"{slide_id}.png")
     skimage.io.imsave(filename, screenshot)
-
-
-def save_facial_expression(b64string, dirname, filename):
-    """
-    Save the facial expression of the student on drive.
-    :param b64string: The base64 encoded image. A string.
-    :param dirname: The folder to save the screenshot.
-    :param filename: The filename of the facial expression.
-    :return:
-    """
-    if not os.path.exists(dirname):
-        os.makedirs(dirname)
-    filename = os.path.join(dirname, f"{filename}.png")
-
-    im_bytes = base64.b64decode(b64string)  # im_bytes is a binary image
-    # im_file = BytesIO(im_bytes)  # convert image to file-like object
-
-    with open(filename, "wb") as f:
-        f.write(im_bytes)
-
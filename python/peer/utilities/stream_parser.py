@@ -0,0 +1,253 @@
+import binascii
+import json
+import os
+import re
+import tempfile
+
+_WHITESPACE = b" \t\r\n"
+_STRUCTURAL = re.compile(rb'[\[\]{}"]')
+_STRING_SPECIAL = re.compile(rb'["\\]')
+_SCALAR_END = re.compile(rb'[,}\]\s]')
+_ESCAPES = {b"/": b"/", b"\\": b"\\", b'"': b'"', b"n": b"", b"r": b""}
+
+
+class _ChunkReader:
+    """Reads a byte stream chunk by chunk, keeping only the unread part of the current chunk."""
+
+    def __init__(self, stream, chunk_size):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buf = b""
+        self.pos = 0
+
+    def fill(self) -> bool:
+        """Read the next chunk. Returns False at the end of the stream."""
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> bytes:
+        """Returns the next non-whitespace byte without consuming it."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos:self.pos + 1] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos:self.pos + 1]
+            if not self.fill():
+                raise ValueError("Unexpected end of JSON body.")
+
+    def expect(self, c: bytes):
+        """Consume the next non-whitespace byte, which must be `c`."""
+        got = self.peek()
+        if got != c:
+            raise ValueError("Expecting {!r} at byte {}, got {!r}.".format(c, self.pos, got))
+        self.pos += 1
+
+    def read_byte(self) -> bytes:
+        """Consume one byte (whitespace included)."""
+        while self.pos >= len(self.buf):
+            if not self.fill():
+                raise ValueError("Unexpected end of JSON body.")
+        c = self.buf[self.pos:self.pos + 1]
+        self.pos += 1
+        return c
+
+    def read_string_into(self, write, escapes: dict = None):
+        """Consume the rest of a string whose opening quote is consumed.
+
+        :param write: Called with consecutive pieces of the string.
+        :param escapes: If specified, escape sequences are replaced using this mapping, otherwise kept as they are.
+        """
+        while True:
+            m = _STRING_SPECIAL.search(self.buf, self.pos)
+            if m is None:
+                write(self.buf[self.pos:])
+                self.pos = len(self.buf)
+                if not self.fill():
+                    raise ValueError("Unterminated string in JSON body.")
+                continue
+            write(self.buf[self.pos:m.start()])
+            self.pos = m.end()
+            if m.group() == b'"':
+                if escapes is None:
+                    write(b'"')
+                return
+            escaped = self.read_byte()
+            if escapes is None:
+                write(b"\\" + escaped)
+            elif escaped in escapes:
+                write(escapes[escaped])
+            else:
+                raise ValueError("Unsupported escape \\{} in a base64 string.".format(escaped.decode()))
+
+    def read_raw_value(self) -> bytes:
+        """Consume a JSON value and return its raw bytes."""
+        out = []
+        c = self.peek()
+        if c == b'"':
+            self.pos += 1
+            out.append(b'"')
+            self.read_string_into(out.append)
+            return b"".join(out)
+
+        if c not in (b"{", b"["):
+            # number, true, false, null
+            while True:
+                m = _SCALAR_END.search(self.buf, self.pos)
+                if m is not None:
+                    out.append(self.buf[self.pos:m.start()])
+                    self.pos = m.start()
+                    return b"".join(out)
+                out.append(self.buf[self.pos:])
+                self.pos = len(self.buf)
+                if not self.fill():
+                    return b"".join(out)
+
+        depth = 0
+        while True:
+            m = _STRUCTURAL.search(self.buf, self.pos)
+            if m is None:
+                out.append(self.buf[self.pos:])
+                self.pos = len(self.buf)
+                if not self.fill():
+                    raise ValueError("Unexpected end of JSON body.")
+                continue
+            out.append(self.buf[self.pos:m.end()])
+            self.pos = m.end()
+            token = m.group()
+            if token == b'"':
+                self.read_string_into(out.append)
+            elif token in (b"{", b"["):
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return b"".join(out)
+
+
+class _Base64Sink:
+    """Decodes base64 text fed in pieces of any length into a binary file."""
+
+    def __init__(self, out):
+        self.carry = b""
+        self.out = out
+
+    def write(self, data: bytes):
+        data = self.carry + data
+        n = len(data) // 4 * 4
+        if n > 0:
+            self.out.write(binascii.a2b_base64(data[:n]))
+        self.carry = data[n:]
+
+    def close(self):
+        if len(self.carry) > 0:
+            self.out.write(binascii.a2b_base64(self.carry + b"=" * (-len(self.carry) % 4)))
+            self.carry = b""
+        self.out.close()
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def parse_facial_expression_upload(stream, on_frame, frame_key: str = "facialExpression", required_keys=(),
+                                   chunk_size: int = 64 * 1024, tmp_dir=None):
+    """Parse a JSON object from a stream, handing the facial expressions over one at a time.
+
+    The posted body is a JSON object whose `frame_key` field is a list of [timestamp, base64 string].
+    Each base64 string is decoded chunk by chunk into a temporary file, so memory stays bounded by `chunk_size`,
+    no matter how large or how many frames are posted. Other fields are parsed with `json.loads`.
+
+    :param stream: A file-like object with `read(size)`, e.g., flask.request.stream.
+    :param on_frame: Called as on_frame(fields, timestamp, path of the temporary file) for each frame. `fields`
+        contains the other fields of the object parsed so far. on_frame takes over the file: it renames or removes it.
+    :param frame_key: The field holding the frames.
+    :param required_keys: Fields that on_frame relies on. Frames met before all of them are parsed are kept in
+        their temporary files and handed over when the object ends.
+    :param chunk_size: The number of bytes read from the stream at a time.
+    :param tmp_dir: The folder of the temporary files. Should be on the file system where frames are stored, so
+        that they can be renamed in place. The default temporary folder is used if it is not specified.
+    :return: A tuple of (the other fields as a dictionary, the number of frames).
+    :raises ValueError: The body is not a JSON object in the expected form. Temporary files not handed over yet
+        are removed.
+    """
+    deferred = []
+    try:
+        return _parse_upload(_ChunkReader(stream, chunk_size), on_frame, frame_key, required_keys, tmp_dir, deferred)
+    except BaseException:
+        for _, path in deferred:
+            _remove(path)
+        raise
+
+
+def _parse_upload(reader, on_frame, frame_key, required_keys, tmp_dir, deferred):
+    """See parse_facial_expression_upload(). Frames waiting for the required keys are appended to `deferred`."""
+    fields = {}
+    n_frames = 0
+
+    def emit(timestamp, path):
+        if all(k in fields for k in required_keys):
+            on_frame(fields, timestamp, path)
+        else:
+            deferred.append((timestamp, path))
+
+    reader.expect(b"{")
+    if reader.peek() == b"}":
+        reader.pos += 1
+        return fields, 0
+
+    while True:
+        key = json.loads(reader.read_raw_value())
+        reader.expect(b":")
+
+        if key == frame_key and reader.peek() == b"[":
+            reader.pos += 1
+            if reader.peek() == b"]":
+                reader.pos += 1
+            else:
+                while True:
+                    reader.expect(b"[")
+                    timestamp = json.loads(reader.read_raw_value())
+                    reader.expect(b",")
+                    reader.expect(b'"')
+                    fd, path = tempfile.mkstemp(suffix=".frame", dir=tmp_dir)
+                    sink = _Base64Sink(os.fdopen(fd, "wb"))
+                    try:
+                        reader.read_string_into(sink.write, escapes=_ESCAPES)
+                        sink.close()
+                        reader.expect(b"]")
+                    except BaseException:
+                        sink.out.close()
+                        _remove(path)
+                        raise
+                    emit(timestamp, path)
+                    n_frames += 1
+
+                    c = reader.peek()
+                    reader.pos += 1
+                    if c == b"]":
+                        break
+                    if c != b",":
+                        raise ValueError("Expecting ',' or ']' in {}, got {!r}.".format(frame_key, c))
+        else:
+            fields[key] = json.loads(reader.read_raw_value())
+
+        c = reader.peek()
+        reader.pos += 1
+        if c == b"}":
+            break
+        if c != b",":
+            raise ValueError("Expecting ',' or '}}', got {!r}.".format(c))
+
+    if len(deferred) > 0 and not all(k in fields for k in required_keys):
+        raise ValueError("Missing fields {} for the frames.".format([k for k in required_keys if k not in fields]))
+    while len(deferred) > 0:
+        timestamp, path = deferred.pop(0)
+        on_frame(fields, timestamp, path)
+    return fields, n_frames